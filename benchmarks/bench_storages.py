@@ -0,0 +1,348 @@
+"""Measure the throughput of TimeMachineMiddleware with each storage.
+
+Every run snapshots a synthetic crawl through the middleware, retrieves it
+back and prints one JSON object per storage, so results from different
+versions of scrapy-time-machine can be compared. Each storage runs in its
+own process to get a meaningful peak RSS. S3 storages run against moto.
+
+    python benchmarks/bench_storages.py --requests 100000 --output results.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import traceback
+import warnings
+from glob import glob
+from time import perf_counter
+
+STORAGES = {
+    "dbm": "scrapy_time_machine.storages.DbmTimeMachineStorage",
+    "segment": "scrapy_time_machine.storages.SegmentTimeMachineStorage",
+    "sqlite": "scrapy_time_machine.storages.SqliteTimeMachineStorage",
+    "s3": "scrapy_time_machine.storages.S3TimeMachineStorage",
+    "s3-segment": "scrapy_time_machine.storages.S3SegmentTimeMachineStorage",
+    "sharded": "scrapy_time_machine.storages.ShardedTimeMachineStorage",
+    "s3-sharded": "scrapy_time_machine.storages.S3ShardedTimeMachineStorage",
+}
+
+DEFAULT_SIZES = "1KB:60,10KB:25,100KB:10,1MB:4,10MB:1"
+
+_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+WORDS = [
+    "<div>",
+    "</div>",
+    '<a href="/page">',
+    "</a>",
+    "<p>",
+    "</p>",
+    'class="item"',
+    "price",
+    "title",
+    "description",
+] + [
+    "".join(random.Random(i).choices("abcdefghijklmnopqrstuvwxyz", k=7))
+    for i in range(500)
+]
+
+
+def parse_size(value):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?B?)", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def parse_sizes(value):
+    """Parse a ``SIZE:WEIGHT,...`` body size distribution."""
+    sizes, weights = [], []
+    for item in value.split(","):
+        size, _, weight = item.partition(":")
+        sizes.append(parse_size(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def parse_setting(value):
+    name, sep, raw = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE: {value}")
+    return name, raw
+
+
+class Crawl:
+    """Synthetic crawl, regenerated identically for the retrieve phase.
+
+    Bodies are slices of a text built from a small vocabulary, so they
+    compress roughly like HTML, starting with their URL so they all differ.
+    """
+
+    def __init__(self, requests, sizes, seed):
+        self.requests = requests
+        self.sizes, self.weights = sizes
+        self.seed = seed
+        rng = random.Random(seed)
+        text = []
+        length = 0
+        # Twice the largest body, so bodies of that size start anywhere
+        while length < 2 * max(self.sizes):
+            word = rng.choice(WORDS)
+            text.append(word)
+            length += len(word) + 1
+        self.text = " ".join(text).encode()
+
+    def __iter__(self):
+        return map(self.page, range(self.requests))
+
+    def shuffled(self):
+        order = list(range(self.requests))
+        random.Random(self.seed).shuffle(order)
+        return map(self.page, order)
+
+    def page(self, i):
+        from scrapy.http import HtmlResponse, Request
+
+        rng = random.Random(f"{self.seed}-{i}")
+        url = f"http://example.com/{i}"
+        size = rng.choices(self.sizes, self.weights)[0]
+        start = rng.randrange(len(self.text) - size + 1)
+        body = (url.encode() + self.text[start : start + size])[:size]
+        response = HtmlResponse(url, headers={"Content-Type": "text/html"}, body=body)
+        return Request(url), response
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    latencies.sort()
+    result = {
+        f"p{p}": latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+        for p in (50, 90, 99)
+    }
+    result["max"] = latencies[-1]
+    return result
+
+
+def phase_result(count, total_bytes, elapsed, latencies):
+    return {
+        "ops": count,
+        "seconds": elapsed,
+        "ops_per_second": count / elapsed if elapsed else None,
+        "mb_per_second": total_bytes / 1024**2 / elapsed if elapsed else None,
+        "latency": percentiles(latencies),
+    }
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def snapshot_size(storage, uri):
+    if uri.startswith("s3://"):
+        bucket, path = storage.get_netloc_and_path(uri)
+        objects = storage.s3_client.list_objects(Bucket=bucket, Prefix=path.lstrip("/"))
+        return sum(o["Size"] for o in objects.get("Contents", []))
+    # dbm implementations and segment indexes add suffixes to the file name,
+    # sharded snapshots are directories
+    size = 0
+    for path in glob(glob_escape(uri) + "*"):
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        else:
+            size += os.path.getsize(path)
+    return size
+
+
+def glob_escape(path):
+    return re.sub(r"([*?[])", r"[\1]", path)
+
+
+def run_phase(mode, settings, crawl, shuffle):
+    from scrapy import Spider
+    from scrapy.settings import Settings
+    from scrapy.utils.test import get_crawler
+
+    from scrapy_time_machine.timemachine import TimeMachineMiddleware
+
+    crawler = get_crawler(Spider)
+    spider = Spider(name="benchmark")
+    crawler.stats.open_spider(spider)
+    settings = Settings({**settings, f"TIME_MACHINE_{mode.upper()}": True})
+
+    start = perf_counter()
+    mw = TimeMachineMiddleware(settings, crawler.stats)
+    mw.spider_opened(spider)
+    open_time = perf_counter() - start
+
+    pairs = crawl.shuffled() if shuffle and mode == "retrieve" else iter(crawl)
+
+    latencies = []
+    total_bytes = 0
+    start = perf_counter()
+    for request, response in pairs:
+        t = perf_counter()
+        if mode == "snapshot":
+            mw.process_response(request, response, spider)
+        else:
+            response = mw.process_request(request, spider)
+        latencies.append(perf_counter() - t)
+        total_bytes += len(response.body)
+    elapsed = perf_counter() - start
+
+    start = perf_counter()
+    mw.spider_closed(spider)
+    close_time = perf_counter() - start
+    # Writes may be deferred to the close, e.g. with TIME_MACHINE_WRITE_WORKERS
+    result = phase_result(len(latencies), total_bytes, elapsed + close_time, latencies)
+    result["open_seconds"] = open_time
+    result["close_seconds"] = close_time
+    result["stats"] = {
+        k: v
+        for k, v in crawler.stats.get_stats().items()
+        if k.startswith("time_machine/")
+    }
+    return mw.storage, result
+
+
+def run_storage(name, args):
+    """Snapshot and retrieve the crawl with a storage, in a child process."""
+    warnings.simplefilter("ignore")
+    tmpdir = tempfile.mkdtemp(prefix="time-machine-bench-")
+    moto_mock = None
+    try:
+        if name.startswith("s3"):
+            import boto3
+            import moto
+
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            moto_mock = moto.mock_aws()
+            moto_mock.start()
+            boto3.client("s3").create_bucket(Bucket="benchmark")
+            uri = "s3://benchmark/snapshot.db"
+        else:
+            uri = os.path.join(tmpdir, "snapshot.db")
+
+        settings = {
+            "TIME_MACHINE_ENABLED": True,
+            "TIME_MACHINE_STORAGE": STORAGES[name],
+            "TIME_MACHINE_URI": uri,
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            **dict(args.settings),
+        }
+        crawl = Crawl(args.requests, args.sizes, args.seed)
+        storage, store = run_phase("snapshot", settings, crawl, args.shuffle)
+        size = snapshot_size(storage, storage.snapshot_uri)
+        _, retrieve = run_phase("retrieve", settings, crawl, args.shuffle)
+        return {
+            "storage": name,
+            "requests": args.requests,
+            "sizes": args.sizes_spec,
+            "settings": dict(args.settings),
+            "store": store,
+            "retrieve": retrieve,
+            "snapshot_bytes": size,
+            "peak_rss_bytes": peak_rss(),
+        }
+    except Exception:
+        # Storage exceptions may not survive the trip back to the parent
+        raise RuntimeError(traceback.format_exc()) from None
+    finally:
+        if moto_mock is not None:
+            moto_mock.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def environment():
+    try:
+        from importlib.metadata import version
+
+        package_version = version("scrapy-time-machine")
+    except Exception:
+        package_version = None
+    return {
+        "version": package_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def format_summary(result):
+    lines = [f"{result['storage']}: {result['snapshot_bytes'] / 1024 ** 2:.1f} MiB"]
+    for phase in ("store", "retrieve"):
+        r = result[phase]
+        latency = r["latency"]
+        lines.append(
+            f"  {phase:8} {r['ops_per_second']:10.1f} ops/s {r['mb_per_second']:8.1f} MiB/s"
+            f"  p50 {latency['p50'] * 1000:.3f} ms  p99 {latency['p99'] * 1000:.3f} ms"
+            f"  open {r['open_seconds']:.3f} s  close {r['close_seconds']:.3f} s"
+        )
+    lines.append(f"  peak RSS {result['peak_rss_bytes'] / 1024 ** 2:.1f} MiB")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--storage",
+        action="append",
+        choices=sorted(STORAGES),
+        help="storage to benchmark, can be repeated (default: all)",
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help=f"body size distribution as SIZE:WEIGHT,... (default: {DEFAULT_SIZES})",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--shuffle", action="store_true", help="retrieve in random order"
+    )
+    parser.add_argument(
+        "-s",
+        dest="settings",
+        action="append",
+        type=parse_setting,
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra setting, e.g. -s TIME_MACHINE_CODEC=zstd",
+    )
+    parser.add_argument("--output", help="append JSON lines to this file")
+    args = parser.parse_args(argv)
+    args.sizes_spec = args.sizes
+    args.sizes = parse_sizes(args.sizes)
+
+    env = environment()
+    context = multiprocessing.get_context("spawn")
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for name in args.storage or list(STORAGES):
+            with context.Pool(1) as pool:
+                try:
+                    result = pool.apply(run_storage, (name, args))
+                except Exception as e:
+                    print(f"{name}: failed\n{e}", file=sys.stderr)
+                    continue
+            result.update(env)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            print(format_summary(result), file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
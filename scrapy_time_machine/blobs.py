@@ -0,0 +1,127 @@
+import dbm
+import logging
+import mmap
+import os
+from contextlib import contextmanager
+from hashlib import sha256
+from os.path import exists, join
+from tempfile import NamedTemporaryFile, TemporaryFile
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+def blob_digest(body):
+    return sha256(body).hexdigest()
+
+
+class DbmBlobStore:
+    """Content addressed store of response bodies.
+
+    Bodies are kept compressed in a dbm database under the SHA-256 of their
+    uncompressed content, prefixed by the name of the codec used, so a
+    store can be shared by snapshots written with different codecs. Only
+    one process may write to a store at a time, ``flag`` is ``"r"`` for the
+    others.
+    """
+
+    def __init__(self, path, flag="c"):
+        self.path = path
+        self.db = dbm.open(path, flag)
+        self._lock = Lock()
+
+    def __contains__(self, digest):
+        with self._lock:
+            return digest in self.db
+
+    def get(self, digest):
+        with self._lock:
+            value = self.db.get(digest)
+        if value is None:
+            return None
+        codec_name, _, data = value.partition(b"\n")
+        return codec_name.decode(), data
+
+    def put(self, digest, codec_name, data):
+        value = codec_name.encode() + b"\n" + data
+        with self._lock:
+            self.db[digest] = value
+
+    def close(self):
+        self.db.close()
+
+
+@contextmanager
+def _mapped(f):
+    if not os.fstat(f.fileno()).st_size:
+        yield b""  # empty files can't be mapped
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        yield m
+
+
+class FileBodyStore:
+    """Large bodies of a snapshot, one file each in a directory next to it.
+
+    ``open`` memory maps the file, so reading a body doesn't load it in
+    memory before it is decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, name, data):
+        path = join(self.path, name)
+        if exists(path):
+            return  # names are digests of the content
+        os.makedirs(self.path, exist_ok=True)
+        # Readers never see a partial file
+        with NamedTemporaryFile(dir=self.path, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    @contextmanager
+    def open(self, name):
+        with open(join(self.path, name), "rb") as f, _mapped(f) as data:
+            yield data
+
+    def close(self):
+        pass
+
+
+class S3BodyStore:
+    """Large bodies of a snapshot, one object each under an S3 prefix.
+
+    With an ``uploader`` (a :class:`~scrapy_time_machine.writers.ThreadedWriter`)
+    objects are uploaded in background threads, ``close`` waits for them.
+    """
+
+    def __init__(self, client, bucket, prefix, uploader=None):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.uploader = uploader
+
+    def put(self, name, data):
+        self.uploader.put(self._upload, name, data)
+
+    def _upload(self, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+    @contextmanager
+    def open(self, name):
+        with TemporaryFile() as f:
+            self.client.download_fileobj(self.bucket, self.prefix + name, f)
+            f.flush()
+            with _mapped(f) as data:
+                yield data
+
+    def close(self):
+        if self.uploader is None:
+            return
+        self.uploader.close()
+        errors, self.uploader = self.uploader.errors, None
+        if errors:
+            raise IOError(
+                f"Failed to upload {errors} bodies to s3://{self.bucket}/{self.prefix}"
+            )
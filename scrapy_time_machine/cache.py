@@ -0,0 +1,174 @@
+import os
+from collections import OrderedDict
+from os.path import exists, join
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+
+class BlockCache:
+    """Read byte ranges of a remote object through an LRU cache of blocks.
+
+    ``fetch(start, end)`` must return the bytes of the object between
+    ``start`` and ``end`` (exclusive). Blocks missing from a read are fetched
+    with a single call, even when some blocks in between are cached.
+    """
+
+    def __init__(self, fetch, block_size, max_size):
+        self.fetch = fetch
+        self.block_size = block_size
+        self.max_size = max_size
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def read(self, offset, length):
+        block_size = self.block_size
+        first = offset // block_size
+        last = (offset + max(length, 1) - 1) // block_size
+        wanted = range(first, last + 1)
+
+        with self._lock:
+            blocks = {i: self.blocks[i] for i in wanted if i in self.blocks}
+            for i in blocks:
+                self.blocks.move_to_end(i)
+            missing = [i for i in wanted if i not in blocks]
+            self.hits += len(blocks)
+            self.misses += len(missing)
+
+        if missing:
+            start, stop = missing[0], missing[-1] + 1
+            data = self.fetch(start * block_size, stop * block_size)
+            for i in range(start, stop):
+                pos = (i - start) * block_size
+                blocks[i] = data[pos : pos + block_size]
+            with self._lock:
+                for i in missing:
+                    self._add(i, blocks[i])
+
+        start = offset - first * block_size
+        if first == last:
+            return memoryview(blocks[first])[start : start + length]
+        return memoryview(b"".join(blocks[i] for i in wanted))[start : start + length]
+
+    def _add(self, i, block):
+        if i in self.blocks:
+            return
+        self.blocks[i] = block
+        self.size += len(block)
+        while self.size > self.max_size and self.blocks:
+            _, evicted = self.blocks.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class ResponseCache:
+    """LRU cache of responses, holding at most ``max_size`` bytes.
+
+    Cached responses are never handed out, ``get`` returns a copy, so
+    changes to the flags or headers of one don't leak into the others.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.responses.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.responses.move_to_end(key)
+            self.hits += 1
+        return entry[0].replace()
+
+    def put(self, key, response):
+        size = self._size(response)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self.responses:
+                return
+            self.responses[key] = (response.replace(), size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self.responses.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    @staticmethod
+    def _size(response):
+        size = len(response.url) + len(response.body)
+        for name, values in response.headers.items():
+            size += len(name) + sum(len(value) for value in values)
+        return size
+
+
+class SnapshotCache:
+    """Directory of downloaded snapshots, capped to ``max_size`` bytes.
+
+    Files are named after their key. The least recently used ones, by
+    modification time, are removed when new files don't fit. Files are
+    only ever renamed into place complete, so the directory can be shared
+    by concurrent processes.
+    """
+
+    suffix = ".snapshot"
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = self._path(key)
+        if not exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def add(self, key, write):
+        """Add the file that ``write(f)`` writes to the binary file ``f``."""
+        path = self._path(key)
+        with NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False) as f:
+            try:
+                write(f)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        self._evict(keep=path)
+        return path
+
+    def _path(self, key):
+        return join(self.directory, key + self.suffix)
+
+    def _evict(self, keep):
+        files = []
+        for name in os.listdir(self.directory):
+            path = join(self.directory, name)
+            if not name.endswith(self.suffix) or path == keep:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # evicted by another process
+            files.append((stat.st_mtime, stat.st_size, path))
+        size = os.path.getsize(keep) + sum(f[1] for f in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            self.evictions += 1
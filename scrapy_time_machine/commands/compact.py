@@ -0,0 +1,68 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_time_machine.convert import compact_snapshots
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+
+    def syntax(self):
+        return "[options] <source uri> [<source uri> ...] <target uri>"
+
+    def short_desc(self):
+        return "Compact, merge or extract a subset of Time Machine snapshots"
+
+    def long_desc(self):
+        return (
+            "Copy the latest response to each request of one or more Time Machine "
+            "snapshots to a new snapshot, leaving out the space of replaced "
+            "records, optionally keeping only some URLs or fingerprints. Bodies are "
+            "compressed again with the TIME_MACHINE_CODEC setting. The storage is "
+            "taken from the TIME_MACHINE_STORAGE setting."
+        )
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--url",
+            metavar="REGEX",
+            help="only copy responses whose URL matches REGEX",
+        )
+        parser.add_argument(
+            "--fingerprints",
+            metavar="FILE",
+            help="only copy the responses to the request fingerprints in FILE, "
+            "one per line",
+        )
+        parser.add_argument(
+            "--target-storage",
+            metavar="CLASS",
+            help="storage of the target snapshot, TIME_MACHINE_STORAGE by default",
+        )
+        parser.add_argument(
+            "-P",
+            "--processes",
+            type=int,
+            default=0,
+            metavar="N",
+            help="compress bodies in N worker processes",
+        )
+
+    def run(self, args, opts):
+        if len(args) < 2:
+            raise UsageError()
+        fingerprints = None
+        if opts.fingerprints:
+            with open(opts.fingerprints) as f:
+                fingerprints = {line.strip() for line in f if line.strip()}
+        copied = compact_snapshots(
+            self.settings,
+            args[:-1],
+            args[-1],
+            url_pattern=opts.url,
+            fingerprints=fingerprints,
+            target_storage=opts.target_storage,
+            processes=opts.processes,
+        )
+        print(f"Copied {copied} responses")
@@ -0,0 +1,27 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_time_machine.convert import convert_snapshot
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+
+    def syntax(self):
+        return "<source uri> <target uri>"
+
+    def short_desc(self):
+        return "Copy a Time Machine snapshot, converting it to the current format"
+
+    def long_desc(self):
+        return (
+            "Copy a Time Machine snapshot, rewriting the records written by older "
+            "versions in the current binary format. The storage is taken from the "
+            "TIME_MACHINE_STORAGE setting."
+        )
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        converted = convert_snapshot(self.settings, *args)
+        print(f"Converted {converted} records")
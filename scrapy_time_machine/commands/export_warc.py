@@ -0,0 +1,27 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_time_machine.warc import export_warc
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+
+    def syntax(self):
+        return "<snapshot uri> <warc file>"
+
+    def short_desc(self):
+        return "Export the responses of a Time Machine snapshot to a WARC file"
+
+    def long_desc(self):
+        return (
+            "Write every response of a Time Machine snapshot to a WARC file, gzipped "
+            "record by record when its name ends with .gz. The storage is taken "
+            "from the TIME_MACHINE_STORAGE setting."
+        )
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        exported = export_warc(self.settings, *args)
+        print(f"Exported {exported} responses")
@@ -0,0 +1,27 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_time_machine.warc import import_warc
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+
+    def syntax(self):
+        return "<warc file> [<warc file> ...] <snapshot uri>"
+
+    def short_desc(self):
+        return "Build a Time Machine snapshot from WARC files"
+
+    def long_desc(self):
+        return (
+            "Store the responses of WARC files, gzipped or not, in a Time Machine "
+            "snapshot that can be retrieved by a crawl. The storage is taken from "
+            "the TIME_MACHINE_STORAGE setting."
+        )
+
+    def run(self, args, opts):
+        if len(args) < 2:
+            raise UsageError()
+        imported = import_warc(self.settings, args[:-1], args[-1])
+        print(f"Imported {imported} responses")
@@ -0,0 +1,27 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_time_machine.convert import merge_shards
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+
+    def syntax(self):
+        return "<sharded uri> <target uri>"
+
+    def short_desc(self):
+        return "Merge the shards of a Time Machine snapshot in a single snapshot"
+
+    def long_desc(self):
+        return (
+            "Merge the shards written by every writer of a sharded Time Machine "
+            "snapshot in a single snapshot of the storage of the shards. The sharded "
+            "storage is taken from the TIME_MACHINE_STORAGE setting."
+        )
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        merged = merge_shards(self.settings, *args)
+        print(f"Merged {merged} responses")
@@ -0,0 +1,34 @@
+from scrapy.commands.crawl import Command as CrawlCommand
+
+
+class Command(CrawlCommand):
+    def short_desc(self):
+        return "Run a spider against a Time Machine snapshot, without downloading"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "-P",
+            "--processes",
+            type=int,
+            default=None,
+            metavar="N",
+            help="run spider callbacks in N worker processes",
+        )
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        self.settings.set("TIME_MACHINE_ENABLED", True, priority="cmdline")
+        self.settings.set("TIME_MACHINE_RETRIEVE", True, priority="cmdline")
+        self.settings.set("TIME_MACHINE_SNAPSHOT", False, priority="cmdline")
+        self.settings.set(
+            "DOWNLOADER", "scrapy_time_machine.replay.ReplayDownloader", "cmdline"
+        )
+        self.settings.set("AUTOTHROTTLE_ENABLED", False, priority="cmdline")
+        self.settings.set(
+            "TIME_MACHINE_REPLAY_SPIDER_ARGUMENTS", opts.spargs, priority="cmdline"
+        )
+        if opts.processes is not None:
+            self.settings.set(
+                "TIME_MACHINE_REPLAY_PROCESSES", opts.processes, priority="cmdline"
+            )
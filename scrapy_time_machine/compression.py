@@ -0,0 +1,132 @@
+import gzip
+from threading import local
+
+from scrapy.exceptions import NotConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class NoneCodec:
+    name = "none"
+    trainable = False
+
+    def __init__(self, level=None):
+        self.level = level
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+
+class GzipCodec(NoneCodec):
+    name = "gzip"
+
+    def __init__(self, level=None):
+        super().__init__(9 if level is None else level)
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec(NoneCodec):
+    """Zstandard codec, optionally using a dictionary shared by all bodies.
+
+    zstandard compressors are not thread safe, so each thread gets its own.
+    """
+
+    name = "zstd"
+    trainable = True
+
+    def __init__(self, level=None, dictionary=None):
+        if zstandard is None:
+            raise NotConfigured("The zstd codec requires the zstandard package")
+        super().__init__(3 if level is None else level)
+        self.dictionary = None
+        self._local = local()
+        if dictionary is not None:
+            self.set_dictionary(dictionary)
+
+    def set_dictionary(self, dictionary):
+        self.dictionary = zstandard.ZstdCompressionDict(bytes(dictionary))
+        self._local = local()
+
+    def train(self, samples, dict_size):
+        """Return a dictionary trained from ``samples`` as bytes."""
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+    def compress(self, data):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self.dictionary
+            )
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor(
+                dict_data=self.dictionary
+            )
+        return decompressor.decompress(data)
+
+
+def check_delta():
+    if zstandard is None:
+        raise NotConfigured("Delta compression requires the zstandard package")
+
+
+def delta_compress(reference, data, level=3):
+    """Return ``data`` compressed with ``reference`` as a dictionary.
+
+    Like ``zstd --patch-from``, the window and match tables cover the whole
+    reference, so data that barely changed compresses to a few bytes.
+    """
+    dictionary = zstandard.ZstdCompressionDict(
+        reference, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+    )
+    defaults = zstandard.ZstdCompressionParameters.from_level(
+        level, source_size=len(data), dict_size=len(reference)
+    )
+    # Capped to what decompressors accept by default
+    window_log = min(max(len(reference) + len(data), 1).bit_length(), 27)
+    params = zstandard.ZstdCompressionParameters(
+        window_log=max(window_log, defaults.window_log),
+        hash_log=max(min(window_log, 24), defaults.hash_log),
+        chain_log=max(min(window_log, 24), defaults.chain_log),
+        search_log=defaults.search_log,
+        min_match=defaults.min_match,
+        target_length=defaults.target_length,
+        strategy=defaults.strategy,
+        enable_ldm=True,
+    )
+    compressor = zstandard.ZstdCompressor(
+        dict_data=dictionary, compression_params=params
+    )
+    return compressor.compress(data)
+
+
+def delta_decompress(reference, delta):
+    dictionary = zstandard.ZstdCompressionDict(
+        bytes(reference), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+    )
+    return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(delta)
+
+
+CODECS = {codec.name: codec for codec in (NoneCodec, GzipCodec, ZstdCodec)}
+
+
+def get_codec(name, level=None):
+    try:
+        codec_cls = CODECS[name]
+    except KeyError:
+        raise NotConfigured(f"Unknown Time Machine codec: {name}")
+    return codec_cls(level=level)
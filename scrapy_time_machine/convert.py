@@ -0,0 +1,337 @@
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+
+from scrapy_time_machine.compression import get_codec
+from scrapy_time_machine.records import is_record
+from scrapy_time_machine.storages import (
+    ShardedTimeMachineStorage,
+    SqliteTimeMachineStorage,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORAGE = "scrapy_time_machine.storages.DbmTimeMachineStorage"
+
+
+def open_storage(settings, uri, mode, **overrides):
+    """Open the snapshot at ``uri`` outside of a crawl.
+
+    ``mode`` is ``"retrieve"`` or ``"snapshot"``. Features that only make
+    sense during a crawl are disabled, ``overrides`` are set on top.
+    """
+    settings = settings.copy()
+    for name, value in {
+        "TIME_MACHINE_URI": uri,
+        "TIME_MACHINE_RETRIEVE": mode == "retrieve",
+        "TIME_MACHINE_SNAPSHOT": mode == "snapshot",
+        "TIME_MACHINE_WRITE_WORKERS": 0,
+        "TIME_MACHINE_PREFETCH": 0,
+        "TIME_MACHINE_ZSTD_DICT_SAMPLES": 0,
+        "TIME_MACHINE_PROFILE": False,
+        **overrides,
+    }.items():
+        settings.set(name, value, priority="cmdline")
+    storage_cls = load_object(settings.get("TIME_MACHINE_STORAGE") or DEFAULT_STORAGE)
+    storage = storage_cls(settings)
+    storage.set_uri({})
+    if mode == "retrieve" and not storage.is_uri_valid():
+        raise NotConfigured(f"Invalid URI {storage.snapshot_uri}")
+    storage.open_spider(None)
+    # Only what is copied ends in the snapshot
+    storage._order = None
+    return storage
+
+
+def _is_record_key(key):
+    if key.startswith("__") and key.endswith("__"):
+        return False  # metadata
+    return not key.endswith(("_versions", "_time"))
+
+
+def convert_snapshot(settings, source_uri, target_uri):
+    """Copy the snapshot at ``source_uri`` to ``target_uri``, rewriting the
+    records of older versions in the current binary format.
+
+    Bodies are copied as they are, compressed, in the blob store or in the
+    body store of the snapshot. Returns
+    the number of records that were converted.
+    """
+    storage_cls = load_object(settings.get("TIME_MACHINE_STORAGE") or DEFAULT_STORAGE)
+    if issubclass(storage_cls, SqliteTimeMachineStorage):
+        raise NotConfigured(f"{storage_cls.__name__} snapshots don't need converting")
+
+    source = open_storage(
+        settings, source_uri, "retrieve", TIME_MACHINE_LEGACY_RECORDS=True
+    )
+    try:
+        # Records are copied with the header table they refer to
+        target = open_storage(
+            settings, target_uri, "snapshot", TIME_MACHINE_HEADER_TABLE_SIZE=0
+        )
+    except Exception:
+        source.close_spider(None)
+        raise
+    if target.body_store is None:
+        target.body_store = target._open_body_store()
+    converted = 0
+    try:
+        for key, value in source._iter_items():
+            if key.endswith("_time"):
+                continue  # kept in the records now
+            data = source._load_record(value) if _is_record_key(key) else {}
+            if data and not is_record(value):
+                if "body_ref" not in data:
+                    # Bodies were always gzipped before codecs were configurable
+                    data.setdefault("codec", "gzip")
+                if "time" not in data:
+                    timestamp = source._get(f"{key[: -len('_data')]}_time")
+                    data["time"] = float(timestamp) if timestamp else 0.0
+                value = target._dump_record(data)
+                converted += 1
+            if "external" in data:
+                _copy_external(source, target, data["external"])
+            with target._write_lock:
+                target._put(key, value)
+    finally:
+        source.close_spider(None)
+        target.close_spider(None)
+    logger.info(f"Converted {converted} records from {source_uri} to {target_uri}")
+    return converted
+
+
+def _copy_external(source, target, name):
+    with source.body_store.open(name) as body:
+        target.body_store.put(name, bytes(body))
+
+
+def merge_shards(settings, source_uri, target_uri):
+    """Merge the shards of the snapshot at ``source_uri`` in a single
+    snapshot of their storage at ``target_uri``.
+
+    Responses are decoded and stored again, keeping their crawl time, so
+    shards compressed with different dictionaries can be merged. When
+    several writers stored the same request, the latest response wins.
+    Archives are merged as plain snapshots of their latest responses.
+    Returns the number of responses in the merged snapshot.
+    """
+    storage_cls = load_object(settings.get("TIME_MACHINE_STORAGE") or DEFAULT_STORAGE)
+    if not issubclass(storage_cls, ShardedTimeMachineStorage):
+        raise NotConfigured(f"{storage_cls.__name__} snapshots are not sharded")
+
+    source = open_storage(settings, source_uri, "retrieve")
+    shard_storages = {manifest["storage"] for manifest in source.manifests}
+    if len(shard_storages) != 1:
+        source.close_spider(None)
+        raise NotConfigured(f"Shards use different storages: {shard_storages}")
+    try:
+        target = open_storage(
+            settings,
+            target_uri,
+            "snapshot",
+            TIME_MACHINE_STORAGE=shard_storages.pop(),
+            TIME_MACHINE_ARCHIVE=False,
+        )
+    except Exception:
+        source.close_spider(None)
+        raise
+    # Crawl times of the merged responses
+    merged = {}
+    try:
+        for shard in source.iter_shards():
+            for key in shard._get_order() or ():
+                data = shard._find_data(key)
+                if data is None:
+                    continue
+                crawled = data.get("time", 0.0)
+                if merged.get(key, -1.0) >= crawled:
+                    continue
+                response = shard._build_response(data)
+                record = target._encode_response(key, response)
+                record["time"] = crawled
+                target._write_data(key, record)
+                merged[key] = crawled
+        # Keep a crawl order for prefetching
+        target._start_order()
+        for key in sorted(merged, key=merged.get):
+            target._record_order(key)
+    finally:
+        source.close_spider(None)
+        target.close_spider(None)
+    logger.info(f"Merged {len(merged)} responses from {source_uri} to {target_uri}")
+    return len(merged)
+
+
+def iter_storages(storage):
+    """Yield the snapshots of ``storage``: itself, or the storages of its
+    shards when it is sharded, from the oldest writer to the latest.
+    """
+    if isinstance(storage, ShardedTimeMachineStorage):
+        yield from reversed(list(storage.iter_shards()))
+    else:
+        yield storage
+
+
+def iter_snapshot_keys(storage):
+    """Yield ``(layer, key)`` for every response that ``storage`` serves,
+    where ``layer`` is the snapshot that stored it: ``storage`` itself or,
+    for incremental snapshots, one of their base snapshots.
+    """
+    seen = set()
+    layer = storage
+    while layer is not None:
+        for key in layer.iter_keys():
+            if key not in seen:
+                seen.add(key)
+                yield layer, key
+        # Lookups fall back to the base snapshot the same way
+        layer = layer.base
+
+
+def compact_snapshots(
+    settings,
+    source_uris,
+    target_uri,
+    url_pattern=None,
+    fingerprints=None,
+    target_storage=None,
+    processes=0,
+    batch_size=64,
+):
+    """Copy the responses of the snapshots at ``source_uris`` to a new
+    snapshot at ``target_uri``.
+
+    Only the latest response to each request, by crawl time, is copied, so
+    the target doesn't keep the space of replaced records. ``url_pattern``,
+    a regular expression searched in the URLs, and ``fingerprints``, a set
+    of request fingerprints, select a subset of the responses. The target
+    uses ``target_storage``, if set, instead of the configured storage,
+    which can't be sharded. Bodies are compressed again with the configured
+    codec, in a pool of ``processes``
+    worker processes if set. Responses are streamed ``batch_size`` at a
+    time, only fingerprints and crawl times are kept for every response.
+    Returns the number of copied responses.
+    """
+    sources = []
+    try:
+        for uri in source_uris:
+            sources.append(
+                open_storage(settings, uri, "retrieve", TIME_MACHINE_LAZY_BODIES=False)
+            )
+        overrides = {}
+        if target_storage:
+            overrides["TIME_MACHINE_STORAGE"] = target_storage
+        # A self-contained snapshot, with every body in it
+        target = open_storage(
+            settings,
+            target_uri,
+            "snapshot",
+            TIME_MACHINE_ARCHIVE=False,
+            TIME_MACHINE_BASE_URI=None,
+            TIME_MACHINE_DELTA=False,
+            **overrides,
+        )
+    except Exception:
+        for source in sources:
+            source.close_spider(None)
+        raise
+    if isinstance(target, ShardedTimeMachineStorage):
+        for storage in sources + [target]:
+            storage.close_spider(None)
+        raise NotConfigured("The target of a compaction can't be sharded")
+    url_regex = re.compile(url_pattern) if url_pattern else None
+    pool = None
+    # Workers can't use the blob store nor the dictionary of the target
+    if processes > 0 and target.blob_store is None:
+        if getattr(target.codec, "dictionary", None) is None:
+            pool = ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_init_worker,
+                initargs=(target.codec.name, target.codec.level),
+            )
+    # Crawl times of the copied responses
+    written = {}
+    try:
+        storages = [s for source in sources for s in iter_storages(source)]
+        # Which storage has the latest response to each request
+        latest = _latest_storages(storages) if len(storages) > 1 else None
+        for index, storage in enumerate(storages):
+            batch = []
+            for layer, key in iter_snapshot_keys(storage):
+                if fingerprints is not None and key not in fingerprints:
+                    continue
+                if latest is not None and latest.get(key) != index:
+                    continue
+                data = storage._find_data(key)
+                if data is None:
+                    continue
+                if url_regex is not None and not url_regex.search(data["url"]):
+                    continue
+                crawled = _crawl_time(layer, key, data)
+                batch.append((key, storage._build_response(data), crawled))
+                if len(batch) >= batch_size:
+                    _write_batch(target, batch, pool, written)
+                    batch = []
+            _write_batch(target, batch, pool, written)
+        # Keep a crawl order for prefetching
+        target._start_order()
+        for key in sorted(written, key=written.get):
+            target._record_order(key)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for source in sources:
+            source.close_spider(None)
+        target.close_spider(None)
+    logger.info(f"Copied {len(written)} responses to {target_uri}")
+    return len(written)
+
+
+def _latest_storages(storages):
+    latest = {}
+    for index, storage in enumerate(storages):
+        for layer, key in iter_snapshot_keys(storage):
+            data = layer._read_data(key)
+            if data is None:
+                continue
+            crawled = _crawl_time(layer, key, data)
+            # On ties the last snapshot wins
+            if key not in latest or crawled >= latest[key][0]:
+                latest[key] = (crawled, index)
+    return {key: index for key, (_, index) in latest.items()}
+
+
+def _crawl_time(storage, key, data):
+    if "time" in data:
+        return data["time"]
+    # Written by older versions, with the time under a "<key>_time" key
+    timestamp = storage._get(f"{key}_time")
+    return float(timestamp) if timestamp else 0.0
+
+
+def _write_batch(target, batch, pool, written):
+    if pool is not None:
+        bodies = pool.map(_compress, [response.body for _, response, _ in batch])
+    else:
+        bodies = [None] * len(batch)
+    for (key, response, crawled), compressed in zip(batch, bodies):
+        record = target._encode_response(key, response, compressed=compressed)
+        record["time"] = crawled
+        target._write_data(key, record)
+        written[key] = crawled
+
+
+# Codec of the worker processes of compact_snapshots
+_codec = None
+
+
+def _init_worker(name, level):
+    global _codec
+    _codec = get_codec(name, level=level)
+
+
+def _compress(body):
+    return _codec.compress(body)
@@ -0,0 +1,45 @@
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+
+def as_deferred(result):
+    """Return ``result`` of an asynchronous storage call as a Deferred.
+
+    Storages may return Deferreds, coroutines (which need the asyncio
+    reactor when they await asyncio code) or plain values.
+    """
+    result = deferred_from_coro(result)
+    if isinstance(result, defer.Deferred):
+        return result
+    return defer.succeed(result)
+
+
+class ThreadedStorage:
+    """Asynchronous API of a synchronous storage.
+
+    ``retrieve_response`` and ``store_response`` run in a pool of at most
+    ``threads`` threads and return Deferreds, so slow lookups don't block
+    the reactor. The storage must be safe to use from several threads, as
+    the storages of this package are.
+    """
+
+    def __init__(self, storage, threads):
+        self.storage = storage
+        self.pool = ThreadPool(0, threads, name="time-machine-storage")
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        # Queued calls run before the threads stop
+        self.pool.stop()
+
+    def retrieve_response(self, spider, request):
+        return self._call(self.storage.retrieve_response, spider, request)
+
+    def store_response(self, spider, request, response):
+        return self._call(self.storage.store_response, spider, request, response)
+
+    def _call(self, func, *args):
+        return threads.deferToThreadPool(reactor, self.pool, func, *args)
@@ -0,0 +1,100 @@
+import mmap
+from tempfile import TemporaryFile
+
+from scrapy.http import TextResponse
+
+
+class CompressedBody:
+    """Compressed body of a retrieved response, inflated on demand.
+
+    Payloads larger than ``spill_size`` bytes are written to a temporary
+    file instead of being kept in memory, and memory mapped to be inflated.
+    """
+
+    def __init__(self, codec, data, spill_size=None):
+        self.codec = codec
+        self.size = len(data)
+        self.data = None
+        self.file = None
+        if spill_size is not None and self.size > spill_size:
+            self.file = TemporaryFile()
+            self.file.write(data)
+            self.file.flush()
+        else:
+            self.data = bytes(data)
+
+    def inflate(self):
+        if self.file is None:
+            return self.codec.decompress(self.data)
+        with self.file, mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return self.codec.decompress(m)
+
+
+class ExternalBody(CompressedBody):
+    """Compressed body kept in a body store, read when it is inflated."""
+
+    def __init__(self, codec, store, name):
+        self.codec = codec
+        self.store = store
+        self.name = name
+
+    def inflate(self):
+        with self.store.open(self.name) as data:
+            return self.codec.decompress(data)
+
+
+class LazyBodyMixin:
+    """Response whose body is only inflated when it is first accessed."""
+
+    _compressed_body = None
+
+    @property
+    def body(self):
+        compressed = self._compressed_body
+        if compressed is not None:
+            self._compressed_body = None
+            self._body = compressed.inflate()
+        return self._body
+
+
+class LazyTextBodyMixin(LazyBodyMixin):
+    """Text response whose encoding is only detected from the inflated body."""
+
+    def _set_url(self, url):
+        if isinstance(url, str):
+            # TextResponse would detect, and cache, the encoding of the
+            # placeholder body to decode a URL that is already a string
+            self._url = url
+        else:
+            super()._set_url(url)
+
+    @property
+    def encoding(self):
+        self.body
+        return super().encoding
+
+
+_lazy_classes = {}
+
+
+def lazy_response(respcls, compressed, **kwargs):
+    """Return a ``respcls`` response with the ``compressed`` body."""
+    lazycls = _lazy_classes.get(respcls)
+    if lazycls is None:
+        mixin = (
+            LazyTextBodyMixin if issubclass(respcls, TextResponse) else LazyBodyMixin
+        )
+        lazycls = _lazy_classes[respcls] = type(
+            f"Lazy{respcls.__name__}", (mixin, respcls), {"_response_class": respcls}
+        )
+    response = lazycls(body=b"", **kwargs)
+    response._compressed_body = compressed
+    return response
+
+
+def response_class(response):
+    """Return the class of ``response``, without its lazy body mixin.
+
+    Lazy classes are built at runtime and can't be pickled.
+    """
+    return getattr(response, "_response_class", type(response))
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class Prefetcher:
+    """Load records ahead of the requests that need them.
+
+    ``order`` lists the keys in the order they were stored by the snapshot,
+    which is close to the order a replay asks for them. Every ``get``
+    schedules the ``size`` keys that follow the requested one to be loaded
+    with ``load(key)`` on background threads. At most ``size`` loaded
+    records are kept, the oldest scheduled one is dropped to make room.
+    ``get`` can be called from several threads.
+    """
+
+    def __init__(self, load, order, size, workers=1):
+        self.load = load
+        self.order = order
+        self.positions = {}
+        for position, key in enumerate(order):
+            self.positions.setdefault(key, position)
+        self.size = size
+        self.pending = OrderedDict()
+        self.next = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="time-machine-prefetch"
+        )
+        self._schedule(0)
+
+    def get(self, key):
+        with self._lock:
+            future = self.pending.pop(key, None)
+            position = self.positions.get(key)
+            if position is not None:
+                self._schedule(position + 1)
+            if future is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if future is None:
+            return self.load(key)
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+    def _schedule(self, start):
+        stop = min(start + self.size, len(self.order))
+        # Keys before self.next were already scheduled once
+        for position in range(max(start, self.next), stop):
+            key = self.order[position]
+            if key in self.pending:
+                continue
+            if len(self.pending) >= self.size:
+                _, future = self.pending.popitem(last=False)
+                future.cancel()
+                self.evictions += 1
+            self.pending[key] = self.executor.submit(self.load, key)
+        self.next = max(self.next, stop)
@@ -0,0 +1,80 @@
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds of the latency histogram buckets
+BUCKETS = (
+    (1e-5, "10us"),
+    (1e-4, "100us"),
+    (1e-3, "1ms"),
+    (1e-2, "10ms"),
+    (1e-1, "100ms"),
+    (1.0, "1s"),
+    (10.0, "10s"),
+)
+
+
+class Profiler:
+    """Record how long storage operations take in the crawl stats.
+
+    Every operation gets a ``time_machine/profile/<phase>`` latency
+    histogram with a count, the total and max seconds and one counter per
+    bucket. Storages are profiled by wrapping the methods to measure, so
+    nothing is measured, nor paid for, unless profiling is enabled.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._lock = Lock()
+
+    def record(self, phase, seconds):
+        for limit, label in BUCKETS:
+            if seconds <= limit:
+                bucket = f"le_{label}"
+                break
+        else:
+            bucket = f"gt_{label}"
+        prefix = f"time_machine/profile/{phase}"
+        with self._lock:
+            self.stats.inc_value(f"{prefix}/count")
+            self.stats.inc_value(f"{prefix}/seconds", seconds, start=0.0)
+            self.stats.max_value(f"{prefix}/max_seconds", seconds)
+            self.stats.inc_value(f"{prefix}/{bucket}")
+
+    def wrap(self, phase, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(phase, perf_counter() - start)
+
+        return timed
+
+    def wrap_codec(self, codec):
+        """Time ``codec`` and count the bytes it compresses."""
+        compress = self.wrap("compress", codec.compress)
+        decompress = self.wrap("decompress", codec.decompress)
+
+        def counted_compress(data):
+            compressed = compress(data)
+            with self._lock:
+                raw = self.stats.get_value("time_machine/bytes/raw", 0) + len(data)
+                size = self.stats.get_value("time_machine/bytes/compressed", 0)
+                size += len(compressed)
+                self.stats.set_value("time_machine/bytes/raw", raw)
+                self.stats.set_value("time_machine/bytes/compressed", size)
+                if size:
+                    self.stats.set_value("time_machine/compression_ratio", raw / size)
+            return compressed
+
+        def counted_decompress(data):
+            body = decompress(data)
+            with self._lock:
+                self.stats.inc_value("time_machine/bytes/decompressed", len(body))
+            return body
+
+        codec.compress = counted_compress
+        codec.decompress = counted_decompress
+        return codec
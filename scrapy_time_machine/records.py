@@ -0,0 +1,254 @@
+"""Binary format of the stored responses.
+
+A record is a fixed header followed by length-prefixed fields, all little
+endian, and the body, which takes the rest of the record::
+
+    magic "TMR", format version, flags, status, time
+    url                  uint32 length + UTF-8
+    codec or body_ref    uint8 length + ASCII, empty with FLAG_BASE_BODY
+    external body name   uint8 length + ASCII, with FLAG_EXTERNAL_BODY
+    delta chain depth    uint8, with FLAG_DELTA
+    headers              uint16 count, then for each header:
+                         uint16 length + name, uint16 value count,
+                         uint32 length + value for each value
+    body
+
+With FLAG_HEADER_TABLE, every header starts with a uint16 reference: one
+plus the index of the header in the ``HeaderTable`` of the snapshot, or 0
+when the header follows inline.
+
+Decoding a record never runs code from the snapshot, unlike pickle, and
+the body of a record read from a memoryview is returned without a copy.
+"""
+import struct
+from threading import Lock
+
+MAGIC = b"TMR"
+# Version 2 added FLAG_EXTERNAL_BODY, version 3 FLAG_BASE_BODY and FLAG_DELTA,
+# version 4 FLAG_HEADER_TABLE
+VERSION = 4
+
+# Set when the body is kept in the blob store, the body field is then empty
+FLAG_BODY_REF = 1
+# Set when the compressed body is stored apart from the snapshot records
+FLAG_EXTERNAL_BODY = 2
+# Set when the body is the one of the same request in the base snapshot
+FLAG_BASE_BODY = 4
+# Set when the body is a delta against the body in the base snapshot
+FLAG_DELTA = 8
+# Set when headers may refer to the header table of the snapshot
+FLAG_HEADER_TABLE = 16
+
+# References are uint16, 0 is for inline headers
+MAX_HEADER_TABLE_SIZE = 0xFFFF
+
+_header = struct.Struct("<3sBBHd")
+_u8 = struct.Struct("<B")
+_u16 = struct.Struct("<H")
+_u32 = struct.Struct("<I")
+
+
+def is_record(value):
+    return bytes(value[: len(MAGIC)]) == MAGIC
+
+
+def encode_record(data, table=None):
+    """Return ``data``, a dict as built by the storages, as a record.
+
+    Headers already in ``table``, a ``HeaderTable``, are stored as references.
+    """
+    flags = FLAG_HEADER_TABLE if table is not None else 0
+    if "body_ref" in data:
+        flags |= FLAG_BODY_REF
+        name = data["body_ref"].encode()
+    elif data.get("base_body"):
+        flags |= FLAG_BASE_BODY
+        name = b""
+    else:
+        name = data["codec"].encode()
+    url = data["url"].encode()
+    fields = [_u32.pack(len(url)), url, _u8.pack(len(name)), name]
+    if "external" in data:
+        flags |= FLAG_EXTERNAL_BODY
+        external = data["external"].encode()
+        fields += [_u8.pack(len(external)), external]
+    if "delta" in data:
+        flags |= FLAG_DELTA
+        fields.append(_u8.pack(data["delta"]))
+    return b"".join(
+        [
+            _header.pack(MAGIC, VERSION, flags, data["status"], data["time"]),
+            *fields,
+            encode_headers(data["headers"], table),
+            data.get("body", b""),
+        ]
+    )
+
+
+def decode_record(record, table=None):
+    magic, version, flags, status, time = _header.unpack_from(record)
+    if magic != MAGIC:
+        raise ValueError("Not a Time Machine record")
+    if version > VERSION:
+        raise ValueError(f"Unsupported Time Machine record version {version}")
+    pos = _header.size
+    (length,) = _u32.unpack_from(record, pos)
+    pos += _u32.size
+    url = str(record[pos : pos + length], "utf-8")
+    pos += length
+    (length,) = _u8.unpack_from(record, pos)
+    pos += _u8.size
+    name = str(record[pos : pos + length], "ascii")
+    pos += length
+    data = {"status": status, "url": url, "time": time}
+    if flags & FLAG_EXTERNAL_BODY:
+        (length,) = _u8.unpack_from(record, pos)
+        pos += _u8.size
+        data["external"] = str(record[pos : pos + length], "ascii")
+        pos += length
+    if flags & FLAG_DELTA:
+        (data["delta"],) = _u8.unpack_from(record, pos)
+        pos += _u8.size
+    if flags & FLAG_HEADER_TABLE:
+        if table is None:
+            raise ValueError("Record headers need the header table")
+    else:
+        table = None
+    data["headers"], pos = _decode_headers(record, pos, table)
+    if flags & FLAG_BODY_REF:
+        data["body_ref"] = name
+    elif flags & FLAG_BASE_BODY:
+        data["base_body"] = True
+    else:
+        data["codec"] = name
+        if not flags & FLAG_EXTERNAL_BODY:
+            data["body"] = record[pos:]
+    return data
+
+
+def encode_headers(headers, table=None):
+    parts = [_u16.pack(len(headers))]
+    for name, values in headers.items():
+        if table is not None:
+            index = table.ref(name, values)
+            if index is not None:
+                parts.append(_u16.pack(index + 1))
+                continue
+            parts.append(_u16.pack(0))
+        parts.append(encode_header(name, values))
+    return b"".join(parts)
+
+
+def decode_headers(value, table=None):
+    return _decode_headers(value, 0, table)[0]
+
+
+def _decode_headers(buf, pos, table):
+    headers = {}
+    (count,) = _u16.unpack_from(buf, pos)
+    pos += _u16.size
+    for _ in range(count):
+        if table is not None:
+            (ref,) = _u16.unpack_from(buf, pos)
+            pos += _u16.size
+            if ref:
+                header = table.get(ref - 1)
+                if header is None:
+                    raise ValueError(f"Header {ref - 1} missing from the table")
+                name, values = header
+                headers[name] = list(values)
+                continue
+        name, values, pos = _decode_header(buf, pos)
+        headers[name] = values
+    return headers, pos
+
+
+def encode_header(name, values):
+    parts = [_u16.pack(len(name)), name, _u16.pack(len(values))]
+    for value in values:
+        parts += [_u32.pack(len(value)), value]
+    return b"".join(parts)
+
+
+def decode_header(value):
+    name, values, _ = _decode_header(value, 0)
+    return name, tuple(values)
+
+
+def _decode_header(buf, pos):
+    (length,) = _u16.unpack_from(buf, pos)
+    pos += _u16.size
+    name = bytes(buf[pos : pos + length])
+    pos += length
+    (value_count,) = _u16.unpack_from(buf, pos)
+    pos += _u16.size
+    values = []
+    for _ in range(value_count):
+        (length,) = _u32.unpack_from(buf, pos)
+        pos += _u32.size
+        values.append(bytes(buf[pos : pos + length]))
+        pos += length
+    return name, values, pos
+
+
+class HeaderTable:
+    """Headers shared by the records of a snapshot.
+
+    Records refer to the ``(name, values)`` pairs of the table by index
+    instead of repeating them. A header is only added the second time it is
+    seen, so those that change with every response, like dates, stay inline.
+    ``save(index, header)`` is called to persist a header before any record
+    refers to it, ``load(index)`` to read back a header, or None.
+    """
+
+    def __init__(self, max_size, save=None, load=None):
+        if not 0 <= max_size <= MAX_HEADER_TABLE_SIZE:
+            raise ValueError(f"Header tables hold at most {MAX_HEADER_TABLE_SIZE}")
+        self.max_size = max_size
+        self.headers = {}
+        self._index = {}
+        # Headers seen once, not in the table yet
+        self._seen = set()
+        self._save = save
+        self._load = load
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.headers)
+
+    def load_all(self):
+        """Read the persisted headers, to add more after them."""
+        while self.get(len(self.headers)) is not None:
+            pass
+
+    def get(self, index):
+        header = self.headers.get(index)
+        if header is None and self._load is not None:
+            header = self._load(index)
+            if header is not None:
+                with self._lock:
+                    self._add(index, header)
+        return header
+
+    def ref(self, name, values):
+        """Return the index of the header, or None to store it inline."""
+        header = (name, tuple(values))
+        with self._lock:
+            index = self._index.get(header)
+            if index is not None or len(self.headers) >= self.max_size:
+                return index
+            if header not in self._seen:
+                if len(self._seen) >= self.max_size:
+                    self._seen.clear()
+                self._seen.add(header)
+                return None
+            self._seen.discard(header)
+            index = len(self.headers)
+            if self._save is not None:
+                self._save(index, header)
+            self._add(index, header)
+            return index
+
+    def _add(self, index, header):
+        self.headers[index] = header
+        self._index[header] = index
@@ -0,0 +1,184 @@
+import asyncio
+import inspect
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
+from scrapy.crawler import Crawler
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.request import request_from_dict
+from twisted.internet import defer
+
+from scrapy_time_machine.lazy import response_class
+
+
+class ReplayError(Exception):
+    """A spider callback failed in a replay worker process."""
+
+
+class ReplayDownloader:
+    """Downloader that never touches the network.
+
+    Requests go through the downloader middlewares, where
+    ``TimeMachineMiddleware`` answers them from the snapshot, but skip the
+    download slots, so there are no delays nor per-domain concurrency
+    limits. With ``TIME_MACHINE_REPLAY_PROCESSES`` set, spider callbacks run
+    in a pool of worker processes while everything else (scheduling, spider
+    middlewares, item pipelines, feed exports) stays in the crawl process.
+    """
+
+    def __init__(self, crawler):
+        self.settings = crawler.settings
+        self.signals = crawler.signals
+        self.stats = crawler.stats
+        self.slots = {}
+        self.active = set()
+        self.total_concurrency = self.settings.getint(
+            "TIME_MACHINE_REPLAY_CONCURRENCY", 100
+        )
+        self.processes = self.settings.getint("TIME_MACHINE_REPLAY_PROCESSES", 0)
+        self.middleware = DownloaderMiddlewareManager.from_crawler(crawler)
+        self.pool = None
+        if self.processes > 0:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=_init_worker,
+                initargs=(
+                    crawler.spidercls,
+                    self.settings.copy_to_dict(),
+                    self.settings.getdict("TIME_MACHINE_REPLAY_SPIDER_ARGUMENTS"),
+                ),
+            )
+
+    def fetch(self, request, spider):
+        def _deactivate(response):
+            self.active.remove(request)
+            return response
+
+        self.active.add(request)
+        dfd = self.middleware.download(self._download, request, spider)
+        if self.pool is not None:
+            dfd.addCallback(self._use_remote_callback, request, spider)
+        return dfd.addBoth(_deactivate)
+
+    def needs_backout(self):
+        return len(self.active) >= self.total_concurrency
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def _download(self, request, spider):
+        # Only reached when no downloader middleware answered the request
+        self.stats.inc_value("time_machine/replay/not_found", spider=spider)
+        raise IgnoreRequest(f"{request} is not in the Time Machine snapshot")
+
+    def _use_remote_callback(self, response, request, spider):
+        if isinstance(response, Request):
+            return response  # redirects and retries go back to the scheduler
+        remote = _RemoteCallback(self, request, spider)
+        response.request = request.replace(callback=remote, cb_kwargs={})
+        return response
+
+    def _call_remote(self, request, response, spider):
+        dfd = defer.Deferred()
+        request_dict = request.to_dict(spider=spider)
+        # The middleware keeps the retrieved response in meta, it's sent apart
+        request_dict["meta"] = {
+            key: value
+            for key, value in request.meta.items()
+            if key != "snapshotted_response"
+        }
+        future = self.pool.submit(
+            _run_callback,
+            request_dict,
+            response_class(response),
+            response.url,
+            response.status,
+            dict(response.headers),
+            response.body,
+            response.flags,
+        )
+
+        def _done(future):
+            from twisted.internet import reactor
+
+            reactor.callFromThread(self._fire, dfd, future, spider)
+
+        future.add_done_callback(_done)
+        return dfd
+
+    def _fire(self, dfd, future, spider):
+        try:
+            ok, result = future.result()
+        except Exception as e:
+            dfd.errback(e)
+            return
+        if not ok:
+            dfd.errback(ReplayError(result))
+            return
+        self.stats.inc_value("time_machine/replay/remote_callbacks", spider=spider)
+        dfd.callback(
+            [
+                request_from_dict(value, spider=spider) if is_request else value
+                for is_request, value in result
+            ]
+        )
+
+
+class _RemoteCallback:
+    def __init__(self, downloader, request, spider):
+        self.downloader = downloader
+        self.request = request
+        self.spider = spider
+
+    def __call__(self, response, **kwargs):
+        return self.downloader._call_remote(self.request, response, self.spider)
+
+
+_spider = None
+
+
+def _init_worker(spidercls, settings, spider_kwargs):
+    global _spider
+    crawler = Crawler(spidercls, Settings(settings))
+    _spider = spidercls.from_crawler(crawler, **spider_kwargs)
+
+
+def _run_callback(request, response_cls, url, status, headers, body, flags):
+    try:
+        request = request_from_dict(request, spider=_spider)
+        response = response_cls(
+            url=url,
+            status=status,
+            headers=headers,
+            body=body,
+            flags=flags,
+            request=request,
+        )
+        callback = request.callback or _spider._parse
+        output = _collect(callback(response, **request.cb_kwargs))
+        return True, [
+            (True, value.to_dict(spider=_spider))
+            if isinstance(value, Request)
+            else (False, value)
+            for value in output
+        ]
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _collect(output):
+    if inspect.isasyncgen(output):
+
+        async def collect():
+            return [value async for value in output]
+
+        return asyncio.run(collect())
+    if inspect.iscoroutine(output):
+        output = asyncio.run(output)
+    return list(arg_to_iter(output))
@@ -1,101 +1,833 @@
 import dbm
-import gzip
+import json
 import logging
+import mmap
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+from bisect import insort
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from hashlib import md5, sha256
 from os.path import basename, dirname, exists, join
 from tempfile import NamedTemporaryFile
-from time import time
+from threading import Lock, RLock
+from time import perf_counter, time
 from urllib import parse
 
 import boto3
-from scrapy.exceptions import CloseSpider
+from botocore.exceptions import ClientError
+from scrapy.exceptions import CloseSpider, NotConfigured
 from scrapy.http import Headers
 from scrapy.responsetypes import responsetypes
+from scrapy.utils.misc import load_object
 from scrapy.utils.project import data_path
 from scrapy.utils.request import request_fingerprint
 from six.moves import cPickle as pickle
 from w3lib.url import file_uri_to_path
 
+from scrapy_time_machine.blobs import (
+    DbmBlobStore,
+    FileBodyStore,
+    S3BodyStore,
+    blob_digest,
+)
+from scrapy_time_machine.cache import BlockCache, ResponseCache, SnapshotCache
+from scrapy_time_machine.compression import (
+    check_delta,
+    delta_compress,
+    delta_decompress,
+    get_codec,
+)
+from scrapy_time_machine.lazy import CompressedBody, ExternalBody, lazy_response
+from scrapy_time_machine.prefetch import Prefetcher
+from scrapy_time_machine.profiling import Profiler
+from scrapy_time_machine.records import (
+    MAX_HEADER_TABLE_SIZE,
+    HeaderTable,
+    decode_header,
+    decode_headers,
+    decode_record,
+    encode_header,
+    encode_headers,
+    encode_record,
+    is_record,
+)
+from scrapy_time_machine.writers import S3MultipartWriter, ThreadedWriter
+
 logger = logging.getLogger(__name__)
 
 
+def _local_path(uri):
+    path = file_uri_to_path(uri)
+    directory = data_path(dirname(path), createdir=True)
+    return join(directory, basename(path))
+
+
+def _open_blob_store(path, retrieve_mode):
+    if not retrieve_mode:
+        return DbmBlobStore(path)
+    if not dbm.whichdb(path):
+        raise NotConfigured(f"Blob store {path} not found")
+    return DbmBlobStore(path, "r")
+
+
+def _md5_etag(f, part_size=None):
+    """Return the S3 ETag of the content of ``f``, uploaded in parts of
+    ``part_size`` bytes or in a single part.
+    """
+    chunk_size = 1024 * 1024
+    if part_size is None:
+        digest = md5()
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+    digests = []
+    while True:
+        digest, remaining = md5(), part_size
+        while remaining:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+        if remaining == part_size:
+            break
+        digests.append(digest.digest())
+    return f"{md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def _inflated(body):
+    if isinstance(body, CompressedBody):
+        return body.inflate()
+    return body
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
 class DbmTimeMachineStorage:
     time_machine_dir = "timemachine"
+    # Storages that can't list their keys in write order record it while
+    # writing, in chunks of order_chunk_size keys
+    records_order = True
+    order_chunk_size = 10000
 
     def __init__(self, settings):
+        self.settings = settings
         self.db = None
         self.snapshot_uri = None
         self.uri = settings.get("TIME_MACHINE_URI")
         self.retrieve_mode = settings.getbool("TIME_MACHINE_RETRIEVE", False)
         self.snapshot_mode = settings.getbool("TIME_MACHINE_SNAPSHOT", False)
+        self.write_workers = settings.getint("TIME_MACHINE_WRITE_WORKERS", 0)
+        self.write_queue_size = settings.getint("TIME_MACHINE_WRITE_QUEUE_SIZE", 100)
+        self.writer = None
+        self._write_lock = RLock()
+
+        level = settings.get("TIME_MACHINE_CODEC_LEVEL")
+        self.codec = get_codec(
+            settings.get("TIME_MACHINE_CODEC", "gzip"),
+            level=int(level) if level is not None else None,
+        )
+        self.codecs = {self.codec.name: self.codec}
+        self.dict_samples = settings.getint("TIME_MACHINE_ZSTD_DICT_SAMPLES", 0)
+        self.dict_size = settings.getint("TIME_MACHINE_ZSTD_DICT_SIZE", 112640)
+        # Responses held back until the compression dictionary is trained
+        self._samples = None
+        self._dict_lock = Lock()
+
+        self.blob_store_uri = settings.get("TIME_MACHINE_BLOB_STORE_URI")
+        self.blob_store_path = None
+        self.blob_store = None
+        self.blob_codecs = {}
+
+        self.external_body_size = settings.getint("TIME_MACHINE_EXTERNAL_BODY_SIZE", 0)
+        self.body_store = None
+
+        self.archive = settings.getbool("TIME_MACHINE_ARCHIVE", False)
+        self.as_of = _parse_time(settings.get("TIME_MACHINE_AS_OF"))
+
+        self.prefetch = settings.getint("TIME_MACHINE_PREFETCH", 0)
+        self.prefetch_workers = settings.getint("TIME_MACHINE_PREFETCH_WORKERS", 1)
+        self.prefetcher = None
+        # Keys stored since the last chunk of the crawl order was written
+        self._order = None
+        self._order_chunks = 0
+        self._read_lock = Lock()
+
+        self.base_uri = settings.get("TIME_MACHINE_BASE_URI")
+        self.ttl = settings.getfloat("TIME_MACHINE_TTL", 24 * 60 * 60)
+        self.ttl_patterns = [
+            (re.compile(pattern), float(ttl))
+            for pattern, ttl in settings.getdict("TIME_MACHINE_TTL_PATTERNS").items()
+        ]
+        self.revalidate = settings.getbool("TIME_MACHINE_REVALIDATE", True)
+        self.delta = settings.getbool("TIME_MACHINE_DELTA", False)
+        self.delta_chain = settings.getint("TIME_MACHINE_DELTA_CHAIN", 10)
+        if self.delta:
+            check_delta()
+            if not 0 <= self.delta_chain < 256:
+                raise NotConfigured("TIME_MACHINE_DELTA_CHAIN must be below 256")
+        # Snapshot that responses missing from this one are looked up in
+        self.base = None
+        self._uri_params = {}
+
+        self.header_table_size = settings.getint("TIME_MACHINE_HEADER_TABLE_SIZE", 4096)
+        if not 0 <= self.header_table_size <= MAX_HEADER_TABLE_SIZE:
+            raise NotConfigured(
+                f"TIME_MACHINE_HEADER_TABLE_SIZE must be at most {MAX_HEADER_TABLE_SIZE}"
+            )
+        self.header_table = None
+        # Pickled records of older versions run code from the snapshot
+        self.legacy_records = settings.getbool("TIME_MACHINE_LEGACY_RECORDS", False)
+
+        self.lazy_bodies = settings.getbool("TIME_MACHINE_LAZY_BODIES", False)
+        self.spill_size = settings.getint("TIME_MACHINE_SPILL_SIZE", 1024 * 1024)
+
+        self.response_cache_size = settings.getint(
+            "TIME_MACHINE_RESPONSE_CACHE_SIZE", 0
+        )
+        self.response_cache = None
+
+        self.profile = settings.getbool("TIME_MACHINE_PROFILE", False)
+        self.profiler = None
+
+        # Set by the middleware
+        self.stats = None
+        self._stats_lock = Lock()
 
     def set_uri(self, uri_params):
-        self.snapshot_uri = file_uri_to_path(self.uri % uri_params)
-        path = dirname(self.snapshot_uri)
-        path = data_path(path, createdir=True)
-        db_name = basename(self.snapshot_uri)
-        self.snapshot_uri = join(path, db_name)
+        self._uri_params = uri_params
+        self.snapshot_uri = self._resolve_uri(self.uri % uri_params)
+        if self.blob_store_uri:
+            self.blob_store_path = _local_path(self.blob_store_uri % uri_params)
+
+    def _resolve_uri(self, uri):
+        return _local_path(uri)
 
     def is_uri_valid(self):
-        return exists(self.snapshot_uri)
+        # Some dbm implementations add their own suffixes to the file name
+        return exists(self.snapshot_uri) or bool(dbm.whichdb(self.snapshot_uri))
 
     def open_spider(self, spider):
+        start = perf_counter()
+        self._prepare_profiler()
         # configure snapshot_uri
         self._prepare_time_machine()
+        if self.blob_store_path:
+            self.blob_store = _open_blob_store(self.blob_store_path, self.retrieve_mode)
+        if self.retrieve_mode or self.external_body_size > 0:
+            self.body_store = self._open_body_store()
+        self._prepare_codec()
+        self._prepare_header_table()
+        self._prepare_archive()
+        self._check_records()
+        self._prepare_base()
+        self._prepare_prefetch()
+        if self.retrieve_mode and self.response_cache_size > 0:
+            self.response_cache = ResponseCache(self.response_cache_size)
+        if self.snapshot_mode and self.write_workers > 0:
+            self.writer = ThreadedWriter(
+                self._store, maxsize=self.write_queue_size, workers=self.write_workers
+            )
+        if self.profiler is not None:
+            self.profiler.record("open", perf_counter() - start)
         logger.debug(f"Using Time machine storage with URI - {self.snapshot_uri}")
 
+    # Methods timed when profiling, by phase
+    _profiled_methods = (
+        ("store", "store_response"),
+        ("retrieve", "retrieve_response"),
+        ("fingerprint", "_request_key"),
+        ("encode", "_dump_record"),
+        ("decode", "_load_record"),
+        ("write", "_put"),
+        ("read", "_get"),
+        ("response", "_build_response"),
+    )
+
+    def _prepare_profiler(self):
+        if not self.profile or self.stats is None:
+            return
+        self.profiler = Profiler(self.stats)
+        for phase, name in self._profiled_methods:
+            setattr(self, name, self.profiler.wrap(phase, getattr(self, name)))
+        for codec in self.codecs.values():
+            self.profiler.wrap_codec(codec)
+
     def _prepare_time_machine(self):
         if not self.snapshot_uri:
             raise CloseSpider("Snapshot uri not configured.")
 
         self.db = dbm.open(self.snapshot_uri, "c")
 
+    body_store_suffix = ".bodies"
+
+    def _open_body_store(self):
+        return FileBodyStore(self.snapshot_uri + self.body_store_suffix)
+
+    def _prepare_codec(self):
+        dictionary = self._get_meta("zstd_dict")
+        if dictionary is not None:
+            # Keep using the dictionary the snapshot was written with
+            self._get_codec("zstd").set_dictionary(dictionary)
+        elif (
+            self.snapshot_mode
+            and self.codec.trainable
+            and self.dict_samples > 0
+            # Shared blobs must be readable without this snapshot's dictionary
+            and self.blob_store is None
+        ):
+            self._samples = []
+
+    def _prepare_header_table(self):
+        save = None
+        if self.snapshot_mode and self.header_table_size > 0:
+            save = self._save_header
+        self.header_table = HeaderTable(
+            self.header_table_size, save=save, load=self._load_header
+        )
+        if save is not None:
+            # New headers go after those of previous runs
+            self.header_table.load_all()
+
+    def _save_header(self, index, header):
+        self._set_meta(f"header_{index}", encode_header(*header))
+
+    def _load_header(self, index):
+        value = self._get_meta(f"header_{index}")
+        return decode_header(value) if value is not None else None
+
+    def _prepare_archive(self):
+        is_archive = self._get_meta("archive") is not None
+        if self.snapshot_mode and self.archive and not is_archive:
+            self._set_meta("archive", b"1")
+            is_archive = True
+        # Snapshots keep their format, whatever the current settings are
+        self.archive = is_archive
+        if self.as_of is not None and not self.archive:
+            logger.warning("TIME_MACHINE_AS_OF is ignored, snapshot is not an archive")
+
+    def _check_records(self):
+        if not self.retrieve_mode or self.legacy_records:
+            return
+        # Older versions pickled every record, checking one is enough
+        key = next(self.iter_keys(), None)
+        if key is None:
+            return
+        try:
+            self._read_data(key)
+        except ValueError:
+            raise NotConfigured(
+                f"{self.snapshot_uri} was written by an older version, convert it"
+                " with timemachine-convert or set TIME_MACHINE_LEGACY_RECORDS"
+            ) from None
+
+    def _prepare_base(self):
+        if self.snapshot_mode:
+            uri = self.base_uri and self.base_uri % self._uri_params
+        else:
+            # Deltas record the snapshot they were layered on
+            uri = self._get_meta("base")
+            uri = uri and bytes(uri).decode()
+        if not uri:
+            return
+        base = self._open_base(uri)
+        if base.snapshot_uri == self.snapshot_uri:
+            logger.warning("The base snapshot is the snapshot itself, ignoring it")
+            return
+        if not base.is_uri_valid():
+            logger.warning(f"Base snapshot {base.snapshot_uri} not found, ignoring it")
+            return
+        base.open_spider(None)
+        self.base = base
+        if self.snapshot_mode:
+            self._set_meta("base", base.snapshot_uri.encode())
+
+    def _open_base(self, uri):
+        settings = self.settings.copy()
+        for name, value in {
+            "TIME_MACHINE_URI": uri.replace("%", "%%"),
+            "TIME_MACHINE_RETRIEVE": True,
+            "TIME_MACHINE_SNAPSHOT": False,
+            "TIME_MACHINE_BASE_URI": None,
+            "TIME_MACHINE_PREFETCH": 0,
+            "TIME_MACHINE_PROFILE": False,
+        }.items():
+            settings.set(name, value, priority="cmdline")
+        base = type(self)(settings)
+        base.set_uri(self._uri_params)
+        return base
+
+    def _prepare_prefetch(self):
+        if self.snapshot_mode:
+            self._start_order()
+        elif self.prefetch > 0:
+            order = self._get_order()
+            if order is None:
+                logger.info("Snapshot has no recorded crawl order, not prefetching")
+                return
+            self.prefetcher = Prefetcher(
+                self._load_response,
+                order,
+                self.prefetch,
+                workers=self.prefetch_workers,
+            )
+
+    def _start_order(self):
+        self._order = [] if self.records_order else None
+        self._order_chunks = 0
+
+    def _record_order(self, key):
+        if self._order is None:
+            return
+        with self._write_lock:
+            self._order.append(key)
+            if len(self._order) >= self.order_chunk_size:
+                self._write_order_chunk()
+
+    def _write_order_chunk(self):
+        self._set_meta(f"order_{self._order_chunks}", "\n".join(self._order).encode())
+        self._order_chunks += 1
+        self._order = []
+
+    def _finish_order(self):
+        if self._order is None:
+            return
+        if self._order:
+            self._write_order_chunk()
+        # Chunks of an earlier run past this count are stale
+        self._set_meta("order_chunks", str(self._order_chunks).encode())
+        self._order = None
+
+    def _get_order(self):
+        """Return the stored keys in write order, or None if unknown."""
+        chunks = self._get_meta("order_chunks")
+        if chunks is None:
+            return None
+        order = []
+        for index in range(int(chunks)):
+            order += bytes(self._get_meta(f"order_{index}")).decode().split()
+        return order
+
+    def _get_codec(self, name):
+        codec = self.codecs.get(name)
+        if codec is None:
+            codec = self.codecs[name] = self._new_codec(name)
+        return codec
+
+    def _new_codec(self, name, level=None):
+        codec = get_codec(name, level=level)
+        if self.profiler is not None:
+            self.profiler.wrap_codec(codec)
+        return codec
+
     def close_spider(self, spider):
-        if self.db:
-            self.db.close()
+        start = perf_counter()
+        # Pending writes must land before the DB is closed or uploaded
+        if self.writer is not None:
+            self.writer.close()
+            errors, self.writer = self.writer.errors, None
+            if errors:
+                self._inc_stat("time_machine/store/errors", errors)
+                logger.error(
+                    f"Failed to write {errors} responses to {self.snapshot_uri}"
+                )
+
+        with self._dict_lock:
+            if self._samples is not None:
+                self._train_dictionary()
 
+        self._finish_order()
+        if self.body_store is not None:
+            try:
+                self.body_store.close()
+            except IOError as e:
+                logger.error(str(e))
+            self.body_store = None
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self._inc_stat("time_machine/prefetch/hits", self.prefetcher.hits)
+            self._inc_stat("time_machine/prefetch/misses", self.prefetcher.misses)
+            self._inc_stat("time_machine/prefetch/evicted", self.prefetcher.evictions)
+            self.prefetcher = None
+        if self.response_cache is not None:
+            cache = self.response_cache
+            self._inc_stat("time_machine/response_cache/hits", cache.hits)
+            self._inc_stat("time_machine/response_cache/misses", cache.misses)
+            self._inc_stat("time_machine/response_cache/evicted", cache.evictions)
+            self.response_cache = None
+
+        self._close_db()
+        if self.blob_store is not None:
+            # Stores shared by a sharded storage are closed by it
+            if self.blob_store_path:
+                self.blob_store.close()
+            self.blob_store = None
         self._finish_time_machine()
+        if self.base is not None:
+            self.base.close_spider(spider)
+            self.base = None
+        if self.profiler is not None:
+            self.profiler.record("close", perf_counter() - start)
+
+    def _close_db(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
     def _finish_time_machine(self):
         pass
 
     def retrieve_response(self, spider, request):
-        data = self._read_data(spider, request)
+        key = self._request_key(request)
+        if self.response_cache is not None:
+            response = self.response_cache.get(key)
+            if response is not None:
+                return response
+        data = self._find_data(key)
         if data is None:
             return  # not stored
+        response = self._build_response(data)
+        # Lazy bodies stay compressed until they are used
+        if self.response_cache is not None and not self.lazy_bodies:
+            self.response_cache.put(key, response)
+        return response
+
+    def retrieve_base_response(self, spider, request):
+        """Return the response to ``request`` in the base snapshot, if any,
+        and whether it is still fresh according to its TTL.
+        """
+        data = self.base._find_data(self._request_key(request))
+        if data is None:
+            return None, False
+        # Records written before the time was kept in them are always stale
+        age = time() - data.get("time", 0.0)
+        return self._build_response(data), age <= self._ttl(request.url)
+
+    def _ttl(self, url):
+        for pattern, ttl in self.ttl_patterns:
+            if pattern.search(url):
+                return ttl
+        return self.ttl
+
+    def _find_data(self, key):
+        if self.prefetcher is not None:
+            data = self.prefetcher.get(key)
+        else:
+            data = self._load_response(key)
+        if data is None and self.base is not None:
+            # Unchanged since the base snapshot
+            return self.base._find_data(key)
+        return data
+
+    def _build_response(self, data):
         url = data["url"]
         status = data["status"]
         headers = Headers(data["headers"])
-        body = gzip.decompress(data["body"])
         respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+        body = data["body"]
+        if isinstance(body, CompressedBody):
+            return lazy_response(respcls, body, url=url, headers=headers, status=status)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def _load_response(self, key):
+        # Called from prefetch threads too
+        data = self._read_data(key)
+        if data is None:
+            return None
+        if data.pop("base_body", False):
+            base = self.base and self.base._find_data(key)
+            if base is None:
+                logger.warning(f"Body of {data['url']} missing from the base snapshot")
+                return None
+            data["body"] = base["body"]
+            if "delta" in base:
+                data["delta"] = base["delta"]
+            return data
+        if "delta" in data:
+            base = self.base and self.base._find_data(key)
+            if base is None:
+                logger.warning(f"Delta reference of {data['url']} missing")
+                return None
+            data["body"] = delta_decompress(_inflated(base["body"]), data["body"])
+            return data
+        if "body_ref" in data:
+            codec, body = self._read_blob(data.pop("body_ref"))
+        elif "external" in data:
+            codec = self._get_codec(data["codec"])
+            body = ExternalBody(codec, self.body_store, data.pop("external"))
+            data["body"] = body if self.lazy_bodies else body.inflate()
+            return data
+        else:
+            # Snapshots written before codecs were configurable are gzipped
+            codec = self._get_codec(data.get("codec", "gzip"))
+            body = data["body"]
+        if self.lazy_bodies:
+            data["body"] = CompressedBody(codec, body, self.spill_size)
+        else:
+            data["body"] = codec.decompress(body)
+        return data
 
     def store_response(self, spider, request, response):
         key = self._request_key(request)
+        self._record_order(key)
+        if self.writer is not None:
+            self.writer.put(key, response)
+        else:
+            self._store(key, response)
+
+    def _store(self, key, response):
+        if self._samples is not None:
+            with self._dict_lock:
+                if self._samples is not None:
+                    self._samples.append((key, response))
+                    if len(self._samples) >= self.dict_samples:
+                        self._train_dictionary()
+                    return
+
+        self._write_response(key, response)
+
+    def _write_response(self, key, response):
+        if self.archive:
+            self._write_version(key, response)
+        else:
+            self._write_data(key, self._encode_response(key, response))
+
+    def _encode_response(self, key, response, compressed=None):
         data = {
             "status": response.status,
             "url": response.url,
             "headers": dict(response.headers),
-            "body": gzip.compress(response.body),
         }
-        data = pickle.dumps(data, protocol=2)
-        self.db["%s_data" % key] = data
-        self.db["%s_time" % key] = str(time())
+        if "revalidated" in response.flags and self.base is not None:
+            # Unchanged since the base snapshot, which keeps the body
+            data["base_body"] = True
+        elif self.blob_store is not None:
+            data["body_ref"] = self._store_blob(response.body)
+        elif not (self.delta and self._encode_delta(key, response, data)):
+            body = compressed
+            if body is None:
+                body = self.codec.compress(response.body)
+            data["codec"] = self.codec.name
+            if self.body_store is not None and len(response.body) > (
+                self.external_body_size
+            ):
+                data["external"] = self._store_external(body)
+            else:
+                data["body"] = body
+        return data
 
-    def _read_data(self, spider, request):
-        key = self._request_key(request)
-        db = self.db
-        tkey = f"{key}_time"
-        if tkey not in db:
+    def _encode_delta(self, key, response, data):
+        """Store the body in ``data`` as a delta against the same response
+        in the base snapshot. Return whether it was possible.
+        """
+        base = self.base and self.base._find_data(key)
+        if base is None:
+            return False
+        depth = base.get("delta", 0)
+        if depth >= self.delta_chain:
+            # A keyframe ends the chain, bounding the work to decode bodies
+            self._inc_stat("time_machine/delta/keyframes")
+            return False
+        data["body"] = delta_compress(_inflated(base["body"]), response.body)
+        data["codec"] = "zstd"
+        data["delta"] = depth + 1
+        with self._stats_lock:
+            if self.stats is not None:
+                self.stats.inc_value("time_machine/delta/bodies")
+                raw = self.stats.get_value("time_machine/delta/raw_bytes", 0)
+                size = self.stats.get_value("time_machine/delta/bytes", 0)
+                raw, size = raw + len(response.body), size + len(data["body"])
+                self.stats.set_value("time_machine/delta/raw_bytes", raw)
+                self.stats.set_value("time_machine/delta/bytes", size)
+                self.stats.set_value("time_machine/delta/ratio", raw / size)
+        return True
+
+    def _store_external(self, body):
+        name = blob_digest(body)
+        self.body_store.put(name, body)
+        self._inc_stat("time_machine/external/bodies")
+        self._inc_stat("time_machine/external/bytes", len(body))
+        return name
+
+    def _store_blob(self, body):
+        digest = blob_digest(body)
+        if digest in self.blob_store:
+            self._inc_stat("time_machine/dedup/hits")
+            self._inc_stat("time_machine/dedup/bytes_saved", len(body))
+        else:
+            self._inc_stat("time_machine/dedup/misses")
+            codec = self._get_blob_codec(self.codec.name)
+            self.blob_store.put(digest, codec.name, codec.compress(body))
+        return digest
+
+    def _read_blob(self, digest):
+        blob = self.blob_store.get(digest) if self.blob_store is not None else None
+        if blob is None:
+            raise KeyError(f"Body {digest} not found in the blob store")
+        codec_name, data = blob
+        return self._get_blob_codec(codec_name), data
+
+    def _get_blob_codec(self, name):
+        # Blobs never use a trained dictionary, it belongs to a single snapshot
+        codec = self.blob_codecs.get(name)
+        if codec is None:
+            level = self.codec.level if name == self.codec.name else None
+            codec = self.blob_codecs[name] = self._new_codec(name, level=level)
+        return codec
+
+    def _inc_stat(self, key, count=1):
+        if self.stats is not None:
+            with self._stats_lock:
+                self.stats.inc_value(key, count)
+
+    def _train_dictionary(self):
+        samples, self._samples = self._samples, None
+        if samples:
+            try:
+                dictionary = self.codec.train(
+                    [response.body for _, response in samples], self.dict_size
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Could not train a {self.codec.name} dictionary, "
+                    f"storing responses without it: {e}"
+                )
+            else:
+                self.codec.set_dictionary(dictionary)
+                self._set_meta("zstd_dict", dictionary)
+
+        for key, response in samples:
+            self._write_response(key, response)
+
+    def _write_data(self, key, data):
+        data.setdefault("time", time())
+        value = self._dump_record(data)
+        with self._write_lock:
+            self._put(f"{key}_data", value)
+
+    def _read_data(self, key):
+        if self.archive:
+            return self._read_version(key)
+        return self._read_record(key)
+
+    def _read_record(self, key):
+        value = self._get(f"{key}_data")
+        if value is None:
             return  # not found
+        return self._load_record(value)
+
+    # Archives keep every distinct version of a response, and a sorted
+    # list of (time, version id) entries for each fingerprint
+    _version_entry = struct.Struct("<d16s")
+    _volatile_headers = (b"Date", b"Age", b"Expires")
+
+    def _write_version(self, key, response):
+        version = self._version_id(response)
+        with self._write_lock:
+            known = any(v == version for _, v in self._get_versions(key))
+        if known:
+            self._inc_stat("time_machine/archive/unchanged")
+            value = None
+        else:
+            data = self._encode_response(key, response)
+            data["time"] = time()
+            value = self._dump_record(data)
 
-        return pickle.loads(db[f"{key}_data"])
+        with self._write_lock:
+            if value is not None:
+                self._put(f"{key}_{version.hex()}", value)
+            versions = self._get_versions(key)
+            insort(versions, (time(), version))
+            entry = self._version_entry
+            self._put(f"{key}_versions", b"".join(entry.pack(*v) for v in versions))
+
+    def _read_version(self, key):
+        versions = self._get_versions(key)
+        if self.as_of is not None:
+            versions = [v for v in versions if v[0] <= self.as_of]
+        if not versions:
+            return  # not found
+
+        _, version = versions[-1]
+        return self._load_record(self._get(f"{key}_{version.hex()}"))
+
+    def _get_versions(self, key):
+        value = self._get(f"{key}_versions")
+        if value is None:
+            return []
+        return list(self._version_entry.iter_unpack(value))
+
+    def _version_id(self, response):
+        digest = sha256(b"%d %s\n" % (response.status, response.url.encode()))
+        for name, values in sorted(response.headers.items()):
+            if name not in self._volatile_headers:
+                digest.update(name + b": " + b", ".join(values) + b"\n")
+        digest.update(b"\n" + response.body)
+        return digest.digest()[:16]
+
+    def _dump_record(self, data):
+        return encode_record(data, self._writable_header_table())
+
+    def _writable_header_table(self):
+        if self.header_table_size > 0:
+            return self.header_table
+        return None
+
+    def _load_record(self, value):
+        if self.legacy_records and not is_record(value):
+            # Written by older versions, with the time under a "<key>_time" key
+            return pickle.loads(value)
+        return decode_record(value, self.header_table)
+
+    def _get(self, key):
+        # Only the dbm handle needs reads to take turns
+        with self._read_lock:
+            return self.db.get(key)
+
+    def _put(self, key, value):
+        self.db[key] = value
+
+    def _iter_items(self):
+        """Yield every stored ``(key, value)``, records and metadata alike."""
+        for key in self.db.keys():
+            yield key.decode(), self.db[key]
+
+    def iter_keys(self):
+        """Yield the fingerprint of every stored response."""
+        suffix = "_versions" if self.archive else "_data"
+        for key in self.db.keys():
+            key = key.decode()
+            if key.endswith(suffix) and not key.startswith("__"):
+                yield key[: -len(suffix)]
+
+    def _get_meta(self, name):
+        return self._get(f"__{name}__")
+
+    def _set_meta(self, name, value):
+        with self._write_lock:
+            self._put(f"__{name}__", value)
 
     def _request_key(self, request):
         return request_fingerprint(request)
 
 
-class S3TimeMachineStorage(DbmTimeMachineStorage):
+class S3StorageMixin:
     def __init__(self, settings):
         super().__init__(settings)
         self.s3_client = boto3.client(
@@ -103,6 +835,8 @@ class S3TimeMachineStorage(DbmTimeMachineStorage):
             aws_access_key_id=settings.get("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=settings.get("AWS_SECRET_ACCESS_KEY"),
         )
+        self.upload_workers = settings.getint("TIME_MACHINE_S3_UPLOAD_WORKERS", 2)
+        self.upload_queue_size = settings.getint("TIME_MACHINE_S3_UPLOAD_QUEUE_SIZE", 2)
 
     def get_netloc_and_path(self, s3_uri):
         scheme, netloc, path, _, _, _ = parse.urlparse(s3_uri)
@@ -120,10 +854,68 @@ class S3TimeMachineStorage(DbmTimeMachineStorage):
         except Exception:
             return False
 
-    def set_uri(self, uri_params):
-        self.snapshot_uri = self.uri % uri_params
+    def _resolve_uri(self, uri):
+        return uri
+
+    # S3 calls timed when profiling
+    _profiled_s3_calls = (
+        "get_object",
+        "download_fileobj",
+        "upload_file",
+        "put_object",
+        "create_multipart_upload",
+        "upload_part",
+        "complete_multipart_upload",
+    )
+
+    def _prepare_profiler(self):
+        super()._prepare_profiler()
+        if self.profiler is None:
+            return
+        for name in self._profiled_s3_calls:
+            method = getattr(self.s3_client, name)
+            setattr(self.s3_client, name, self.profiler.wrap(f"s3/{name}", method))
+
+    def _open_body_store(self):
+        uploader = None
+        if self.snapshot_mode:
+            uploader = ThreadedWriter(
+                maxsize=self.upload_queue_size, workers=self.upload_workers
+            )
+        return S3BodyStore(
+            self.s3_client,
+            *self._s3_location(self.body_store_suffix + "/"),
+            uploader=uploader,
+        )
+
+    def _s3_location(self, suffix=""):
+        s3_bucket, s3_path = self.get_netloc_and_path(self.snapshot_uri)
+        return s3_bucket, s3_path.lstrip("/") + suffix
+
+
+class S3TimeMachineStorage(S3StorageMixin, DbmTimeMachineStorage):
+    def __init__(self, settings):
+        super().__init__(settings)
+        cache_dir = settings.get("TIME_MACHINE_SNAPSHOT_CACHE_DIR")
+        self.snapshot_cache = None
+        if cache_dir:
+            self.snapshot_cache = SnapshotCache(
+                cache_dir,
+                settings.getint("TIME_MACHINE_SNAPSHOT_CACHE_SIZE", 10 * 1024**3),
+            )
+        self.download_workers = settings.getint("TIME_MACHINE_S3_DOWNLOAD_WORKERS", 8)
+        self.download_part_size = settings.getint(
+            "TIME_MACHINE_S3_DOWNLOAD_PART_SIZE", 8 * 1024 * 1024
+        )
+        self.verify = settings.getbool("TIME_MACHINE_S3_VERIFY", True)
+        self.path_to_local_file = None
 
     def _prepare_time_machine(self):
+        if self.retrieve_mode and self.snapshot_cache is not None:
+            # Cached snapshots are shared by runs, never write to them
+            self.db = dbm.open(self._cached_snapshot(), "r")
+            return
+
         # Create a local file to host the db data
         tempfile = NamedTemporaryFile(mode="wb", suffix=".db")
         if self.retrieve_mode:
@@ -131,12 +923,26 @@ class S3TimeMachineStorage(DbmTimeMachineStorage):
             s3_bucket, s3_path = self.get_netloc_and_path(self.snapshot_uri)
             self.s3_client.download_fileobj(s3_bucket, s3_path.lstrip("/"), tempfile)
             self.db = dbm.open(tempfile.name, "c")
+        elif self.archive and self._download_archive(tempfile):
+            # New versions are added to the existing archive
+            self.db = dbm.open(tempfile.name, "c")
         else:
             self.db = dbm.open(tempfile.name, "n")
 
         # Save refence to DB underlaying file
         self.path_to_local_file = tempfile
 
+    def _download_archive(self, tempfile):
+        s3_bucket, s3_path = self.get_netloc_and_path(self.snapshot_uri)
+        try:
+            self.s3_client.download_fileobj(s3_bucket, s3_path.lstrip("/"), tempfile)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            return False
+        tempfile.flush()
+        return True
+
     def _finish_time_machine(self):
         if self.snapshot_mode:
             # Flush local file content
@@ -149,4 +955,772 @@ class S3TimeMachineStorage(DbmTimeMachineStorage):
             logger.info(f"Uploaded Time Machine file to {self.snapshot_uri}")
 
         # Close and remove local db file
-        self.path_to_local_file.close()
+        if self.path_to_local_file is not None:
+            self.path_to_local_file.close()
+
+    def _cached_snapshot(self):
+        bucket, key = self._s3_location()
+        head = self.s3_client.head_object(Bucket=bucket, Key=key)
+        # A new upload of the snapshot has a new ETag
+        cache_key = sha256(f"{self.snapshot_uri}\n{head['ETag']}".encode()).hexdigest()
+        path = self.snapshot_cache.get(cache_key)
+        if path is not None:
+            self._inc_stat("time_machine/snapshot_cache/hits")
+            return path
+
+        self._inc_stat("time_machine/snapshot_cache/misses")
+        evictions = self.snapshot_cache.evictions
+        path = self.snapshot_cache.add(
+            cache_key, lambda f: self._download(bucket, key, head, f)
+        )
+        self._inc_stat("time_machine/snapshot_cache/downloaded", head["ContentLength"])
+        evicted = self.snapshot_cache.evictions - evictions
+        if evicted:
+            self._inc_stat("time_machine/snapshot_cache/evicted", evicted)
+        return path
+
+    def _download(self, bucket, key, head, f):
+        """Download the object to ``f`` with parallel ranged GETs."""
+        size = head["ContentLength"]
+        f.truncate(size)
+        f.flush()
+
+        def fetch(start):
+            end = min(start + self.download_part_size, size)
+            response = self.s3_client.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f"bytes={start}-{end - 1}",
+                # Fails if the object changes during the download
+                IfMatch=head["ETag"],
+            )
+            with open(f.name, "r+b") as part:
+                part.seek(start)
+                shutil.copyfileobj(response["Body"], part)
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as pool:
+            # Consume the results to raise the first error
+            list(pool.map(fetch, range(0, size, self.download_part_size)))
+
+        if self.verify:
+            self._verify(bucket, key, head, f)
+
+    def _verify(self, bucket, key, head, f):
+        etag = head["ETag"].strip('"')
+        _, _, parts = etag.partition("-")
+        part_size = None
+        if parts:
+            # Multipart ETags are the MD5 of the MD5s of the parts
+            first = self.s3_client.head_object(Bucket=bucket, Key=key, PartNumber=1)
+            part_size = first["ContentLength"]
+        f.seek(0)
+        if _md5_etag(f, part_size) != etag:
+            raise IOError(f"Checksum mismatch downloading {self.snapshot_uri}")
+
+
+class SegmentTimeMachineStorage(DbmTimeMachineStorage):
+    """Store responses in an append-only data file.
+
+    Every record is appended to the file at ``snapshot_uri`` and its
+    location is appended to an index file next to it. The index is loaded
+    in memory when the spider opens and, in retrieve mode, records are read
+    straight from a memory map of the data file.
+    """
+
+    index_suffix = ".idx"
+    # The index is in write order
+    records_order = False
+
+    # kind, key length, record offset, record length
+    _entry = struct.Struct("<BBQI")
+    FINGERPRINT_KEY = 0
+    NAMED_KEY = 1
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.index = {}
+        self.data_file = None
+        self.index_file = None
+        self.mmap = None
+        self.offset = 0
+        self.keep_index = True
+
+    @property
+    def index_uri(self):
+        return self.snapshot_uri + self.index_suffix
+
+    def is_uri_valid(self):
+        return exists(self.snapshot_uri) and exists(self.index_uri)
+
+    def _prepare_time_machine(self):
+        if not self.snapshot_uri:
+            raise CloseSpider("Snapshot uri not configured.")
+
+        if exists(self.index_uri):
+            with open(self.index_uri, "rb") as f:
+                self.index = self._load_index(f.read())
+
+        if self.retrieve_mode:
+            self.data_file = open(self.snapshot_uri, "rb")
+            if os.fstat(self.data_file.fileno()).st_size:
+                self.mmap = mmap.mmap(
+                    self.data_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        else:
+            self.data_file = open(self.snapshot_uri, "a+b")
+            self.index_file = open(self.index_uri, "ab")
+            self.offset = self.data_file.tell()
+
+    def _close_db(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        for f in (self.index_file, self.data_file):
+            if f is not None:
+                f.close()
+        self.data_file = self.index_file = None
+
+    def _write_data(self, key, data):
+        data.setdefault("time", time())
+        value = self._dump_record(data)
+        with self._write_lock:
+            self._put(key, value)
+
+    def _read_record(self, key):
+        record = self._get(key)
+        if record is None:
+            return  # not found
+        return self._load_record(record)
+
+    def _load_record(self, record):
+        return decode_record(record, self.header_table)
+
+    def _check_records(self):
+        pass  # segments never held pickled records
+
+    def _get(self, key):
+        location = self.index.get(key)
+        if location is None:
+            return None
+        return self._read(*location)
+
+    def _iter_items(self):
+        # Copies, views would keep the memory map from being closed
+        for key, (offset, length) in self.index.items():
+            yield key, bytes(self._read(offset, length))
+
+    def _get_order(self):
+        return list(self.iter_keys())
+
+    def iter_keys(self):
+        for key in list(self.index):
+            if self.archive:
+                if key.endswith("_versions"):
+                    yield key[: -len("_versions")]
+            elif "_" not in key:
+                # Metadata and versions have underscores, fingerprints don't
+                yield key
+
+    def _read(self, offset, length):
+        if self.mmap is not None:
+            return memoryview(self.mmap)[offset : offset + length]
+        with self._write_lock:
+            self.data_file.flush()
+        return os.pread(self.data_file.fileno(), length, offset)
+
+    def _put(self, key, value):
+        offset = self.offset
+        length = len(value)
+        self.data_file.write(value)
+        # The data is written before its index entry so an interrupted run
+        # never indexes a partial record
+        self.index_file.write(self._encode_entry(key, offset, length))
+        if self.keep_index:
+            self.index[key] = (offset, length)
+        self.offset += length
+
+    def _encode_entry(self, key, offset, length):
+        kind, raw_key = self.NAMED_KEY, key.encode()
+        if len(key) == 40:
+            try:
+                kind, raw_key = self.FINGERPRINT_KEY, bytes.fromhex(key)
+            except ValueError:
+                pass
+        return self._entry.pack(kind, len(raw_key), offset, length) + raw_key
+
+    def _load_index(self, buf):
+        index = {}
+        pos = 0
+        entry_size = self._entry.size
+        while pos + entry_size <= len(buf):
+            kind, key_len, offset, length = self._entry.unpack_from(buf, pos)
+            pos += entry_size
+            raw_key = buf[pos : pos + key_len]
+            if len(raw_key) < key_len:
+                break  # truncated by an interrupted run
+            pos += key_len
+            key = raw_key.hex() if kind == self.FINGERPRINT_KEY else raw_key.decode()
+            index[key] = (offset, length)
+        return index
+
+
+class S3SegmentTimeMachineStorage(S3StorageMixin, SegmentTimeMachineStorage):
+    """Keep a segment snapshot in S3 and read records with ranged GETs.
+
+    The data file and its index are stored as two objects, the index under
+    the snapshot key with an ``.idx`` suffix. In snapshot mode both are
+    streamed to S3 as multipart uploads while the crawl runs. In retrieve
+    mode only the index is downloaded when the spider opens, records are
+    fetched on demand in blocks kept in an in-memory LRU cache.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.block_size = settings.getint("TIME_MACHINE_S3_BLOCK_SIZE", 1024 * 1024)
+        self.cache_size = settings.getint(
+            "TIME_MACHINE_S3_CACHE_SIZE", 64 * 1024 * 1024
+        )
+        self.part_size = settings.getint("TIME_MACHINE_S3_PART_SIZE", 8 * 1024 * 1024)
+        if self.archive:
+            # Each run uploads new objects, earlier versions would be lost
+            raise NotConfigured(
+                "TIME_MACHINE_ARCHIVE is not supported by S3SegmentTimeMachineStorage"
+            )
+        self.block_cache = None
+        self.uploader = None
+
+    def _prepare_time_machine(self):
+        if self.retrieve_mode:
+            s3_bucket, s3_key = self._s3_location(self.index_suffix)
+            index = self.s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+            self.index = self._load_index(index["Body"].read())
+            self.block_cache = BlockCache(
+                self._fetch_range, self.block_size, self.cache_size
+            )
+        else:
+            # Finished parts wait in a bounded queue, which caps local disk use
+            self.uploader = ThreadedWriter(
+                maxsize=self.upload_queue_size, workers=self.upload_workers
+            )
+            self.data_file, self.index_file = [
+                S3MultipartWriter(
+                    self.s3_client,
+                    *self._s3_location(suffix),
+                    self.part_size,
+                    self.uploader,
+                )
+                for suffix in ("", self.index_suffix)
+            ]
+            # Uploaded records can't be read back, so don't keep their index
+            self.keep_index = False
+
+    def _read(self, offset, length):
+        return self.block_cache.read(offset, length)
+
+    def _fetch_range(self, start, end):
+        s3_bucket, s3_key = self._s3_location()
+        response = self.s3_client.get_object(
+            Bucket=s3_bucket, Key=s3_key, Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Body"].read()
+
+    def _close_db(self):
+        if self.uploader is None:
+            return super()._close_db()
+
+        try:
+            # The index is only completed once all the data is in place
+            self.data_file.close()
+            self.index_file.close()
+        except IOError:
+            self.index_file.abort()
+            logger.error(f"Failed to upload Time Machine file to {self.snapshot_uri}")
+        else:
+            logger.info(f"Uploaded Time Machine file to {self.snapshot_uri}")
+        finally:
+            self.data_file = self.index_file = None
+            self.uploader.close()
+            self.uploader = None
+
+
+class SqliteTimeMachineStorage(DbmTimeMachineStorage):
+    """Store responses in an SQLite database.
+
+    Responses are rows of an indexed table, so snapshots can be queried by
+    URL prefix, status or crawl time. Writes are committed in batches of
+    ``TIME_MACHINE_SQLITE_BATCH_SIZE`` rows in WAL mode, which also lets
+    other processes read the committed rows while a snapshot is written.
+    """
+
+    # Rows are in write order
+    records_order = False
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            fingerprint TEXT NOT NULL,
+            version BLOB NOT NULL,
+            url TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers BLOB NOT NULL,
+            time REAL NOT NULL,
+            codec TEXT,
+            body BLOB,
+            body_ref TEXT,
+            external TEXT,
+            base_body INTEGER,
+            delta INTEGER,
+            header_table INTEGER,
+            PRIMARY KEY (fingerprint, version)
+        );
+        CREATE INDEX IF NOT EXISTS responses_url ON responses (url);
+        CREATE INDEX IF NOT EXISTS responses_status ON responses (status);
+        CREATE INDEX IF NOT EXISTS responses_time ON responses (time);
+        CREATE TABLE IF NOT EXISTS versions (
+            fingerprint TEXT NOT NULL,
+            time REAL NOT NULL,
+            version BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS versions_fingerprint
+            ON versions (fingerprint, time);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL
+        );
+    """
+
+    # Plain snapshots keep a single version of each response
+    NO_VERSION = b""
+
+    _profiled_methods = DbmTimeMachineStorage._profiled_methods + (
+        ("write", "_put_row"),
+        ("read", "_get_row"),
+    )
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.batch_size = settings.getint("TIME_MACHINE_SQLITE_BATCH_SIZE", 1000)
+        self._uncommitted = 0
+
+    def is_uri_valid(self):
+        return exists(self.snapshot_uri)
+
+    def _prepare_time_machine(self):
+        if not self.snapshot_uri:
+            raise CloseSpider("Snapshot uri not configured.")
+
+        # Connections are shared by the writer and prefetch threads, always
+        # under one of the storage locks
+        if self.retrieve_mode:
+            uri = f"file:{parse.quote(self.snapshot_uri)}?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(self.snapshot_uri, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # A crash may lose the last transactions, but never corrupts the DB
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(self.schema)
+
+    def _close_db(self):
+        if self.db is None:
+            return
+        if not self.retrieve_mode:
+            self.db.commit()
+            # Leave a self-contained file behind
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.close()
+        self.db = None
+
+    def _write_data(self, key, data):
+        data.setdefault("time", time())
+        with self._write_lock:
+            self._put_row(key, self.NO_VERSION, data)
+            self._written()
+
+    def _read_record(self, key):
+        return self._get_row(key, self.NO_VERSION)
+
+    def _write_version(self, key, response):
+        version = self._version_id(response)
+        with self._write_lock:
+            known = self._has_row(key, version)
+        if known:
+            self._inc_stat("time_machine/archive/unchanged")
+        else:
+            data = self._encode_response(key, response)
+            data["time"] = time()
+
+        with self._write_lock:
+            if not known:
+                self._put_row(key, version, data)
+            self.db.execute(
+                "INSERT INTO versions (fingerprint, time, version) VALUES (?, ?, ?)",
+                (key, time(), version),
+            )
+            self._written()
+
+    def _read_version(self, key):
+        sql = "SELECT version FROM versions WHERE fingerprint = ?"
+        params = [key]
+        if self.as_of is not None:
+            sql += " AND time <= ?"
+            params.append(self.as_of)
+        row = self.db.execute(
+            sql + " ORDER BY time DESC, version DESC LIMIT 1", params
+        ).fetchone()
+        if row is None:
+            return  # not found
+        return self._get_row(key, row[0])
+
+    def _written(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.batch_size:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def _has_row(self, key, version):
+        row = self.db.execute(
+            "SELECT 1 FROM responses WHERE fingerprint = ? AND version = ?",
+            (key, version),
+        ).fetchone()
+        return row is not None
+
+    # Columns of the body fields, NULL when a response doesn't have them
+    _body_columns = ("codec", "body", "body_ref", "external", "base_body", "delta")
+
+    def _put_row(self, key, version, data):
+        columns = ", ".join(self._body_columns)
+        placeholders = ", ".join("?" * len(self._body_columns))
+        table = self._writable_header_table()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (fingerprint, version, url, status,"
+            f" headers, header_table, time, {columns})"
+            f" VALUES (?, ?, ?, ?, ?, ?, ?, {placeholders})",
+            (
+                key,
+                version,
+                data["url"],
+                data["status"],
+                encode_headers(data["headers"], table),
+                1 if table is not None else None,
+                data["time"],
+                *(data.get(name) for name in self._body_columns),
+            ),
+        )
+
+    def _get_row(self, key, version):
+        columns = ", ".join(self._body_columns)
+        row = self.db.execute(
+            f"SELECT url, status, headers, header_table, time, {columns}"
+            " FROM responses WHERE fingerprint = ? AND version = ?",
+            (key, version),
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, headers, header_table, time_ = row[:5]
+        table = self.header_table if header_table else None
+        data = {
+            "url": url,
+            "status": status,
+            "headers": decode_headers(headers, table),
+            "time": time_,
+        }
+        for name, value in zip(self._body_columns, row[5:]):
+            if value is not None:
+                data[name] = value
+        return data
+
+    def _check_records(self):
+        pass  # rows never held pickled records
+
+    def _read_data(self, key):
+        # The connection is shared by all the threads
+        with self._read_lock:
+            return super()._read_data(key)
+
+    def _get(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _put(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+        self._written()
+
+    def iter_keys(self):
+        table = "versions" if self.archive else "responses"
+        with self._read_lock:
+            rows = self.db.execute(f"SELECT DISTINCT fingerprint FROM {table}")
+            rows = rows.fetchall()
+        for (key,) in rows:
+            yield key
+
+    def _get_order(self):
+        table = "versions" if self.archive else "responses"
+        with self._read_lock:
+            rows = self.db.execute(
+                f"SELECT fingerprint FROM {table} GROUP BY fingerprint"
+                " ORDER BY MIN(rowid)"
+            )
+            rows = rows.fetchall()
+        return [key for (key,) in rows]
+
+    def query(self, url_prefix=None, status=None, since=None, until=None):
+        """Yield ``(fingerprint, url, status, time)`` of the stored responses.
+
+        Filters are combined and served from the table indexes: responses
+        whose URL starts with ``url_prefix``, with the given ``status``, and
+        crawled at or after ``since`` and before ``until`` (UNIX timestamps).
+        """
+        conditions, params = [], []
+        if url_prefix:
+            # A range instead of LIKE, which can't use the index
+            conditions.append("url >= ? AND url < ?")
+            params += [url_prefix, url_prefix + "\U0010ffff"]
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(until)
+        sql = "SELECT fingerprint, url, status, time FROM responses"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self._read_lock:
+            rows = self.db.execute(sql + " ORDER BY time, fingerprint", params)
+            rows = rows.fetchall()
+        yield from rows
+
+
+class ShardedTimeMachineStorage:
+    """Partition a snapshot by request fingerprint into shards.
+
+    ``snapshot_uri`` is a directory. Each writer, a Scrapy process named by
+    ``TIME_MACHINE_SHARD_WRITER`` (the host name and PID by default), writes
+    ``TIME_MACHINE_SHARDS`` snapshots of ``TIME_MACHINE_SHARD_STORAGE`` in
+    it, and a manifest listing them when it closes. Writers never share a
+    file, so several processes or machines can snapshot the same crawl. In
+    retrieve mode requests are routed to the shard of their fingerprint in
+    every manifest, most recent first, and shards are opened on first use.
+    Shards share a single response cache and blob store, other caches are
+    per shard.
+    """
+
+    default_shard_storage = "scrapy_time_machine.storages.DbmTimeMachineStorage"
+    manifest_suffix = ".manifest.json"
+
+    # Incremental snapshots need a single base snapshot
+    base = None
+    revalidate = False
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.snapshot_uri = None
+        self.uri = settings.get("TIME_MACHINE_URI")
+        self.retrieve_mode = settings.getbool("TIME_MACHINE_RETRIEVE", False)
+        self.snapshot_mode = settings.getbool("TIME_MACHINE_SNAPSHOT", False)
+        self.shards = settings.getint("TIME_MACHINE_SHARDS", 16)
+        self.shard_storage = (
+            settings.get("TIME_MACHINE_SHARD_STORAGE") or self.default_shard_storage
+        )
+        self.writer = settings.get("TIME_MACHINE_SHARD_WRITER") or (
+            f"{socket.gethostname()}-{os.getpid()}"
+        )
+        self.manifests = []
+        # Open shard storages by file name
+        self._open_shards = {}
+        self._shards_lock = Lock()
+        self._uri_params = {}
+
+        self.response_cache_size = settings.getint(
+            "TIME_MACHINE_RESPONSE_CACHE_SIZE", 0
+        )
+        self.lazy_bodies = settings.getbool("TIME_MACHINE_LAZY_BODIES", False)
+        self.response_cache = None
+        self.blob_store_uri = settings.get("TIME_MACHINE_BLOB_STORE_URI")
+        self.blob_store = None
+
+        # Set by the middleware
+        self.stats = None
+
+    def set_uri(self, uri_params):
+        self._uri_params = uri_params
+        self.snapshot_uri = self._resolve_uri(self.uri % uri_params)
+
+    def _resolve_uri(self, uri):
+        return _local_path(uri)
+
+    def is_uri_valid(self):
+        return bool(self._read_manifests())
+
+    def open_spider(self, spider):
+        if not self.snapshot_uri:
+            raise CloseSpider("Snapshot uri not configured.")
+        self._prepare_time_machine()
+        if self.blob_store_uri:
+            # A dbm file can't be opened by several shards at once
+            self.blob_store = _open_blob_store(
+                _local_path(self.blob_store_uri % self._uri_params),
+                self.retrieve_mode,
+            )
+        if self.retrieve_mode:
+            self.manifests = sorted(
+                self._read_manifests(), key=lambda m: m["time"], reverse=True
+            )
+            if self.response_cache_size > 0:
+                self.response_cache = ResponseCache(self.response_cache_size)
+        logger.debug(f"Using Time machine storage with URI - {self.snapshot_uri}")
+
+    def close_spider(self, spider):
+        with self._shards_lock:
+            shards, self._open_shards = self._open_shards, {}
+        for storage in shards.values():
+            storage.close_spider(spider)
+        if self.blob_store is not None:
+            self.blob_store.close()
+            self.blob_store = None
+        if self.response_cache is not None:
+            cache, self.response_cache = self.response_cache, None
+            if self.stats is not None:
+                self.stats.inc_value("time_machine/response_cache/hits", cache.hits)
+                self.stats.inc_value("time_machine/response_cache/misses", cache.misses)
+                self.stats.inc_value(
+                    "time_machine/response_cache/evicted", cache.evictions
+                )
+        if self.snapshot_mode and shards:
+            self._write_manifest(
+                {
+                    "writer": self.writer,
+                    "time": time(),
+                    "shards": self.shards,
+                    "storage": self.shard_storage,
+                    "files": {
+                        str(self._shard_index(name)): name for name in sorted(shards)
+                    },
+                }
+            )
+
+    def store_response(self, spider, request, response):
+        shard = self._key_shard(self._request_key(request), self.shards)
+        name = f"{self.writer}-{shard:04d}"
+        self._shard(name, self.shard_storage).store_response(spider, request, response)
+
+    def retrieve_response(self, spider, request):
+        key = self._request_key(request)
+        if self.response_cache is not None:
+            response = self.response_cache.get(key)
+            if response is not None:
+                return response
+        for manifest in self.manifests:
+            shard = self._key_shard(key, manifest["shards"])
+            name = manifest["files"].get(str(shard))
+            if name is None:
+                continue
+            storage = self._shard(name, manifest["storage"])
+            response = storage.retrieve_response(spider, request)
+            if response is not None:
+                if self.response_cache is not None and not self.lazy_bodies:
+                    self.response_cache.put(key, response)
+                return response
+        return None
+
+    def iter_shards(self):
+        """Yield the open storage of every shard in the manifests."""
+        for manifest in self.manifests:
+            for name in manifest["files"].values():
+                yield self._shard(name, manifest["storage"])
+
+    @staticmethod
+    def _key_shard(key, shards):
+        return int(key[:8], 16) % shards
+
+    @staticmethod
+    def _shard_index(name):
+        return int(name.rsplit("-", 1)[1])
+
+    def _shard(self, name, storage_path):
+        with self._shards_lock:
+            storage = self._open_shards.get(name)
+            if storage is None:
+                storage = self._open_shards[name] = self._open_shard(name, storage_path)
+            return storage
+
+    def _open_shard(self, name, storage_path):
+        settings = self.settings.copy()
+        uri = self._shard_uri(name).replace("%", "%%")
+        settings.set("TIME_MACHINE_URI", uri, priority="cmdline")
+        # The response cache and the blob store are shared by all the shards
+        settings.set("TIME_MACHINE_RESPONSE_CACHE_SIZE", 0, priority="cmdline")
+        settings.set("TIME_MACHINE_BLOB_STORE_URI", None, priority="cmdline")
+        storage = load_object(storage_path)(settings)
+        storage.stats = self.stats
+        storage.blob_store = self.blob_store
+        storage.set_uri(self._uri_params)
+        storage.open_spider(None)
+        return storage
+
+    def _prepare_time_machine(self):
+        if self.snapshot_mode:
+            os.makedirs(self.snapshot_uri, exist_ok=True)
+
+    def _shard_uri(self, name):
+        return join(self.snapshot_uri, name)
+
+    def _read_manifests(self):
+        if not os.path.isdir(self.snapshot_uri):
+            return []
+        manifests = []
+        for name in os.listdir(self.snapshot_uri):
+            if name.endswith(self.manifest_suffix):
+                with open(join(self.snapshot_uri, name)) as f:
+                    manifests.append(json.load(f))
+        return manifests
+
+    def _write_manifest(self, manifest):
+        path = join(self.snapshot_uri, self.writer + self.manifest_suffix)
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+
+    def _request_key(self, request):
+        return request_fingerprint(request)
+
+
+class S3ShardedTimeMachineStorage(S3StorageMixin, ShardedTimeMachineStorage):
+    """Shards of a snapshot as S3 objects under the ``snapshot_uri`` prefix."""
+
+    default_shard_storage = "scrapy_time_machine.storages.S3SegmentTimeMachineStorage"
+
+    def is_uri_valid(self):
+        return super().is_uri_valid() and ShardedTimeMachineStorage.is_uri_valid(self)
+
+    def _prepare_time_machine(self):
+        pass
+
+    def _shard_uri(self, name):
+        return self.snapshot_uri.rstrip("/") + "/" + name
+
+    def _s3_prefix(self):
+        bucket, path = self._s3_location()
+        return bucket, path.rstrip("/") + "/"
+
+    def _read_manifests(self):
+        bucket, prefix = self._s3_prefix()
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        manifests = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(self.manifest_suffix):
+                    body = self.s3_client.get_object(Bucket=bucket, Key=obj["Key"])
+                    manifests.append(json.load(body["Body"]))
+        return manifests
+
+    def _write_manifest(self, manifest):
+        bucket, prefix = self._s3_prefix()
+        self.s3_client.put_object(
+            Bucket=bucket,
+            Key=prefix + self.writer + self.manifest_suffix,
+            Body=json.dumps(manifest).encode(),
+        )
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, Type, TypeVar
+from typing import Optional, Type, TypeVar, Union
 
 from scrapy import signals
 from scrapy.crawler import Crawler
@@ -22,6 +22,8 @@ from twisted.internet.error import (
 )
 from twisted.web.client import ResponseFailed
 
+from scrapy_time_machine.deferred import ThreadedStorage, as_deferred
+
 TimeMachineMiddlewareTV = TypeVar(
     "TimeMachineMiddlewareTV", bound="TimeMachineMiddleware"
 )
@@ -58,8 +60,17 @@ class TimeMachineMiddleware:
             )
 
         self.stats = stats
+        self.storage.stats = stats
         self.invalid = False
 
+        # Storages with an asynchronous API return Deferreds or coroutines
+        self.async_storage = None
+        async_threads = settings.getint("TIME_MACHINE_ASYNC_THREADS", 0)
+        if getattr(self.storage, "is_async", False):
+            self.async_storage = self.storage
+        elif async_threads > 0:
+            self.async_storage = ThreadedStorage(self.storage, async_threads)
+
     @classmethod
     def from_crawler(
         cls: Type[TimeMachineMiddlewareTV], crawler: Crawler
@@ -75,20 +86,41 @@ class TimeMachineMiddleware:
 
         if self.storage.retrieve_mode and not self.storage.is_uri_valid():
             self.invalid = True
-            raise CloseSpider(f"Invalid URI {self.uri}")
+            raise CloseSpider(f"Invalid URI {self.storage.snapshot_uri}")
         self.storage.open_spider(spider)
+        if isinstance(self.async_storage, ThreadedStorage):
+            self.async_storage.start()
 
     def spider_closed(self, spider: Spider) -> None:
+        if isinstance(self.async_storage, ThreadedStorage):
+            self.async_storage.stop()
         self.storage.close_spider(spider)
 
-    def process_request(self, request: Request, spider: Spider) -> Optional[Response]:
+    def process_request(
+        self, request: Request, spider: Spider
+    ) -> Union[Optional[Response], defer.Deferred]:
         if self.invalid:
             return None
 
+        if (
+            self.storage.snapshot_mode
+            and getattr(self.storage, "base", None) is not None
+        ):
+            return self._retrieve_fresh_response(spider, request)
+
         if not self.storage.retrieve_mode:
             return None
 
-        snapshotted_response = self.storage.retrieve_response(spider, request)
+        if self.async_storage is not None:
+            dfd = as_deferred(self.async_storage.retrieve_response(spider, request))
+            return dfd.addCallback(self._retrieved_response, request)
+        return self._retrieved_response(
+            self.storage.retrieve_response(spider, request), request
+        )
+
+    def _retrieved_response(
+        self, snapshotted_response: Optional[Response], request: Request
+    ) -> Response:
         if not snapshotted_response:
             raise CloseSpider(
                 "Unknown request! Did you modify the spider request chain?"
@@ -104,17 +136,27 @@ class TimeMachineMiddleware:
 
     def process_response(
         self, request: Request, response: Response, spider: Spider
-    ) -> Response:
+    ) -> Union[Response, defer.Deferred]:
         if self.invalid:
             return response
 
         if not self.storage.snapshot_mode:
             return response
 
-        # Is a retrieve run
+        # Is a retrieve run, or a fresh response of the base snapshot
         if "snapshot" in response.flags:
             return response
 
+        stale_response = request.meta.pop("snapshot_response", None)
+        if response.status == 304 and stale_response is not None:
+            response = self._revalidated_response(spider, stale_response, response)
+
+        if self.async_storage is not None:
+            self.stats.inc_value("time_machine/store", spider=spider)
+            dfd = as_deferred(
+                self.async_storage.store_response(spider, request, response)
+            )
+            return dfd.addCallback(lambda _: response)
         self._snapshot_response(spider, response, request)
         return response
 
@@ -129,6 +171,58 @@ class TimeMachineMiddleware:
             return snapshot_response
         return None
 
+    def _retrieve_fresh_response(
+        self, spider: Spider, request: Request
+    ) -> Optional[Response]:
+        response, fresh = self.storage.retrieve_base_response(spider, request)
+        if response is None:
+            self.stats.inc_value("time_machine/incremental/new", spider=spider)
+            return None
+
+        response.flags.append("snapshot")
+        if fresh:
+            self.stats.inc_value("time_machine/incremental/fresh", spider=spider)
+            return response
+
+        self.stats.inc_value("time_machine/incremental/stale", spider=spider)
+        # Served instead if the download fails, or if it is not modified
+        request.meta["snapshot_response"] = response
+        if getattr(self.storage, "revalidate", False):
+            self._add_validators(spider, request, response)
+        return None
+
+    def _add_validators(
+        self, spider: Spider, request: Request, response: Response
+    ) -> None:
+        validators = {
+            b"If-None-Match": response.headers.get(b"ETag"),
+            b"If-Modified-Since": response.headers.get(b"Last-Modified"),
+        }
+        added = False
+        for name, value in validators.items():
+            if value is not None and name not in request.headers:
+                request.headers[name] = value
+                added = True
+        if added:
+            self.stats.inc_value("time_machine/revalidation/requests", spider=spider)
+
+    def _revalidated_response(
+        self, spider: Spider, stale_response: Response, response: Response
+    ) -> Response:
+        # Headers of the 304 response update the stored ones
+        headers = stale_response.headers.copy()
+        for name, values in response.headers.items():
+            if name != b"Content-Length":
+                headers.setlist(name, values)
+        self.stats.inc_value("time_machine/revalidation/hits", spider=spider)
+        self.stats.inc_value(
+            "time_machine/revalidation/bytes_saved",
+            len(stale_response.body),
+            spider=spider,
+        )
+        flags = [flag for flag in stale_response.flags if flag != "snapshot"]
+        return stale_response.replace(headers=headers, flags=flags + ["revalidated"])
+
     def _snapshot_response(
         self,
         spider: Spider,
@@ -0,0 +1,277 @@
+"""Convert snapshots to and from WARC files.
+
+Records are streamed one at a time in both directions, so converting an
+archive only holds one response in memory. Exported records are compressed
+as separate gzip members, as usual for ``.warc.gz`` files, so tools can
+split the file at any record and process the parts in parallel.
+
+Responses keep the fingerprint of their request in a
+``WARC-Time-Machine-Fingerprint`` header, which imports use as the key of
+the response. Archives from other tools don't have it, so their responses
+are keyed by the fingerprint of the request record written before them, if
+any, or of a GET request for their URL.
+"""
+import gzip
+import logging
+import uuid
+from base64 import b32encode
+from datetime import datetime, timezone
+from hashlib import sha1
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response
+from twisted.web.http import RESPONSES
+
+from scrapy_time_machine.convert import iter_snapshot_keys, iter_storages, open_storage
+from scrapy_time_machine.storages import ShardedTimeMachineStorage
+
+logger = logging.getLogger(__name__)
+
+WARC_VERSION = b"WARC/1.1"
+FINGERPRINT_HEADER = "WARC-Time-Machine-Fingerprint"
+
+
+def export_warc(settings, source_uri, path):
+    """Write every response of the snapshot at ``source_uri`` to the WARC
+    file at ``path``, gzipped when it ends with ``.gz``.
+
+    Archives export the latest version of each response, or the one as of
+    ``TIME_MACHINE_AS_OF``. Returns the number of exported responses.
+    """
+    source = open_storage(
+        settings, source_uri, "retrieve", TIME_MACHINE_LAZY_BODIES=False
+    )
+    exported = 0
+    try:
+        with open(path, "wb") as f:
+            writer = WarcWriter(f, compress=path.endswith(".gz"))
+            writer.write_warcinfo()
+            # Oldest writers first, importing the file keeps the latest responses
+            for storage in iter_storages(source):
+                for _, key in iter_snapshot_keys(storage):
+                    data = storage._find_data(key)
+                    if data is None:
+                        continue
+                    writer.write_response(
+                        data["url"],
+                        data["status"],
+                        data["headers"],
+                        data["body"],
+                        data.get("time", 0.0),
+                        key,
+                    )
+                    exported += 1
+    finally:
+        source.close_spider(None)
+    logger.info(f"Exported {exported} responses from {source_uri} to {path}")
+    return exported
+
+
+def import_warc(settings, paths, target_uri):
+    """Store the responses of the WARC files at ``paths`` in a new snapshot
+    at ``target_uri``, keeping their crawl time.
+
+    When a request has several responses, the last one wins. Returns the
+    number of imported responses.
+    """
+    target = open_storage(settings, target_uri, "snapshot", TIME_MACHINE_ARCHIVE=False)
+    if isinstance(target, ShardedTimeMachineStorage):
+        target.close_spider(None)
+        raise NotConfigured("WARC files can't be imported in a sharded snapshot")
+    # Keep a crawl order for prefetching
+    target._start_order()
+    imported = 0
+    try:
+        for path in paths:
+            with open_warc(path) as f:
+                for key, response, crawled in _iter_responses(target, f):
+                    record = target._encode_response(key, response)
+                    record["time"] = crawled
+                    target._write_data(key, record)
+                    target._record_order(key)
+                    imported += 1
+    finally:
+        target.close_spider(None)
+    logger.info(
+        f"Imported {imported} responses from {', '.join(paths)} to {target_uri}"
+    )
+    return imported
+
+
+def _iter_responses(storage, f):
+    request = None
+    for headers, block in iter_records(f):
+        warc_type = headers.get("warc-type")
+        if warc_type == "request":
+            request = headers, block
+            continue
+        if warc_type != "response" or "msgtype=response" not in headers.get(
+            "content-type", ""
+        ).replace(" ", ""):
+            continue
+        url = headers["warc-target-uri"]
+        status, response_headers, body = parse_http_response(block)
+        response = Response(url, status=status, headers=response_headers, body=body)
+        key = headers.get(FINGERPRINT_HEADER.lower())
+        if key is None:
+            key = storage._request_key(_request(url, headers, request))
+        yield key, response, _parse_warc_date(headers.get("warc-date"))
+
+
+def _request(url, headers, request):
+    """Return the request of a response from another tool."""
+    if request is not None:
+        request_headers, block = request
+        concurrent = headers.get("warc-concurrent-to")
+        if request_headers.get("warc-record-id") == concurrent or (
+            request_headers.get("warc-target-uri") == url
+        ):
+            head, _, body = _split_http_message(block)
+            method = head.split(b" ", 1)[0].decode("ascii")
+            return Request(url, method=method, body=body)
+    return Request(url)
+
+
+class WarcWriter:
+    """Write WARC records to the binary file ``f``."""
+
+    def __init__(self, f, compress=True):
+        self.f = f
+        self.compress = compress
+
+    def write_warcinfo(self):
+        block = b"software: scrapy-time-machine\r\nformat: WARC File Format 1.1\r\n"
+        self.write_record(
+            "warcinfo", {"Content-Type": "application/warc-fields"}, block
+        )
+
+    def write_response(self, url, status, headers, body, crawled, fingerprint):
+        reason = RESPONSES.get(status, b"")
+        head = [b"HTTP/1.1 %d %s" % (status, reason)]
+        for name, values in headers.items():
+            head += [name + b": " + value for value in values]
+        block = b"\r\n".join(head) + b"\r\n\r\n" + body
+        self.write_record(
+            "response",
+            {
+                "WARC-Target-URI": url,
+                "WARC-Date": _format_warc_date(crawled),
+                "WARC-Payload-Digest": "sha1:"
+                + b32encode(sha1(body).digest()).decode(),
+                FINGERPRINT_HEADER: fingerprint,
+                "Content-Type": "application/http;msgtype=response",
+            },
+            block,
+        )
+
+    def write_record(self, warc_type, headers, block):
+        fields = {
+            "WARC-Type": warc_type,
+            "WARC-Record-ID": f"<urn:uuid:{uuid.uuid4()}>",
+            **headers,
+            "Content-Length": str(len(block)),
+        }
+        if "WARC-Date" not in fields:
+            fields["WARC-Date"] = _format_warc_date(
+                datetime.now(timezone.utc).timestamp()
+            )
+        head = [WARC_VERSION] + [f"{k}: {v}".encode() for k, v in fields.items()]
+        record = b"\r\n".join(head) + b"\r\n\r\n" + block + b"\r\n\r\n"
+        if self.compress:
+            # A gzip member per record
+            record = gzip.compress(record, compresslevel=6)
+        self.f.write(record)
+
+
+def open_warc(path):
+    """Open the WARC file at ``path``, gzipped or not."""
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        # Reads every gzip member in turn
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_records(f):
+    """Yield ``(headers, block)`` for every record of the WARC file ``f``.
+
+    Header names are lowercased, values are strings.
+    """
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue  # the end of the previous record
+        if not line.startswith(b"WARC/"):
+            raise ValueError(f"Not a WARC record: {line[:50]!r}")
+        headers = {}
+        for line in iter(f.readline, b""):
+            line = line.rstrip(b"\r\n")
+            if not line:
+                break
+            name, _, value = line.decode("utf-8").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        block = f.read(int(headers["content-length"]))
+        yield headers, block
+
+
+def parse_http_response(block):
+    """Return the status, headers and body of an HTTP response."""
+    head, headers, body = _split_http_message(block)
+    status = int(head.split(None, 2)[1])
+    encodings = headers.get(b"Transfer-Encoding", [])
+    if any(b"chunked" in value.lower() for value in encodings):
+        # Download handlers hand the decoded body to Scrapy
+        body = _dechunk(body)
+        del headers[b"Transfer-Encoding"]
+    return status, headers, body
+
+
+def _split_http_message(block):
+    end = block.find(b"\r\n\r\n")
+    if end >= 0:
+        head, body = block[:end], block[end + 4 :]
+    else:
+        head, _, body = block.partition(b"\n\n")
+    lines = [line.rstrip(b"\r") for line in head.split(b"\n")]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        # Normalized like scrapy.http.Headers does
+        headers.setdefault(name.strip().title(), []).append(value.strip())
+    return lines[0], headers, body
+
+
+def _dechunk(body):
+    chunks = []
+    pos = 0
+    while True:
+        end = body.find(b"\r\n", pos)
+        if end < 0:
+            break
+        size = int(body[pos:end].split(b";", 1)[0], 16)
+        if size == 0:
+            break
+        chunks.append(body[end + 2 : end + 2 + size])
+        pos = end + 2 + size + 2
+    return b"".join(chunks)
+
+
+def _format_warc_date(timestamp):
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _parse_warc_date(value):
+    if not value:
+        return 0.0
+    value = value.replace("Z", "+00:00")
+    if "." not in value:
+        return datetime.fromisoformat(value).timestamp()
+    # Python < 3.11 only parses 3 or 6 digit fractions
+    seconds, _, rest = value.partition(".")
+    digits = rest[: len(rest) - len(rest.lstrip("0123456789"))]
+    zone = rest[len(digits) :]
+    return datetime.fromisoformat(f"{seconds}.{digits[:6]:0<6}{zone}").timestamp()
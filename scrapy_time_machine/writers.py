@@ -0,0 +1,151 @@
+import logging
+from queue import Queue
+from tempfile import TemporaryFile
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ThreadedWriter:
+    """Run storage writes on background threads.
+
+    Jobs are pushed into a bounded queue, so once ``maxsize`` writes are
+    pending ``put`` blocks the caller until a worker catches up.
+    """
+
+    def __init__(self, func=None, maxsize=100, workers=1):
+        self.func = func
+        self.queue = Queue(maxsize=maxsize)
+        self.errors = 0
+        self._errors_lock = Lock()
+        self.threads = [
+            Thread(target=self._run, name=f"time-machine-writer-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, *args):
+        # Without a func of its own, the first argument is the callable
+        self.queue.put(args)
+
+    def full(self):
+        return self.queue.full()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            try:
+                if args is _STOP:
+                    return
+                if self.func is None:
+                    args[0](*args[1:])
+                else:
+                    self.func(*args)
+            except Exception:
+                with self._errors_lock:
+                    self.errors += 1
+                logger.exception("Error writing response to Time Machine storage")
+            finally:
+                self.queue.task_done()
+
+
+class S3MultipartWriter:
+    """File-like object that streams its content to S3 as a multipart upload.
+
+    Data is spooled to a local temporary file and, every ``part_size``
+    bytes, the spool is handed to ``uploader`` (a :class:`ThreadedWriter`)
+    to be uploaded as the next part. ``close`` uploads the last part and
+    completes the upload, or aborts it if any part failed.
+    """
+
+    def __init__(self, client, bucket, key, part_size, uploader):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.uploader = uploader
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+        self.parts = {}
+        self.part_number = 0
+        self.spool = TemporaryFile()
+        self.closed = False
+
+    def write(self, data):
+        self.spool.write(data)
+        if self.spool.tell() >= self.part_size:
+            self._submit_spool()
+
+    def flush(self):
+        self.spool.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.spool.tell() or not self.part_number:
+            self._submit_spool()
+        self.spool.close()
+        self.uploader.flush()
+        if len(self.parts) != self.part_number:
+            self._abort()
+            raise IOError(f"Failed to upload s3://{self.bucket}/{self.key}")
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": self.parts[number]}
+                    for number in sorted(self.parts)
+                ]
+            },
+        )
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.spool.close()
+        self.uploader.flush()
+        self._abort()
+
+    def _abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+    def _submit_spool(self):
+        spool = self.spool
+        self.spool = TemporaryFile()
+        self.part_number += 1
+        self.uploader.put(self._upload_part, self.part_number, spool)
+
+    def _upload_part(self, part_number, spool):
+        try:
+            spool.seek(0)
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=spool,
+            )
+            self.parts[part_number] = response["ETag"]
+        finally:
+            spool.close()
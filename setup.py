@@ -13,7 +13,7 @@ setup(
     author="Luiz Francisco Rodrigues da Silva",
     author_email="luizfrdasilva@gmail.com",
     url="https://github.com/zytedata/scrapy-time-machine",
-    packages=["scrapy_time_machine"],
+    packages=["scrapy_time_machine", "scrapy_time_machine.commands"],
     platforms=["Any"],
     keywords="scrapy cache middleware",
     include_package_data=True,
@@ -27,5 +27,16 @@ setup(
         "Programming Language :: Python :: 3.10",
         "Programming Language :: Python :: 3.11",
     ],
-    install_requires=["Scrapy>=2.0.0", "boto3"],
+    install_requires=["Scrapy>=2.6.0", "boto3"],
+    extras_require={"zstd": ["zstandard"]},
+    entry_points={
+        "scrapy.commands": [
+            "timemachine-compact = scrapy_time_machine.commands.compact:Command",
+            "timemachine-convert = scrapy_time_machine.commands.convert:Command",
+            "timemachine-export-warc = scrapy_time_machine.commands.export_warc:Command",
+            "timemachine-import-warc = scrapy_time_machine.commands.import_warc:Command",
+            "timemachine-merge = scrapy_time_machine.commands.merge:Command",
+            "timemachine-replay = scrapy_time_machine.commands.replay:Command",
+        ],
+    },
 )
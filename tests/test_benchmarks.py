@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+def test_benchmark_output(tmp_path):
+    output = tmp_path / "results.jsonl"
+    subprocess.run(
+        [
+            sys.executable,
+            join(ROOT, "benchmarks", "bench_storages.py"),
+            "--storage=dbm",
+            "--storage=segment",
+            "--requests=20",
+            "--sizes=1KB:3,100KB:1",
+            "--shuffle",
+            f"--output={output}",
+        ],
+        check=True,
+        capture_output=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["storage"] for r in results] == ["dbm", "segment"]
+    for result in results:
+        for phase in ("store", "retrieve"):
+            assert result[phase]["ops"] == 20
+            assert set(result[phase]["latency"]) == {"p50", "p90", "p99", "max"}
+        assert result["snapshot_bytes"] > 0
+        assert result["peak_rss_bytes"] > 0
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+from scrapy.http import Response
+
+from scrapy_time_machine.cache import BlockCache, ResponseCache, SnapshotCache
+
+DATA = bytes(range(256)) * 4
+
+
+class FakeObject:
+    def __init__(self):
+        self.fetches = []
+
+    def fetch(self, start, end):
+        self.fetches.append((start, end))
+        return DATA[start:end]
+
+
+def test_read_ranges():
+    obj = FakeObject()
+    cache = BlockCache(obj.fetch, block_size=100, max_size=10000)
+    for offset, length in [(0, 10), (95, 10), (250, 300), (1000, 100), (5, 0)]:
+        assert bytes(cache.read(offset, length)) == DATA[offset : offset + length]
+
+
+def test_missing_blocks_are_coalesced():
+    obj = FakeObject()
+    cache = BlockCache(obj.fetch, block_size=100, max_size=10000)
+    cache.read(150, 10)
+    assert obj.fetches == [(100, 200)]
+    # blocks 0 and 2 are missing, block 1 is fetched again with them
+    cache.read(50, 200)
+    assert obj.fetches == [(100, 200), (0, 300)]
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.read(0, 300)
+    assert len(obj.fetches) == 2
+
+
+def test_lru_eviction():
+    obj = FakeObject()
+    cache = BlockCache(obj.fetch, block_size=100, max_size=200)
+    cache.read(0, 10)
+    cache.read(100, 10)
+    cache.read(0, 10)
+    cache.read(200, 10)
+    assert list(cache.blocks) == [0, 2]
+    assert cache.size == 200
+    # reads larger than the cache still work
+    assert bytes(cache.read(0, 500)) == DATA[:500]
+    assert cache.size <= 200
+
+
+def test_response_cache():
+    response = Response("http://a", headers={"A": "b"}, body=b"x" * 100)
+    size = ResponseCache._size(response)
+    cache = ResponseCache(max_size=2 * size)
+    assert cache.get("a") is None
+    cache.put("a", response)
+    response.flags.append("changed")
+    cached = cache.get("a")
+    assert cached is not response
+    assert (cached.body, cached.headers, cached.flags) == (
+        response.body,
+        {b"A": [b"b"]},
+        [],
+    )
+    cached.headers["A"] = "c"
+    assert cache.get("a").headers == {b"A": [b"b"]}
+    cache.put("b", response.replace(url="http://b"))
+    cache.get("a")
+    cache.put("c", response.replace(url="http://c"))
+    assert list(cache.responses) == ["a", "c"]
+    assert cache.size == 2 * size
+    assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+    # responses larger than the cache are not kept
+    cache.put("d", response.replace(body=b"x" * 1000))
+    assert "d" not in cache.responses
+
+
+def test_snapshot_cache(tmp_path):
+    cache = SnapshotCache(str(tmp_path), max_size=250)
+    assert cache.get("a") is None
+    path = cache.add("a", lambda f: f.write(b"a" * 100))
+    with open(path, "rb") as f:
+        assert f.read() == b"a" * 100
+    cache.add("b", lambda f: f.write(b"b" * 100))
+    os.utime(cache.get("b"), (0, 0))
+    assert cache.get("a") == path
+    # "b" is the least recently used
+    cache.add("c", lambda f: f.write(b"c" * 100))
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    assert cache.evictions == 1
+
+
+def test_snapshot_cache_failed_write(tmp_path):
+    cache = SnapshotCache(str(tmp_path), max_size=250)
+
+    def write(f):
+        f.write(b"partial")
+        raise IOError()
+
+    with pytest.raises(IOError):
+        cache.add("a", write)
+    assert cache.get("a") is None
+    assert os.listdir(tmp_path) == []
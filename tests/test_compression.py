@@ -0,0 +1,43 @@
+import pytest
+from scrapy.exceptions import NotConfigured
+
+from scrapy_time_machine.compression import delta_compress, delta_decompress, get_codec
+
+BODY = b"<html><body>" + b"time machine " * 100 + b"</body></html>"
+
+
+@pytest.mark.parametrize("name", ["none", "gzip", "zstd"])
+def test_roundtrip(name):
+    if name == "zstd":
+        pytest.importorskip("zstandard")
+    codec = get_codec(name, level=1)
+    assert codec.decompress(codec.compress(BODY)) == BODY
+    assert codec.decompress(memoryview(codec.compress(BODY))) == BODY
+
+
+def test_unknown_codec():
+    with pytest.raises(NotConfigured):
+        get_codec("lzma")
+
+
+def test_zstd_dictionary():
+    pytest.importorskip("zstandard")
+    samples = [b"<title>%d</title>" % i + BODY + b"%d" % (i * 7) for i in range(20)]
+    codec = get_codec("zstd")
+    dictionary = codec.train(samples, 1024)
+    codec.set_dictionary(dictionary)
+    compressed = codec.compress(samples[0])
+    assert len(compressed) < len(get_codec("zstd").compress(samples[0]))
+
+    other = get_codec("zstd")
+    other.set_dictionary(dictionary)
+    assert other.decompress(compressed) == samples[0]
+
+
+def test_delta():
+    pytest.importorskip("zstandard")
+    reference = bytes(range(256)) * 4096
+    data = reference[:1000] + b"changed" + reference[1007:]
+    delta = delta_compress(reference, data)
+    assert len(delta) < 1000
+    assert delta_decompress(memoryview(reference), delta) == data
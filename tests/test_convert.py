@@ -0,0 +1,246 @@
+import dbm
+import os
+import pickle
+
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+
+from scrapy_time_machine.convert import (
+    compact_snapshots,
+    convert_snapshot,
+    open_storage,
+)
+from scrapy_time_machine.records import is_record
+
+RESPONSE = Response(
+    "http://www.example.com",
+    headers={"Content-Type": "text/html"},
+    body=b"test body",
+    status=202,
+)
+
+
+def legacy_data(storage):
+    data = storage._encode_response(None, RESPONSE)
+    return {k: v for k, v in data.items() if k != "codec"}
+
+
+def check_converted(settings, tmp_path, source):
+    target = str(tmp_path / "converted")
+    assert convert_snapshot(settings, source, target) == 1
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        items = dict(storage._iter_items())
+        assert not any(key.endswith("_time") for key in items)
+        key = storage._request_key(Request(RESPONSE.url))
+        assert all(
+            is_record(value) for name, value in items.items() if name.startswith(key)
+        )
+        stored = storage.retrieve_response(None, Request(RESPONSE.url))
+        assert stored.body == RESPONSE.body
+        assert stored.headers == RESPONSE.headers
+        assert stored.status == RESPONSE.status
+    finally:
+        storage.close_spider(None)
+
+
+def test_convert_dbm(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "legacy")
+    storage = open_storage(settings, source, "snapshot")
+    key = storage._request_key(Request(RESPONSE.url))
+    storage.close_spider(None)
+    db = dbm.open(source, "c")
+    db[f"{key}_data"] = pickle.dumps(legacy_data(storage), protocol=2)
+    db[f"{key}_time"] = "1675000000.5"
+    db.close()
+    check_converted(settings, tmp_path, source)
+
+
+def test_sqlite_is_not_converted(tmp_path):
+    settings = Settings(
+        {
+            "TIME_MACHINE_STORAGE": "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+        }
+    )
+    with pytest.raises(NotConfigured):
+        convert_snapshot(settings, str(tmp_path / "a"), str(tmp_path / "b"))
+
+
+def test_convert_copies_external_bodies(tmp_path):
+    settings = Settings({"TIME_MACHINE_EXTERNAL_BODY_SIZE": 1})
+    source = str(tmp_path / "source")
+    storage = open_storage(settings, source, "snapshot")
+    storage.store_response(None, Request(RESPONSE.url), RESPONSE)
+    storage.close_spider(None)
+    target = str(tmp_path / "converted")
+    assert convert_snapshot(Settings(), source, target) == 0
+    assert os.listdir(target + ".bodies") == os.listdir(source + ".bodies")
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        stored = storage.retrieve_response(None, Request(RESPONSE.url))
+        assert stored.body == RESPONSE.body
+    finally:
+        storage.close_spider(None)
+
+
+def test_convert_keeps_header_table(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "source")
+    storage = open_storage(settings, source, "snapshot")
+    for url in ("http://www.example.com", "http://www.example.com/2"):
+        storage.store_response(None, Request(url), RESPONSE.replace(url=url))
+    assert len(storage.header_table) == 1
+    storage.close_spider(None)
+    target = str(tmp_path / "converted")
+    assert convert_snapshot(settings, source, target) == 0
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        for url in ("http://www.example.com", "http://www.example.com/2"):
+            stored = storage.retrieve_response(None, Request(url))
+            assert stored.headers == RESPONSE.headers
+    finally:
+        storage.close_spider(None)
+
+
+def snapshot(settings, uri, responses, crawled=None):
+    storage = open_storage(settings, uri, "snapshot")
+    for response in responses:
+        if crawled is None:
+            storage.store_response(None, Request(response.url), response)
+        else:
+            key = storage._request_key(Request(response.url))
+            data = storage._encode_response(key, response)
+            data["time"] = crawled
+            storage._write_data(key, data)
+    storage.close_spider(None)
+
+
+def retrieve_bodies(settings, uri, urls):
+    storage = open_storage(settings, uri, "retrieve")
+    try:
+        responses = [storage.retrieve_response(None, Request(url)) for url in urls]
+        return [r.body if r is not None else None for r in responses]
+    finally:
+        storage.close_spider(None)
+
+
+URLS = [f"http://www.example.com/{name}" for name in ("a", "b", "c")]
+
+
+def test_compact_drops_replaced_records(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "source")
+    # Growing records don't fit in the space of the previous ones
+    for i in range(1, 21):
+        body = os.urandom(1000 * i)
+        snapshot(settings, source, [RESPONSE.replace(body=body)])
+    target = str(tmp_path / "target")
+    assert compact_snapshots(settings, [source], target) == 1
+    assert os.path.getsize(target + ".dat") < os.path.getsize(source + ".dat") / 5
+    assert retrieve_bodies(settings, target, [RESPONSE.url]) == [body]
+
+
+def test_compact_merges_latest_responses(tmp_path):
+    settings = Settings()
+    old, new = str(tmp_path / "old"), str(tmp_path / "new")
+    snapshot(settings, new, [RESPONSE.replace(url=URLS[0], body=b"new")], 2000.0)
+    snapshot(
+        settings,
+        old,
+        [RESPONSE.replace(url=url, body=b"old") for url in URLS[:2]],
+        1000.0,
+    )
+    target = str(tmp_path / "target")
+    assert compact_snapshots(settings, [new, old], target) == 2
+    assert retrieve_bodies(settings, target, URLS) == [b"new", b"old", None]
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        keys = [storage._request_key(Request(url)) for url in URLS[:2]]
+        assert storage._get_order() == [keys[1], keys[0]]
+        assert storage._read_data(keys[0])["time"] == 2000.0
+    finally:
+        storage.close_spider(None)
+
+
+def test_compact_subset(tmp_path):
+    settings = Settings(
+        {
+            "TIME_MACHINE_STORAGE": "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+        }
+    )
+    source = str(tmp_path / "source")
+    snapshot(settings, source, [RESPONSE.replace(url=url) for url in URLS])
+    target = str(tmp_path / "by-url")
+    assert compact_snapshots(settings, [source], target, url_pattern="/[ab]$") == 2
+    assert retrieve_bodies(settings, target, URLS)[2] is None
+
+    storage = open_storage(settings, source, "retrieve")
+    fingerprint = storage._request_key(Request(URLS[2]))
+    storage.close_spider(None)
+    target = str(tmp_path / "by-fingerprint")
+    assert (
+        compact_snapshots(settings, [source], target, fingerprints={fingerprint}) == 1
+    )
+    assert retrieve_bodies(settings, target, URLS) == [None, None, RESPONSE.body]
+
+
+def test_compact_recompresses_in_processes(tmp_path):
+    pytest.importorskip("zstandard")
+    source = str(tmp_path / "source")
+    snapshot(Settings(), source, [RESPONSE.replace(url=url) for url in URLS])
+    settings = Settings({"TIME_MACHINE_CODEC": "zstd"})
+    target = str(tmp_path / "target")
+    segment = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+    copied = compact_snapshots(
+        settings, [source], target, target_storage=segment, processes=2, batch_size=2
+    )
+    assert copied == 3
+    settings = Settings({"TIME_MACHINE_STORAGE": segment})
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        for url in URLS:
+            key = storage._request_key(Request(url))
+            assert storage._read_data(key)["codec"] == "zstd"
+            assert storage.retrieve_response(None, Request(url)).body == RESPONSE.body
+    finally:
+        storage.close_spider(None)
+
+
+def test_compact_incremental_snapshot(tmp_path):
+    settings = Settings()
+    base, delta = str(tmp_path / "base"), str(tmp_path / "delta")
+    snapshot(settings, base, [RESPONSE.replace(url=url) for url in URLS[:2]])
+    # Only the new response is stored in the delta
+    snapshot(
+        Settings({"TIME_MACHINE_BASE_URI": base}),
+        delta,
+        [RESPONSE.replace(url=URLS[2], body=b"new")],
+    )
+    target = str(tmp_path / "target")
+    assert compact_snapshots(settings, [delta], target) == 3
+    assert retrieve_bodies(settings, target, URLS) == [
+        RESPONSE.body,
+        RESPONSE.body,
+        b"new",
+    ]
+
+    other = str(tmp_path / "other")
+    snapshot(settings, other, [RESPONSE.replace(url=URLS[0], body=b"other")])
+    target = str(tmp_path / "merged")
+    # The other snapshot is newer than the base of the delta
+    assert compact_snapshots(settings, [delta, other], target) == 3
+    assert retrieve_bodies(settings, target, URLS) == [b"other", RESPONSE.body, b"new"]
+
+
+def test_compact_to_sharded_snapshot(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "source")
+    snapshot(settings, source, [RESPONSE])
+    sharded = "scrapy_time_machine.storages.ShardedTimeMachineStorage"
+    with pytest.raises(NotConfigured):
+        compact_snapshots(
+            settings, [source], str(tmp_path / "target"), target_storage=sharded
+        )
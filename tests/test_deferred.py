@@ -0,0 +1,168 @@
+import shutil
+import tempfile
+import time
+from threading import Event, Lock
+
+from scrapy.exceptions import CloseSpider
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from scrapy_time_machine.deferred import ThreadedStorage, as_deferred
+from scrapy_time_machine.timemachine import TimeMachineMiddleware
+
+
+class BlockingStorage:
+    """Storage whose lookups wait until ``release`` is set."""
+
+    def __init__(self, response):
+        self.response = response
+        self.release = Event()
+        self.running = 0
+        self.max_running = 0
+        self._lock = Lock()
+
+    def retrieve_response(self, spider, request):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.release.wait(5)
+        with self._lock:
+            self.running -= 1
+        return self.response
+
+
+class NativeStorage:
+    is_async = True
+
+    def __init__(self, response):
+        self.response = response
+
+    async def retrieve_response(self, spider, request):
+        return self.response
+
+
+class DeferredTest(unittest.TestCase):
+    def setUp(self):
+        self.response = Response("http://example.com", body=b"body")
+
+    @defer.inlineCallbacks
+    def test_threaded_storage(self):
+        storage = BlockingStorage(self.response)
+        threaded = ThreadedStorage(storage, 2)
+        threaded.start()
+        try:
+            dfds = [
+                threaded.retrieve_response(None, Request("http://example.com"))
+                for _ in range(5)
+            ]
+            assert not any(dfd.called for dfd in dfds)
+            storage.release.set()
+            responses = yield defer.gatherResults(dfds)
+        finally:
+            threaded.stop()
+        assert responses == [self.response] * 5
+        assert storage.max_running == 2
+
+    @defer.inlineCallbacks
+    def test_as_deferred(self):
+        assert (yield as_deferred(self.response)) is self.response
+        storage = NativeStorage(self.response)
+        response = yield as_deferred(storage.retrieve_response(None, None))
+        assert response is self.response
+
+
+class AsyncMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.crawler = get_crawler(Spider)
+        self.spider = self.crawler._create_spider("spider")
+        self.crawler.stats.open_spider(self.spider)
+        self.tmpdir = tempfile.mkdtemp()
+        self.request = Request("http://example.com")
+        self.response = Response(
+            "http://example.com", headers={"Content-Type": "text/html"}, body=b"body"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _middleware(self, **settings):
+        settings = Settings(
+            {
+                "TIME_MACHINE_ENABLED": True,
+                "TIME_MACHINE_STORAGE": (
+                    "scrapy_time_machine.storages.DbmTimeMachineStorage"
+                ),
+                "TIME_MACHINE_URI": self.tmpdir + "/test.db",
+                "TIME_MACHINE_ASYNC_THREADS": 2,
+                **settings,
+            }
+        )
+        mw = TimeMachineMiddleware(settings, self.crawler.stats)
+        mw.spider_opened(self.spider)
+        return mw
+
+    @defer.inlineCallbacks
+    def test_snapshot_and_retrieve(self):
+        mw = self._middleware(TIME_MACHINE_SNAPSHOT=True)
+        dfd = mw.process_response(self.request, self.response, self.spider)
+        assert isinstance(dfd, defer.Deferred)
+        assert (yield dfd) is self.response
+        mw.spider_closed(self.spider)
+        assert self.crawler.stats.get_value("time_machine/store") == 1
+
+        mw = self._middleware(TIME_MACHINE_RETRIEVE=True)
+        try:
+            dfd = mw.process_request(self.request, self.spider)
+            assert isinstance(dfd, defer.Deferred)
+            response = yield dfd
+            assert response.body == self.response.body
+            assert "snapshot" in response.flags
+            assert self.request.meta["snapshotted_response"] is response
+
+            with self.assertRaises(CloseSpider):
+                yield mw.process_request(Request("http://example.com/new"), self.spider)
+        finally:
+            mw.spider_closed(self.spider)
+
+    @defer.inlineCallbacks
+    def test_concurrent_lookups(self):
+        requests = [Request(f"http://example.com/{i}") for i in range(8)]
+        segment = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+        mw = self._middleware(TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_STORAGE=segment)
+        for request in requests:
+            response = self.response.replace(url=request.url)
+            yield mw.process_response(request, response, self.spider)
+        mw.spider_closed(self.spider)
+
+        mw = self._middleware(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_STORAGE=segment,
+            TIME_MACHINE_ASYNC_THREADS=4,
+        )
+        storage = mw.storage
+        read = storage._read
+        lock = Lock()
+        running = [0, 0]
+
+        def slow_read(offset, length):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return read(offset, length)
+
+        storage._read = slow_read
+        try:
+            responses = yield defer.gatherResults(
+                [mw.process_request(request, self.spider) for request in requests]
+            )
+        finally:
+            mw.spider_closed(self.spider)
+        assert [r.url for r in responses] == [r.url for r in requests]
+        assert running[1] > 1
@@ -0,0 +1,85 @@
+import pytest
+from scrapy.http import HtmlResponse, Response, TextResponse
+
+from scrapy_time_machine.compression import GzipCodec, NoneCodec
+from scrapy_time_machine.lazy import CompressedBody, lazy_response, response_class
+
+BODY = b"<html><title>caf\xc3\xa9</title></html>" * 100
+
+
+def test_inflate():
+    codec = GzipCodec()
+    body = CompressedBody(codec, memoryview(codec.compress(BODY)))
+    assert body.file is None
+    assert isinstance(body.data, bytes)
+    assert body.inflate() == BODY
+
+
+def test_spill():
+    codec = GzipCodec()
+    compressed = codec.compress(BODY)
+    body = CompressedBody(codec, compressed, spill_size=len(compressed) - 1)
+    assert body.data is None
+    assert body.size == len(compressed)
+    assert body.inflate() == BODY
+    assert body.file.closed
+
+
+def test_lazy_response():
+    body = CompressedBody(NoneCodec(), BODY)
+    response = lazy_response(
+        HtmlResponse,
+        body,
+        url="http://www.example.com",
+        headers={"Content-Type": "text/html; charset=utf-8"},
+        status=200,
+    )
+    assert isinstance(response, HtmlResponse)
+    assert response._compressed_body is body
+    assert response.css("title::text").get() == "café"
+    assert response._compressed_body is None
+    assert response.body == BODY
+    assert response.replace(status=201).body == BODY
+    other = lazy_response(Response, body, url="http://www.example.com")
+    assert type(other) is not type(response)
+    assert type(lazy_response(HtmlResponse, body, url="http://a")) is type(response)
+
+
+@pytest.mark.parametrize(
+    "content_type, body",
+    [
+        # Neither the headers nor the body declare the encoding
+        ("text/html", b"<html><title>Hello</title></html>"),
+        ("text/html", b'<html><meta charset="latin-1"><title>caf\xe9</title></html>'),
+    ],
+)
+def test_lazy_response_encoding_from_body(content_type, body):
+    response = lazy_response(
+        HtmlResponse,
+        CompressedBody(GzipCodec(), GzipCodec().compress(body)),
+        url="http://www.example.com",
+        headers={"Content-Type": content_type},
+    )
+    expected = HtmlResponse(
+        "http://www.example.com", headers={"Content-Type": content_type}, body=body
+    )
+    assert response._compressed_body is not None
+    assert response.encoding == expected.encoding
+    assert response.text == expected.text
+    assert response.css("title::text").get() == expected.css("title::text").get()
+
+
+def test_lazy_text_response_text_first():
+    body = b"<html><title>Hello</title></html>"
+    response = lazy_response(
+        TextResponse, CompressedBody(NoneCodec(), body), url="http://a"
+    )
+    assert response.text == body.decode()
+
+
+def test_response_class():
+    response = lazy_response(
+        HtmlResponse, CompressedBody(NoneCodec(), b""), url="http://a"
+    )
+    assert response_class(response) is HtmlResponse
+    assert response_class(HtmlResponse("http://a")) is HtmlResponse
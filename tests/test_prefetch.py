@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+from scrapy_time_machine.prefetch import Prefetcher
+
+
+class Loader:
+    def __init__(self):
+        self.loaded = []
+
+    def load(self, key):
+        self.loaded.append(key)
+        return key.upper()
+
+
+def test_read_ahead():
+    loader = Loader()
+    prefetcher = Prefetcher(loader.load, list("abcdef"), size=2)
+    assert prefetcher.get("a") == "A"
+    assert prefetcher.get("b") == "B"
+    assert prefetcher.get("x") == "X"
+    prefetcher.close()
+    assert (prefetcher.hits, prefetcher.misses) == (2, 1)
+    assert sorted(loader.loaded) == ["a", "b", "c", "d", "x"]
+
+
+def test_keys_are_scheduled_once():
+    loader = Loader()
+    prefetcher = Prefetcher(loader.load, list("abcd"), size=4)
+    for key in "abcd":
+        prefetcher.get(key)
+    prefetcher.close()
+    assert sorted(loader.loaded) == list("abcd")
+    assert (prefetcher.hits, prefetcher.misses) == (4, 0)
+
+
+def test_oldest_records_are_evicted():
+    release = Event()
+
+    def load(key):
+        release.wait()
+        return key
+
+    prefetcher = Prefetcher(load, list("abcdefgh"), size=2)
+    assert list(prefetcher.pending) == ["a", "b"]
+    release.set()
+    # Jumping ahead schedules records that don't fit with the pending ones
+    assert prefetcher.get("e") == "e"
+    assert list(prefetcher.pending) == ["f", "g"]
+    assert prefetcher.evictions == 2
+    assert prefetcher.get("a") == "a"
+    prefetcher.close()
+    assert (prefetcher.hits, prefetcher.misses) == (0, 2)
+    assert not prefetcher.pending
+
+
+def test_concurrent_gets():
+    keys = [str(i) for i in range(200)]
+    prefetcher = Prefetcher(lambda key: key, keys, size=8, workers=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(prefetcher.get, keys))
+    prefetcher.close()
+    assert values == keys
+    assert prefetcher.hits + prefetcher.misses == len(keys)
+    assert len(prefetcher.pending) == 0
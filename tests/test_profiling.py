@@ -0,0 +1,47 @@
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_time_machine.compression import GzipCodec
+from scrapy_time_machine.profiling import Profiler
+
+
+def get_profiler():
+    crawler = get_crawler(Spider)
+    crawler.stats.open_spider(None)
+    return Profiler(crawler.stats), crawler.stats
+
+
+def test_histogram():
+    profiler, stats = get_profiler()
+    for seconds in (5e-6, 5e-6, 2e-3, 20):
+        profiler.record("write", seconds)
+    assert stats.get_stats() == {
+        "time_machine/profile/write/count": 4,
+        "time_machine/profile/write/seconds": 20.00201,
+        "time_machine/profile/write/max_seconds": 20,
+        "time_machine/profile/write/le_10us": 2,
+        "time_machine/profile/write/le_10ms": 1,
+        "time_machine/profile/write/gt_10s": 1,
+    }
+
+
+def test_wrap():
+    profiler, stats = get_profiler()
+    timed = profiler.wrap("double", lambda x: 2 * x)
+    assert timed(2) == 4
+    assert stats.get_value("time_machine/profile/double/count") == 1
+
+
+def test_wrap_codec():
+    profiler, stats = get_profiler()
+    codec = profiler.wrap_codec(GzipCodec())
+    body = b"a" * 1000
+    assert codec.decompress(codec.compress(body)) == body
+    compressed = stats.get_value("time_machine/bytes/compressed")
+    assert stats.get_value("time_machine/bytes/raw") == 1000
+    assert stats.get_value("time_machine/bytes/decompressed") == 1000
+    assert stats.get_value("time_machine/compression_ratio") == 1000 / compressed
+    assert stats.get_value("time_machine/profile/compress/count") == 1
+    assert stats.get_value("time_machine/profile/decompress/count") == 1
+    # Other instances are not affected
+    assert "compress" not in vars(GzipCodec())
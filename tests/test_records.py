@@ -0,0 +1,113 @@
+import pytest
+
+from scrapy_time_machine.records import (
+    HeaderTable,
+    decode_header,
+    decode_headers,
+    decode_record,
+    encode_header,
+    encode_headers,
+    encode_record,
+    is_record,
+)
+
+DATA = {
+    "status": 200,
+    "url": "http://www.example.com/ünicode",
+    "headers": {b"Content-Type": [b"text/html"], b"Set-Cookie": [b"a=1", b"b=2"]},
+    "time": 1675000000.5,
+    "codec": "gzip",
+    "body": b"\x00compressed body",
+}
+
+
+def test_roundtrip():
+    record = encode_record(DATA)
+    assert is_record(record)
+    assert decode_record(record) == DATA
+
+
+def test_body_is_not_copied():
+    record = memoryview(encode_record(DATA))
+    body = decode_record(record)["body"]
+    assert isinstance(body, memoryview)
+    assert body.obj is record.obj
+    assert bytes(body) == DATA["body"]
+
+
+def test_body_ref():
+    data = {k: v for k, v in DATA.items() if k not in ("codec", "body")}
+    data["body_ref"] = "ab" * 32
+    assert decode_record(encode_record(data)) == data
+
+
+def test_external_body():
+    data = {k: v for k, v in DATA.items() if k != "body"}
+    data["external"] = "cd" * 32
+    assert decode_record(encode_record(data)) == data
+
+
+def test_base_body():
+    data = {k: v for k, v in DATA.items() if k not in ("codec", "body")}
+    data["base_body"] = True
+    assert decode_record(encode_record(data)) == data
+
+
+def test_delta():
+    data = dict(DATA, codec="zstd", delta=3)
+    assert decode_record(encode_record(data)) == data
+
+
+def test_headers():
+    assert decode_headers(encode_headers(DATA["headers"])) == DATA["headers"]
+    assert decode_headers(encode_headers({})) == {}
+
+
+def test_header_table():
+    saved = {}
+    table = HeaderTable(10, save=saved.__setitem__)
+    first = encode_record(DATA, table)
+    # headers are added to the table the second time they are seen
+    assert len(table) == 0
+    second = encode_record(DATA, table)
+    assert saved == {
+        0: (b"Content-Type", (b"text/html",)),
+        1: (b"Set-Cookie", (b"a=1", b"b=2")),
+    }
+    assert len(second) < len(first)
+    for record in (first, second):
+        assert decode_record(record, table) == DATA
+    with pytest.raises(ValueError, match="header table"):
+        decode_record(second)
+
+    assert decode_record(second, HeaderTable(10, load=saved.get)) == DATA
+    with pytest.raises(ValueError, match="missing"):
+        decode_record(second, HeaderTable(10))
+
+
+def test_header_table_is_bounded():
+    table = HeaderTable(1)
+    assert table.ref(b"A", [b"1"]) is None
+    assert table.ref(b"A", [b"1"]) == 0
+    assert table.ref(b"B", [b"2"]) is None
+    assert table.ref(b"B", [b"2"]) is None
+    with pytest.raises(ValueError):
+        HeaderTable(0x10000)
+
+
+def test_header_roundtrip():
+    header = (b"Set-Cookie", (b"a=1", b"b=2"))
+    assert decode_header(encode_header(*header)) == header
+
+
+def test_not_a_record():
+    assert not is_record(b"\x80\x02}q\x00.")
+    with pytest.raises(ValueError):
+        decode_record(b"\x80\x02" + b"\x00" * 20)
+
+
+def test_newer_version():
+    record = bytearray(encode_record(DATA))
+    record[3] = 99
+    with pytest.raises(ValueError, match="version 99"):
+        decode_record(bytes(record))
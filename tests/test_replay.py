@@ -0,0 +1,108 @@
+import gzip
+import shutil
+import tempfile
+
+from scrapy import Spider, signals
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from scrapy_time_machine.storages import DbmTimeMachineStorage
+
+
+class ReplaySpider(Spider):
+    name = "replay"
+    start_urls = ["http://example.com/"]
+
+    def parse(self, response):
+        yield {"url": response.url, "title": response.css("title::text").get()}
+        for href in response.css("a::attr(href)").getall():
+            yield response.follow(href, self.parse_page, cb_kwargs={"page": href})
+
+    def parse_page(self, response, page):
+        yield {"url": response.url, "page": page, "text": response.text}
+
+
+class ReplayDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = self.tmpdir + "/snapshot.db"
+        storage = DbmTimeMachineStorage(
+            Settings({"TIME_MACHINE_URI": self.uri, "TIME_MACHINE_SNAPSHOT": True})
+        )
+        storage.set_uri({})
+        storage.open_spider(None)
+        home = HtmlResponse(
+            "http://example.com/",
+            headers={"Content-Type": "text/html"},
+            body=b"<title>Home</title><a href='/a'>a</a><a href='/missing'>b</a>",
+        )
+        page = HtmlResponse(
+            "http://example.com/a",
+            headers={"Content-Encoding": "gzip", "Content-Type": "text/html"},
+            body=gzip.compress(b"page a"),
+        )
+        for response in (home, page):
+            storage.store_response(None, Request(response.url), response)
+        storage.close_spider(None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @defer.inlineCallbacks
+    def _replay(self, **settings):
+        settings = {
+            "DOWNLOADER": "scrapy_time_machine.replay.ReplayDownloader",
+            "DOWNLOADER_MIDDLEWARES": {
+                "scrapy_time_machine.timemachine.TimeMachineMiddleware": 901
+            },
+            "TIME_MACHINE_ENABLED": True,
+            "TIME_MACHINE_RETRIEVE": True,
+            "TIME_MACHINE_STORAGE": (
+                "scrapy_time_machine.storages.DbmTimeMachineStorage"
+            ),
+            "TIME_MACHINE_URI": self.uri,
+            **settings,
+        }
+        crawler = get_crawler(ReplaySpider, settings)
+        items = []
+        crawler.signals.connect(
+            lambda item: items.append(item), signal=signals.item_scraped, weak=False
+        )
+        yield crawler.crawl()
+        return crawler, sorted(items, key=lambda item: item["url"])
+
+    def _check_items(self, items):
+        assert items == [
+            {"url": "http://example.com/", "title": "Home"},
+            {"url": "http://example.com/a", "page": "/a", "text": "page a"},
+        ]
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        crawler, items = yield self._replay()
+        self._check_items(items)
+        # Unknown requests fail to download, as in retrieve mode
+        assert crawler.stats.get_value("downloader/exception_count") == 1
+
+    @defer.inlineCallbacks
+    def test_replay_with_threaded_storage(self):
+        crawler, items = yield self._replay(TIME_MACHINE_ASYNC_THREADS=2)
+        self._check_items(items)
+
+    @defer.inlineCallbacks
+    def test_replay_in_processes(self):
+        crawler, items = yield self._replay(TIME_MACHINE_REPLAY_PROCESSES=2)
+        self._check_items(items)
+        assert crawler.stats.get_value("time_machine/replay/remote_callbacks") == 2
+        assert crawler.engine.downloader.pool is None
+
+    @defer.inlineCallbacks
+    def test_replay_lazy_bodies_in_processes(self):
+        crawler, items = yield self._replay(
+            TIME_MACHINE_REPLAY_PROCESSES=2, TIME_MACHINE_LAZY_BODIES=True
+        )
+        self._check_items(items)
+        assert crawler.stats.get_value("time_machine/replay/remote_callbacks") == 2
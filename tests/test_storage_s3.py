@@ -1,7 +1,10 @@
+import os
 from contextlib import contextmanager
 from unittest.mock import MagicMock, mock_open, patch
 
+import boto3
 import pytest
+from botocore.exceptions import ClientError
 from scrapy import Spider
 from scrapy.settings import Settings
 from scrapy.utils.test import get_crawler
@@ -157,3 +160,117 @@ def test_finish_time_machine_retrieve_mode():
         )
 
         storage.path_to_local_file.close.assert_called_once()
+
+
+def test_prepare_time_machine_archive_mode():
+    with get_storage(
+        **{
+            "TIME_MACHINE_URI": "s3://bucket/path/to/file",
+            "TIME_MACHINE_SNAPSHOT": True,
+            "TIME_MACHINE_ARCHIVE": True,
+        }
+    ) as storage:
+        storage.set_uri({})
+        storage.s3_client.download_fileobj = MagicMock()
+        mock_dbm_open = mock_open()
+        with patch("scrapy_time_machine.storages.dbm.open", mock_dbm_open):
+            # The existing archive is downloaded to add new versions to it
+            storage._prepare_time_machine()
+            storage.s3_client.download_fileobj.assert_called_once()
+            assert mock_dbm_open.call_args[0][1] == "c"
+
+            # First run of the archive
+            storage.s3_client.download_fileobj.side_effect = ClientError(
+                {"Error": {"Code": "404"}}, "HeadObject"
+            )
+            storage._prepare_time_machine()
+            assert mock_dbm_open.call_args[0][1] == "n"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def get_cached_storage(tmp_path, **settings):
+    storage = S3TimeMachineStorage(
+        Settings(
+            {
+                "TIME_MACHINE_URI": "s3://bucket/snapshot.db",
+                "TIME_MACHINE_RETRIEVE": True,
+                "TIME_MACHINE_SNAPSHOT_CACHE_DIR": str(tmp_path),
+                "TIME_MACHINE_S3_DOWNLOAD_PART_SIZE": 1000,
+                "AWS_ACCESS_KEY_ID": "testing",
+                "AWS_SECRET_ACCESS_KEY": "testing",
+                **settings,
+            }
+        )
+    )
+    storage.set_uri({})
+    crawler = get_crawler()
+    crawler.stats.open_spider(None)
+    storage.stats = crawler.stats
+    return storage
+
+
+def test_snapshot_cache(s3, tmp_path):
+    data = os.urandom(4500)
+    s3.put_object(Bucket="bucket", Key="snapshot.db", Body=data)
+    storage = get_cached_storage(tmp_path)
+    with patch("scrapy_time_machine.storages.dbm.open", mock_open()) as dbm_open:
+        storage._prepare_time_machine()
+        path, mode = dbm_open.call_args[0]
+        assert mode == "r"
+        with open(path, "rb") as f:
+            assert f.read() == data
+        storage._prepare_time_machine()
+        assert dbm_open.call_args[0][0] == path
+        storage._finish_time_machine()
+
+        s3.put_object(Bucket="bucket", Key="snapshot.db", Body=b"new")
+        storage._prepare_time_machine()
+        assert dbm_open.call_args[0][0] != path
+
+    stats = storage.stats
+    assert stats.get_value("time_machine/snapshot_cache/hits") == 1
+    assert stats.get_value("time_machine/snapshot_cache/misses") == 2
+    assert stats.get_value("time_machine/snapshot_cache/downloaded") == 4503
+
+
+def test_snapshot_cache_multipart_checksum(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 1024)
+    data = os.urandom(5000)
+    upload = s3.create_multipart_upload(Bucket="bucket", Key="snapshot.db")
+    parts = []
+    for number, start in enumerate(range(0, len(data), 2048), 1):
+        part = s3.upload_part(
+            Bucket="bucket",
+            Key="snapshot.db",
+            UploadId=upload["UploadId"],
+            PartNumber=number,
+            Body=data[start : start + 2048],
+        )
+        parts.append({"ETag": part["ETag"], "PartNumber": number})
+    s3.complete_multipart_upload(
+        Bucket="bucket",
+        Key="snapshot.db",
+        UploadId=upload["UploadId"],
+        MultipartUpload={"Parts": parts},
+    )
+    storage = get_cached_storage(tmp_path)
+    path = storage._cached_snapshot()
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+    storage = get_cached_storage(tmp_path / "other")
+    monkeypatch.setattr(
+        "scrapy_time_machine.storages._md5_etag", lambda f, part_size: "corrupted"
+    )
+    with pytest.raises(IOError):
+        storage._cached_snapshot()
+    assert os.listdir(tmp_path / "other") == []
@@ -0,0 +1,155 @@
+import boto3
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_time_machine.storages import S3SegmentTimeMachineStorage
+
+moto = pytest.importorskip("moto")
+
+URI = "s3://bucket/snapshots/%(name)s.data"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def get_storage(**settings):
+    settings.setdefault("TIME_MACHINE_URI", URI)
+    settings.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    settings.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    storage = S3SegmentTimeMachineStorage(Settings(settings))
+    storage.set_uri({"name": "spider"})
+    return storage
+
+
+def get_responses(count):
+    return [
+        Response(
+            f"http://example.com/{i}",
+            headers={"Content-Type": "text/html"},
+            body=b"body %d " % i * 200,
+        )
+        for i in range(count)
+    ]
+
+
+def test_snapshot_and_lazy_retrieve(s3):
+    responses = get_responses(50)
+    storage = get_storage(TIME_MACHINE_SNAPSHOT=True)
+    storage.open_spider(None)
+    for response in responses:
+        storage.store_response(None, Request(response.url), response)
+    storage.close_spider(None)
+
+    keys = [o["Key"] for o in s3.list_objects(Bucket="bucket")["Contents"]]
+    assert sorted(keys) == ["snapshots/spider.data", "snapshots/spider.data.idx"]
+
+    storage = get_storage(
+        TIME_MACHINE_RETRIEVE=True,
+        TIME_MACHINE_S3_BLOCK_SIZE=1024,
+        TIME_MACHINE_S3_CACHE_SIZE=16 * 1024,
+    )
+    storage.open_spider(None)
+    # the responses and the shared Content-Type
+    assert len(storage.index) == 51
+    assert storage.block_cache.blocks == {}
+    for response in reversed(responses):
+        stored = storage.retrieve_response(None, Request(response.url))
+        assert stored.body == response.body
+        assert stored.headers == response.headers
+    assert storage.block_cache.hits > 0
+    assert storage.block_cache.size <= 16 * 1024
+    assert storage.retrieve_response(None, Request("http://example.com/new")) is None
+    storage.close_spider(None)
+
+
+def test_archive_is_not_supported(s3):
+    with pytest.raises(NotConfigured):
+        get_storage(TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_ARCHIVE=True)
+
+
+def test_snapshot_streams_parts(s3, monkeypatch):
+    monkeypatch.setattr("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 1024)
+    responses = get_responses(50)
+    storage = get_storage(
+        TIME_MACHINE_SNAPSHOT=True,
+        TIME_MACHINE_CODEC="none",
+        TIME_MACHINE_S3_PART_SIZE=4096,
+    )
+    storage.open_spider(None)
+    for response in responses:
+        storage.store_response(None, Request(response.url), response)
+    storage.uploader.flush()
+    assert len(storage.data_file.parts) > 1
+    assert storage.data_file.spool.tell() < 4096
+    assert storage.index == {}
+    storage.close_spider(None)
+    assert storage.uploader is None
+
+    storage = get_storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_PREFETCH=10)
+    storage.open_spider(None)
+    for response in responses:
+        assert storage.retrieve_response(None, Request(response.url)).body == (
+            response.body
+        )
+    assert storage.prefetcher.hits == 50
+    storage.close_spider(None)
+
+
+def test_profile_s3_calls(s3):
+    crawler = get_crawler(Spider)
+    crawler.stats.open_spider(None)
+    for mode in ("TIME_MACHINE_SNAPSHOT", "TIME_MACHINE_RETRIEVE"):
+        storage = get_storage(**{mode: True, "TIME_MACHINE_PROFILE": True})
+        storage.stats = crawler.stats
+        storage.open_spider(None)
+        if storage.snapshot_mode:
+            response = Response("http://example.com", body=b"body")
+            storage.store_response(None, Request(response.url), response)
+        else:
+            assert storage.retrieve_response(None, Request("http://example.com"))
+        storage.close_spider(None)
+    stats = crawler.stats
+    for call in ("create_multipart_upload", "upload_part", "get_object"):
+        assert stats.get_value(f"time_machine/profile/s3/{call}/count") > 0, call
+
+
+def test_external_bodies(s3):
+    responses = get_responses(5)
+    storage = get_storage(
+        TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_EXTERNAL_BODY_SIZE=1000
+    )
+    storage.open_spider(None)
+    for response in responses:
+        storage.store_response(None, Request(response.url), response)
+    storage.close_spider(None)
+
+    keys = [o["Key"] for o in s3.list_objects(Bucket="bucket")["Contents"]]
+    bodies = [k for k in keys if k.startswith("snapshots/spider.data.bodies/")]
+    assert len(bodies) == 5
+
+    storage = get_storage(TIME_MACHINE_RETRIEVE=True)
+    storage.open_spider(None)
+    for response in responses:
+        stored = storage.retrieve_response(None, Request(response.url))
+        assert stored.body == response.body
+    storage.close_spider(None)
+
+
+def test_snapshot_upload_failure(s3, monkeypatch):
+    storage = get_storage(TIME_MACHINE_SNAPSHOT=True)
+    storage.open_spider(None)
+    storage.store_response(None, Request("http://example.com"), get_responses(1)[0])
+    monkeypatch.setattr(storage.s3_client, "upload_part", None)
+    storage.close_spider(None)
+    assert "Contents" not in s3.list_objects(Bucket="bucket")
+    assert s3.list_multipart_uploads(Bucket="bucket").get("Uploads", []) == []
@@ -0,0 +1,203 @@
+import os
+
+import boto3
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.misc import load_object
+from scrapy.utils.test import get_crawler
+
+from scrapy_time_machine.convert import merge_shards, open_storage
+from scrapy_time_machine.storages import DbmTimeMachineStorage
+from scrapy_time_machine.timemachine import TimeMachineMiddleware
+
+STORAGE = "scrapy_time_machine.storages.ShardedTimeMachineStorage"
+
+
+def get_responses(start, count):
+    return [
+        Response(
+            f"http://example.com/{i}",
+            headers={"Content-Type": "text/html"},
+            body=b"body %d" % i,
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def get_settings(uri, **settings):
+    return Settings(
+        {
+            "TIME_MACHINE_ENABLED": True,
+            "TIME_MACHINE_STORAGE": STORAGE,
+            "TIME_MACHINE_URI": uri,
+            "TIME_MACHINE_SHARDS": 4,
+            **settings,
+        }
+    )
+
+
+def snapshot(uri, responses, **settings):
+    settings = get_settings(uri, TIME_MACHINE_SNAPSHOT=True, **settings)
+    storage = load_storage(settings)
+    storage.open_spider(None)
+    for response in responses:
+        storage.store_response(None, Request(response.url), response)
+    storage.close_spider(None)
+    return storage
+
+
+def load_storage(settings):
+    storage = load_object(settings["TIME_MACHINE_STORAGE"])(settings)
+    storage.set_uri({"name": "spider"})
+    return storage
+
+
+def test_writers_and_routing(tmp_path):
+    uri = str(tmp_path / "%(name)s")
+    first, second = get_responses(0, 20), get_responses(20, 20)
+    snapshot(uri, first, TIME_MACHINE_SHARD_WRITER="a")
+    snapshot(uri, second, TIME_MACHINE_SHARD_WRITER="b")
+
+    names = os.listdir(tmp_path / "spider")
+    assert sorted(n for n in names if n.endswith(".json")) == [
+        "a.manifest.json",
+        "b.manifest.json",
+    ]
+
+    crawler = get_crawler(Spider)
+    crawler.stats.open_spider(None)
+    mw = TimeMachineMiddleware(
+        get_settings(uri, TIME_MACHINE_RETRIEVE=True), crawler.stats
+    )
+    spider = Spider(name="spider")
+    mw.spider_opened(spider)
+    try:
+        for response in first + second:
+            stored = mw.process_request(Request(response.url), spider)
+            assert stored.body == response.body
+            assert stored.headers == response.headers
+        assert mw.storage.retrieve_response(spider, Request("http://new")) is None
+    finally:
+        mw.spider_closed(spider)
+
+
+def test_latest_writer_wins(tmp_path):
+    uri = str(tmp_path / "snapshot")
+    response = get_responses(0, 1)[0]
+    snapshot(uri, [response], TIME_MACHINE_SHARD_WRITER="a")
+    updated = response.replace(body=b"updated")
+    snapshot(uri, [updated], TIME_MACHINE_SHARD_WRITER="b")
+    storage = load_storage(get_settings(uri, TIME_MACHINE_RETRIEVE=True))
+    storage.open_spider(None)
+    assert storage.retrieve_response(None, Request(response.url)).body == b"updated"
+    storage.close_spider(None)
+
+    target = str(tmp_path / "merged")
+    assert merge_shards(get_settings(uri), uri, target) == 1
+    merged = open_storage(Settings(), target, "retrieve")
+    assert merged.retrieve_response(None, Request(response.url)).body == b"updated"
+    merged.close_spider(None)
+
+
+def test_shared_response_cache(tmp_path):
+    uri = str(tmp_path / "snapshot")
+    responses = get_responses(0, 20)
+    snapshot(uri, responses)
+    crawler = get_crawler(Spider)
+    crawler.stats.open_spider(None)
+    storage = load_storage(
+        get_settings(
+            uri, TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_RESPONSE_CACHE_SIZE=1024
+        )
+    )
+    storage.stats = crawler.stats
+    storage.open_spider(None)
+    for _ in range(2):
+        for response in responses:
+            stored = storage.retrieve_response(None, Request(response.url))
+            assert stored.body == response.body
+    assert all(s.response_cache is None for s in storage._open_shards.values())
+    assert storage.response_cache.size <= 1024
+    storage.close_spider(None)
+    stats = crawler.stats
+    assert stats.get_value("time_machine/response_cache/misses") == 20
+    assert stats.get_value("time_machine/response_cache/hits") == 20
+
+
+def test_shared_blob_store(tmp_path):
+    uri = str(tmp_path / "snapshot")
+    blobs = str(tmp_path / "blobs.db")
+    responses = get_responses(0, 200)
+    snapshot(uri, responses, TIME_MACHINE_BLOB_STORE_URI=blobs)
+    storage = load_storage(
+        get_settings(uri, TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_BLOB_STORE_URI=blobs)
+    )
+    storage.open_spider(None)
+    try:
+        for response in responses:
+            stored = storage.retrieve_response(None, Request(response.url))
+            assert stored.body == response.body
+        shards = list(storage._open_shards.values())
+        assert len(shards) == 4
+        assert all(shard.blob_store is storage.blob_store for shard in shards)
+    finally:
+        storage.close_spider(None)
+
+
+def test_merge(tmp_path):
+    uri = str(tmp_path / "snapshot")
+    responses = get_responses(0, 30)
+    snapshot(uri, responses[:15], TIME_MACHINE_SHARD_WRITER="a")
+    snapshot(uri, responses[15:], TIME_MACHINE_SHARD_WRITER="b")
+
+    target = str(tmp_path / "merged")
+    assert merge_shards(get_settings(uri), uri, target) == 30
+    storage = open_storage(Settings(), target, "retrieve")
+    try:
+        assert isinstance(storage, DbmTimeMachineStorage)
+        for response in responses:
+            stored = storage.retrieve_response(None, Request(response.url))
+            assert stored.body == response.body
+        assert len(storage._get_order()) == 30
+    finally:
+        storage.close_spider(None)
+
+
+def test_merge_requires_sharded_storage(tmp_path):
+    with pytest.raises(NotConfigured):
+        merge_shards(Settings(), str(tmp_path / "a"), str(tmp_path / "b"))
+
+
+def test_s3_shards(monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="bucket")
+        uri = "s3://bucket/snapshots/%(name)s"
+        credentials = {
+            "TIME_MACHINE_STORAGE": (
+                "scrapy_time_machine.storages.S3ShardedTimeMachineStorage"
+            ),
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+        }
+        responses = get_responses(0, 10)
+        snapshot(uri, responses, TIME_MACHINE_SHARD_WRITER="a", **credentials)
+
+        keys = [o["Key"] for o in client.list_objects(Bucket="bucket")["Contents"]]
+        assert "snapshots/spider/a.manifest.json" in keys
+        assert all(key.startswith("snapshots/spider/a") for key in keys)
+
+        storage = load_storage(
+            get_settings(uri, TIME_MACHINE_RETRIEVE=True, **credentials)
+        )
+        assert storage.is_uri_valid()
+        storage.open_spider(None)
+        for response in responses:
+            stored = storage.retrieve_response(None, Request(response.url))
+            assert stored.body == response.body
+        storage.close_spider(None)
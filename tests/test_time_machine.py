@@ -1,7 +1,11 @@
+import os
+import pickle
 import shutil
 import tempfile
 import unittest
 from contextlib import contextmanager
+from datetime import datetime
+from time import time
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -11,9 +15,41 @@ from scrapy.settings import Settings
 from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
 
+from scrapy_time_machine.blobs import DbmBlobStore
+from scrapy_time_machine.storages import DbmTimeMachineStorage
 from scrapy_time_machine.timemachine import TimeMachineMiddleware
 
 
+class MinimalStorage:
+    """Storage with only the attributes the middleware always needed."""
+
+    stored = {}
+
+    def __init__(self, settings):
+        self.uri = settings.get("TIME_MACHINE_URI")
+        self.retrieve_mode = settings.getbool("TIME_MACHINE_RETRIEVE")
+        self.snapshot_mode = settings.getbool("TIME_MACHINE_SNAPSHOT")
+        self.snapshot_uri = None
+
+    def set_uri(self, uri_params):
+        self.snapshot_uri = self.uri % uri_params
+
+    def is_uri_valid(self):
+        return True
+
+    def open_spider(self, spider):
+        pass
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        return self.stored.get(request.url)
+
+    def store_response(self, spider, request, response):
+        self.stored[request.url] = response
+
+
 class TimeMachineMiddlewareTest(unittest.TestCase):
     storage_class = "scrapy_time_machine.storages.DbmTimeMachineStorage"
 
@@ -121,6 +157,21 @@ class DefaultStorageTimeMachineMWTest(TimeMachineMiddlewareTest):
                 self.spider, self.request, self.response
             )
 
+    def test_minimal_storage(self):
+        settings = {
+            "TIME_MACHINE_SNAPSHOT": True,
+            "TIME_MACHINE_STORAGE": "tests.test_time_machine.MinimalStorage",
+        }
+        with self._middleware(**settings) as mw:
+            assert mw.process_request(self.request, self.spider) is None
+            mw.process_response(self.request, self.response, self.spider)
+        settings["TIME_MACHINE_SNAPSHOT"] = False
+        settings["TIME_MACHINE_RETRIEVE"] = True
+        with self._middleware(**settings) as mw:
+            response = mw.process_request(self.request, self.spider)
+            assert response is self.response
+            assert "snapshot" in response.flags
+
     @patch("scrapy_time_machine.storages.DbmTimeMachineStorage.retrieve_response")
     @patch("scrapy_time_machine.storages.DbmTimeMachineStorage.is_uri_valid")
     def test_retrieval_run(self, mock_is_uri_valid, mock_retrieve_response):
@@ -149,6 +200,866 @@ class DefaultStorageTimeMachineMWTest(TimeMachineMiddlewareTest):
             assert "snapshot" in response.flags
             assert response.url == self.response.url
 
+    def test_snapshot_threaded_writes(self):
+        settings = {
+            "TIME_MACHINE_SNAPSHOT": True,
+            "TIME_MACHINE_WRITE_WORKERS": 2,
+            "TIME_MACHINE_WRITE_QUEUE_SIZE": 1,
+        }
+        with self._storage(**settings) as storage:
+            assert storage.writer is not None
+            storage.store_response(self.spider, self.request, self.response)
+            storage.writer.flush()
+            response = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, self.response)
+        assert storage.writer is None
+
+    def test_snapshot_threaded_write_errors(self):
+        settings = {"TIME_MACHINE_SNAPSHOT": True, "TIME_MACHINE_WRITE_WORKERS": 2}
+        with self.assertLogs("scrapy_time_machine.storages", "ERROR") as logs:
+            with self._storage(**settings) as storage:
+                storage.writer.func = MagicMock(side_effect=IOError("disk full"))
+                for i in range(3):
+                    request = Request(f"http://www.example.com/{i}")
+                    storage.store_response(self.spider, request, self.response)
+        assert self.crawler.stats.get_value("time_machine/store/errors") == 3
+        assert "Failed to write 3 responses" in logs.output[-1]
+
+    def test_profiling(self):
+        phases = {
+            "open",
+            "close",
+            "store",
+            "retrieve",
+            "fingerprint",
+            "encode",
+            "decode",
+            "write",
+            "read",
+            "compress",
+            "decompress",
+            "response",
+        }
+        with self._storage(TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_PROFILE=True) as s:
+            s.store_response(self.spider, self.request, self.response)
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_PROFILE=True) as s:
+            response = s.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, self.response)
+        stats = self.crawler.stats
+        for phase in phases:
+            assert stats.get_value(f"time_machine/profile/{phase}/count") > 0, phase
+        assert stats.get_value("time_machine/bytes/raw") == len(self.response.body)
+        assert stats.get_value("time_machine/compression_ratio") > 0
+
+    def test_profiling_disabled(self):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            assert storage.profiler is None
+            # Storages run their plain methods
+            assert "_put" not in vars(storage)
+            assert "compress" not in vars(storage.codec)
+        assert not any(
+            key.startswith("time_machine/profile/")
+            for key in self.crawler.stats.get_stats()
+        )
+
+
+class CodecTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _snapshot_and_retrieve(self, responses, **settings):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True, **settings) as storage:
+            for response in responses:
+                storage.store_response(self.spider, Request(response.url), response)
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            for response in responses:
+                stored = storage.retrieve_response(self.spider, Request(response.url))
+                self.assertEqualResponse(stored, response)
+            return storage
+
+    def _responses(self, count):
+        return [
+            self.response.replace(
+                url=f"http://www.example.com/{i}",
+                body=b"<html>" + b"boilerplate " * 50 + b"%d</html>" % i,
+            )
+            for i in range(count)
+        ]
+
+    def test_codecs(self):
+        for codec in ("none", "gzip"):
+            self._snapshot_and_retrieve(
+                [self.response], TIME_MACHINE_CODEC=codec, TIME_MACHINE_CODEC_LEVEL=1
+            )
+
+    def test_unknown_codec(self):
+        with pytest.raises(NotConfigured):
+            with self._middleware(TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_CODEC="?"):
+                pass
+
+    def test_zstd_trained_dictionary(self):
+        pytest.importorskip("zstandard")
+        storage = self._snapshot_and_retrieve(
+            self._responses(30),
+            TIME_MACHINE_CODEC="zstd",
+            TIME_MACHINE_ZSTD_DICT_SAMPLES=20,
+            TIME_MACHINE_ZSTD_DICT_SIZE=1024,
+        )
+        assert storage.codecs["zstd"].dictionary is not None
+
+    def test_zstd_dictionary_training_failure(self):
+        pytest.importorskip("zstandard")
+        storage = self._snapshot_and_retrieve(
+            self._responses(2),
+            TIME_MACHINE_CODEC="zstd",
+            TIME_MACHINE_ZSTD_DICT_SAMPLES=20,
+        )
+        assert storage.codecs["zstd"].dictionary is None
+
+    def test_retrieve_legacy_gzip_snapshot(self):
+        # Records of older versions are pickled dicts with a gzipped body
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            key = storage._request_key(self.request)
+            data = storage._encode_response(None, self.response)
+            del data["codec"]
+            storage._put(f"{key}_data", pickle.dumps(data, protocol=2))
+            storage._put(f"{key}_time", str(time()))
+        with pytest.raises(NotConfigured, match="timemachine-convert"):
+            with self._storage(TIME_MACHINE_RETRIEVE=True):
+                pass
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_LEGACY_RECORDS=True
+        ) as storage:
+            stored = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(stored, self.response)
+
+
+class DedupTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _get_settings(self, **new_settings):
+        new_settings.setdefault(
+            "TIME_MACHINE_BLOB_STORE_URI", self.tmpdir + "/%(name)s-blobs.db"
+        )
+        new_settings.setdefault("TIME_MACHINE_URI", self.tmpdir + "/%(time)s.db")
+        return super()._get_settings(**new_settings)
+
+    def _snapshot(self, requests, response, **settings):
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True, **settings) as mw:
+            for request in requests:
+                mw.process_response(request, response, self.spider)
+            return mw.storage.snapshot_uri
+
+    def test_snapshot_and_retrieve(self):
+        other_request = Request("http://www.example.com/other")
+        uri = self._snapshot([self.request, other_request], self.response)
+        stats = self.crawler.stats
+        assert stats.get_value("time_machine/dedup/misses") == 1
+        assert stats.get_value("time_machine/dedup/hits") == 1
+        assert stats.get_value("time_machine/dedup/bytes_saved") == len(
+            self.response.body
+        )
+        with self._middleware(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_URI=uri) as mw:
+            for request in (self.request, other_request):
+                response = mw.process_request(request, self.spider)
+                self.assertEqualResponse(response, self.response)
+
+    def test_blob_store_is_read_only_when_retrieving(self):
+        uri = self._snapshot([self.request], self.response)
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_URI=uri) as storage:
+            with pytest.raises(Exception):
+                storage.blob_store.put("digest", "gzip", b"body")
+            assert "digest" not in storage.blob_store
+
+    def test_blob_store_shared_across_snapshots(self):
+        self._snapshot([self.request], self.response, TIME_MACHINE_CODEC="none")
+        with patch("scrapy_time_machine.timemachine.datetime") as mock_datetime:
+            mock_datetime.utcnow.return_value = datetime(2000, 1, 1)
+            uri = self._snapshot([self.request], self.response)
+        assert self.crawler.stats.get_value("time_machine/dedup/hits") == 1
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_URI=uri) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, self.response)
+
+    def test_missing_blob(self):
+        uri = self._snapshot([self.request], self.response)
+        with pytest.raises(NotConfigured):
+            with self._storage(
+                TIME_MACHINE_RETRIEVE=True,
+                TIME_MACHINE_URI=uri,
+                TIME_MACHINE_BLOB_STORE_URI=self.tmpdir + "/other-blobs.db",
+            ):
+                pass
+        DbmBlobStore(self.tmpdir + "/other-blobs.db").close()
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_URI=uri,
+            TIME_MACHINE_BLOB_STORE_URI=self.tmpdir + "/other-blobs.db",
+        ) as storage:
+            with pytest.raises(KeyError):
+                storage.retrieve_response(self.spider, self.request)
+
+
+class ArchiveTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _snapshot_at(self, timestamp, response, **settings):
+        with patch("scrapy_time_machine.storages.time", return_value=timestamp):
+            with self._middleware(
+                TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_ARCHIVE=True, **settings
+            ) as mw:
+                mw.process_response(self.request, response, self.spider)
+
+    def _retrieve(self, as_of=None):
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_AS_OF=as_of) as s:
+            return s.retrieve_response(self.spider, self.request)
+
+    def test_as_of(self):
+        first = self.response.replace(headers={"Date": "1"}, body=b"first")
+        second = self.response.replace(headers={"Date": "2"}, body=b"second")
+        third = first.replace(headers={"Date": "3"})
+        self._snapshot_at(100, first)
+        self._snapshot_at(200, second)
+        self._snapshot_at(300, third)
+        assert self.crawler.stats.get_value("time_machine/archive/unchanged") == 1
+
+        assert self._retrieve(as_of="50") is None
+        self.assertEqualResponse(self._retrieve(as_of="100"), first)
+        self.assertEqualResponse(self._retrieve(as_of="250.5"), second)
+        # Unchanged versions point to the response stored first
+        self.assertEqualResponse(self._retrieve(), first)
+        self.assertEqualResponse(
+            self._retrieve(as_of="1970-01-01T00:05:00+00:00"), first
+        )
+        self.assertEqualResponse(self._retrieve(as_of="1970-01-01T00:04:00"), second)
+
+    def test_archive_format_is_kept(self):
+        self._snapshot_at(100, self.response)
+        response = self.response.replace(body=b"new")
+        with patch("scrapy_time_machine.storages.time", return_value=200):
+            with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+                mw.process_response(self.request, response, self.spider)
+        self.assertEqualResponse(self._retrieve(as_of=150), self.response)
+        self.assertEqualResponse(self._retrieve(), response)
+
+    def test_as_of_without_archive(self):
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+            mw.process_response(self.request, self.response, self.spider)
+        self.assertEqualResponse(self._retrieve(as_of=0), self.response)
+
+
+class PrefetchTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _snapshot(self, count):
+        requests = [Request(f"http://www.example.com/{i}") for i in range(count)]
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            for request in requests:
+                response = self.response.replace(url=request.url)
+                storage.store_response(self.spider, request, response)
+        return requests
+
+    def _stats(self):
+        return {
+            name: self.crawler.stats.get_value(f"time_machine/prefetch/{name}")
+            for name in ("hits", "misses", "evicted")
+        }
+
+    def test_prefetch_in_crawl_order(self):
+        requests = self._snapshot(10)
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_PREFETCH=3) as s:
+            assert s.prefetcher.order == [s._request_key(r) for r in requests]
+            for request in requests:
+                response = s.retrieve_response(self.spider, request)
+                assert response.url == request.url
+                assert response.body == self.response.body
+            assert s.retrieve_response(self.spider, Request("http://new")) is None
+        assert self._stats() == {"hits": 10, "misses": 1, "evicted": 0}
+
+    def test_prefetch_out_of_order(self):
+        requests = self._snapshot(10)
+        with self._storage(TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_PREFETCH=2) as s:
+            for request in requests[5:] + requests[:5]:
+                assert s.retrieve_response(self.spider, request).url == request.url
+            assert len(s.prefetcher.pending) <= 2
+        stats = self._stats()
+        assert stats["hits"] + stats["misses"] == 10
+        assert stats["misses"] > 0
+
+    def test_prefetch_disabled(self):
+        requests = self._snapshot(2)
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            assert storage.prefetcher is None
+            assert storage.retrieve_response(self.spider, requests[0])
+        assert self._stats()["hits"] is None
+
+    def test_crawl_order_in_chunks(self):
+        requests = [Request(f"http://www.example.com/{i}") for i in range(10)]
+        with patch.object(DbmTimeMachineStorage, "order_chunk_size", 3):
+            with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+                for request in requests:
+                    response = self.response.replace(url=request.url)
+                    storage.store_response(self.spider, request, response)
+                    assert len(storage._order or ()) < 3
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            assert storage._get_order() == [storage._request_key(r) for r in requests]
+
+
+class SegmentPrefetchTimeMachineMWTest(PrefetchTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class ResponseCacheTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def setUp(self):
+        super().setUp()
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+
+    def _stats(self):
+        return {
+            name: self.crawler.stats.get_value(f"time_machine/response_cache/{name}")
+            for name in ("hits", "misses", "evicted")
+        }
+
+    def test_repeated_requests(self):
+        with self._middleware(
+            TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_RESPONSE_CACHE_SIZE=1024
+        ) as mw:
+            with patch.object(
+                mw.storage, "_find_data", wraps=mw.storage._find_data
+            ) as find_data:
+                first = mw.process_request(self.request, self.spider)
+                second = mw.process_request(self.request, self.spider)
+            assert find_data.call_count == 1
+            assert first is not second
+            assert first.flags == second.flags == ["snapshot"]
+            self.assertEqualResponse(first, self.response)
+            self.assertEqualResponse(second, self.response)
+        assert self._stats() == {"hits": 1, "misses": 1, "evicted": 0}
+
+    def test_eviction(self):
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_RESPONSE_CACHE_SIZE=1
+        ) as storage:
+            assert storage.retrieve_response(self.spider, self.request)
+            assert storage.retrieve_response(self.spider, self.request)
+            assert storage.response_cache.responses == {}
+        assert self._stats() == {"hits": 0, "misses": 2, "evicted": 0}
+
+    def test_lazy_bodies_are_not_cached(self):
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_RESPONSE_CACHE_SIZE=1024,
+            TIME_MACHINE_LAZY_BODIES=True,
+        ) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+            assert response._compressed_body is not None
+            assert storage.response_cache.responses == {}
+
+    def test_disabled(self):
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            assert storage.response_cache is None
+            assert storage.retrieve_response(self.spider, self.request)
+        assert self._stats()["hits"] is None
+
+
+class SegmentResponseCacheTimeMachineMWTest(ResponseCacheTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SqliteResponseCacheTimeMachineMWTest(ResponseCacheTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class HeaderTableTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _responses(self, run):
+        return [
+            self.response.replace(
+                url=f"http://www.example.com/{run}/{i}",
+                headers={
+                    "Content-Type": "text/html",
+                    "Content-Security-Policy": "default-src 'self'",
+                    "Date": f"Mon, 0{i} Jan 2024 00:00:00 GMT",
+                },
+            )
+            for i in range(5)
+        ]
+
+    def _snapshot(self, responses, **settings):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True, **settings) as storage:
+            for response in responses:
+                request = Request(response.url)
+                storage.store_response(self.spider, request, response)
+        return storage.header_table
+
+    def _assert_retrieved(self, responses):
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            for response in responses:
+                stored = storage.retrieve_response(self.spider, Request(response.url))
+                self.assertEqualResponse(stored, response)
+
+    def test_shared_headers(self):
+        responses = self._responses(0)
+        table = self._snapshot(responses)
+        # Dates differ between responses
+        assert sorted(name for name, _ in table.headers.values()) == [
+            b"Content-Security-Policy",
+            b"Content-Type",
+        ]
+        self._assert_retrieved(responses)
+
+    def test_appended_snapshot(self):
+        first, second = self._responses(0), self._responses(1)
+        self._snapshot(first)
+        second[0].headers["X-Run"] = "1"
+        second[1].headers["X-Run"] = "1"
+        # The headers of the first run are kept, X-Run is added after them
+        assert len(self._snapshot(second)) == 3
+        self._assert_retrieved(first + second)
+
+    def test_disabled(self):
+        responses = self._responses(0)
+        table = self._snapshot(responses, TIME_MACHINE_HEADER_TABLE_SIZE=0)
+        assert len(table) == 0
+        self._assert_retrieved(responses)
+
+    def test_invalid_size(self):
+        with pytest.raises(NotConfigured):
+            self._snapshot([], TIME_MACHINE_HEADER_TABLE_SIZE=0x10000)
+
+
+class SegmentHeaderTableTimeMachineMWTest(HeaderTableTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SqliteHeaderTableTimeMachineMWTest(HeaderTableTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class LazyBodyTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def _snapshot(self, **settings):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True, **settings) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+
+    def test_lazy_body(self):
+        self._snapshot()
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_LAZY_BODIES=True
+        ) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+            assert response._compressed_body.file is None
+            self.assertEqualResponse(response, self.response)
+            assert response._compressed_body is None
+
+    def test_spill(self):
+        self._snapshot()
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_LAZY_BODIES=True,
+            TIME_MACHINE_SPILL_SIZE=0,
+        ) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+        assert response._compressed_body.file is not None
+        # The body outlives the snapshot
+        self.assertEqualResponse(response, self.response)
+
+    def test_lazy_blob(self):
+        blobs = self.tmpdir + "/blobs.db"
+        self._snapshot(TIME_MACHINE_BLOB_STORE_URI=blobs)
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_LAZY_BODIES=True,
+            TIME_MACHINE_BLOB_STORE_URI=blobs,
+        ) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+            assert response._compressed_body is not None
+        self.assertEqualResponse(response, self.response)
+
+
+class SegmentLazyBodyTimeMachineMWTest(LazyBodyTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class IncrementalTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def setUp(self):
+        super().setUp()
+        self.other_request = Request("http://www.example.com/other")
+        self.other_response = Response(
+            self.other_request.url,
+            headers={"ETag": '"v1"', "Last-Modified": "Sun, 01 Jan 2023 00:00:00 GMT"},
+            body=b"other body",
+        )
+        with self._middleware(
+            TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_URI=self.tmpdir + "/base.db"
+        ) as mw:
+            mw.process_response(self.request, self.response, self.spider)
+            mw.process_response(self.other_request, self.other_response, self.spider)
+
+    def _incremental(self, **settings):
+        return self._middleware(
+            TIME_MACHINE_SNAPSHOT=True,
+            TIME_MACHINE_BASE_URI=self.tmpdir + "/base.db",
+            **settings,
+        )
+
+    def _stat(self, name):
+        return self.crawler.stats.get_value(f"time_machine/incremental/{name}")
+
+    def test_fresh_responses_are_not_downloaded(self):
+        new_request = Request("http://www.example.com/new")
+        new_response = Response(new_request.url, body=b"new body")
+        with self._incremental() as mw:
+            response = mw.process_request(self.request, self.spider)
+            self.assertEqualResponse(response, self.response)
+            assert "snapshot" in response.flags
+            mw.process_response(self.request, response, self.spider)
+            assert mw.process_request(new_request, self.spider) is None
+            mw.process_response(new_request, new_response, self.spider)
+        assert self._stat("fresh") == 1
+        assert self._stat("new") == 1
+
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            # Only the new response is in the delta
+            assert storage._load_response(storage._request_key(self.request)) is None
+            for request, response in [
+                (self.request, self.response),
+                (self.other_request, self.other_response),
+                (new_request, new_response),
+            ]:
+                stored = storage.retrieve_response(self.spider, request)
+                self.assertEqualResponse(stored, response)
+
+    def test_stale_responses_are_refreshed(self):
+        updated = self.other_response.replace(body=b"updated body")
+        with patch("scrapy_time_machine.storages.time", return_value=time() + 60):
+            with self._incremental(TIME_MACHINE_TTL_PATTERNS={"/other$": 30}) as mw:
+                assert mw.process_request(self.request, self.spider)
+                assert mw.process_request(self.other_request, self.spider) is None
+                assert "snapshot_response" in self.other_request.meta
+                mw.process_response(self.other_request, updated, self.spider)
+                assert "snapshot_response" not in self.other_request.meta
+        assert self._stat("fresh") == 1
+        assert self._stat("stale") == 1
+
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            stored = storage.retrieve_response(self.spider, self.other_request)
+            self.assertEqualResponse(stored, updated)
+
+    def test_stale_response_recovers_download_errors(self):
+        with self._incremental(TIME_MACHINE_TTL=-1) as mw:
+            assert mw.process_request(self.request, self.spider) is None
+            response = mw.process_exception(self.request, TimeoutError(), self.spider)
+        self.assertEqualResponse(response, self.response)
+        assert self.crawler.stats.get_value("time_machine/errorrecovery") == 1
+
+    def test_not_modified_responses_keep_their_body(self):
+        not_modified = Response(
+            self.other_request.url,
+            status=304,
+            headers={"ETag": '"v1"', "Date": "Mon, 02 Jan 2023 00:00:00 GMT"},
+        )
+        with self._incremental(TIME_MACHINE_TTL=-1) as mw:
+            assert mw.process_request(self.other_request, self.spider) is None
+            headers = self.other_request.headers
+            assert headers[b"If-None-Match"] == b'"v1"'
+            assert headers[b"If-Modified-Since"] == b"Sun, 01 Jan 2023 00:00:00 GMT"
+            response = mw.process_response(
+                self.other_request, not_modified, self.spider
+            )
+        assert response.status == 200
+        assert response.body == self.other_response.body
+        assert response.headers[b"Date"] == b"Mon, 02 Jan 2023 00:00:00 GMT"
+        assert "revalidated" in response.flags
+        stats = self.crawler.stats
+        assert stats.get_value("time_machine/revalidation/requests") == 1
+        assert stats.get_value("time_machine/revalidation/hits") == 1
+        assert stats.get_value("time_machine/revalidation/bytes_saved") == len(
+            self.other_response.body
+        )
+
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            key = storage._request_key(self.other_request)
+            assert storage._read_data(key)["base_body"]
+            stored = storage.retrieve_response(self.spider, self.other_request)
+            self.assertEqualResponse(stored, response)
+
+    def test_revalidation_disabled(self):
+        with self._incremental(
+            TIME_MACHINE_TTL=-1, TIME_MACHINE_REVALIDATE=False
+        ) as mw:
+            assert mw.process_request(self.other_request, self.spider) is None
+        assert b"If-None-Match" not in self.other_request.headers
+
+    def test_missing_base(self):
+        with self._middleware(
+            TIME_MACHINE_SNAPSHOT=True,
+            TIME_MACHINE_BASE_URI=self.tmpdir + "/missing.db",
+        ) as mw:
+            assert mw.storage.base is None
+            assert mw.process_request(self.request, self.spider) is None
+
+    def test_base_is_not_the_snapshot(self):
+        with self._middleware(
+            TIME_MACHINE_SNAPSHOT=True,
+            TIME_MACHINE_URI=self.tmpdir + "/base.db",
+            TIME_MACHINE_BASE_URI=self.tmpdir + "/base.db",
+        ) as mw:
+            assert mw.storage.base is None
+
+
+class SegmentIncrementalTimeMachineMWTest(IncrementalTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SqliteIncrementalTimeMachineMWTest(IncrementalTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class DeltaTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def setUp(self):
+        pytest.importorskip("zstandard")
+        super().setUp()
+
+    def _body(self, run):
+        return b"".join(b"<p>line %d</p>" % i for i in range(2000)) + b"run %d" % run
+
+    def _uri(self, run):
+        return f"{self.tmpdir}/run{run}.db"
+
+    def _snapshot(self, run, **settings):
+        response = self.response.replace(body=self._body(run))
+        with self._middleware(
+            TIME_MACHINE_SNAPSHOT=True,
+            TIME_MACHINE_URI=self._uri(run),
+            TIME_MACHINE_BASE_URI=self._uri(run - 1),
+            TIME_MACHINE_TTL=-1,
+            TIME_MACHINE_DELTA=True,
+            TIME_MACHINE_DELTA_CHAIN=2,
+            **settings,
+        ) as mw:
+            assert mw.process_request(self.request, self.spider) is None
+            mw.process_response(self.request, response, self.spider)
+
+    def test_delta_chain(self):
+        for run in range(5):
+            self._snapshot(run)
+        for run, depth in enumerate([None, 1, 2, None, 1]):
+            with self._storage(
+                TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_URI=self._uri(run)
+            ) as storage:
+                key = storage._request_key(self.request)
+                assert storage._read_data(key).get("delta") == depth
+                response = storage.retrieve_response(self.spider, self.request)
+                assert response.body == self._body(run)
+        stats = self.crawler.stats
+        assert stats.get_value("time_machine/delta/bodies") == 3
+        assert stats.get_value("time_machine/delta/keyframes") == 1
+        assert stats.get_value("time_machine/delta/ratio") > 100
+
+    def test_lazy_reference(self):
+        for run in range(2):
+            self._snapshot(run, TIME_MACHINE_LAZY_BODIES=True)
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True,
+            TIME_MACHINE_URI=self._uri(1),
+            TIME_MACHINE_LAZY_BODIES=True,
+        ) as storage:
+            response = storage.retrieve_response(self.spider, self.request)
+            assert response.body == self._body(1)
+
+
+class SegmentDeltaTimeMachineMWTest(DeltaTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SqliteDeltaTimeMachineMWTest(DeltaTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class ExternalBodyTimeMachineMWTest(TimeMachineMiddlewareTest):
+    def setUp(self):
+        super().setUp()
+        self.small_request = Request("http://www.example.com/small")
+        self.small_response = Response(self.small_request.url, body=b"small")
+
+    def _snapshot(self):
+        with self._storage(
+            TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_EXTERNAL_BODY_SIZE=5
+        ) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            storage.store_response(self.spider, self.small_request, self.small_response)
+        return storage
+
+    def test_external_body(self):
+        storage = self._snapshot()
+        bodies = storage.snapshot_uri + ".bodies"
+        assert len(os.listdir(bodies)) == 1
+        assert self.crawler.stats.get_value("time_machine/external/bodies") == 1
+        for lazy in (False, True):
+            with self._storage(
+                TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_LAZY_BODIES=lazy
+            ) as storage:
+                response = storage.retrieve_response(self.spider, self.request)
+                small = storage.retrieve_response(self.spider, self.small_request)
+                self.assertEqualResponse(response, self.response)
+                self.assertEqualResponse(small, self.small_response)
+
+    def test_same_body_stored_once(self):
+        with self._storage(
+            TIME_MACHINE_SNAPSHOT=True, TIME_MACHINE_EXTERNAL_BODY_SIZE=1
+        ) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            other = Request("http://www.example.com/other")
+            storage.store_response(self.spider, other, self.response)
+        assert len(os.listdir(storage.snapshot_uri + ".bodies")) == 1
+
+    def test_disabled(self):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            assert storage.body_store is None
+        assert not os.path.exists(storage.snapshot_uri + ".bodies")
+
+
+class SegmentExternalBodyTimeMachineMWTest(ExternalBodyTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SqliteExternalBodyTimeMachineMWTest(ExternalBodyTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class SegmentArchiveTimeMachineMWTest(ArchiveTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SegmentDedupTimeMachineMWTest(DedupTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+
+class SegmentStorageTimeMachineMWTest(TimeMachineMiddlewareTest):
+    storage_class = "scrapy_time_machine.storages.SegmentTimeMachineStorage"
+
+    def test_snapshot_and_retrieve(self):
+        other_request = Request("http://www.example.com/other")
+        other_response = Response(other_request.url, body=b"other body")
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+            mw.process_response(self.request, self.response, self.spider)
+            mw.process_response(other_request, other_response, self.spider)
+        with self._middleware(TIME_MACHINE_RETRIEVE=True) as mw:
+            assert mw.storage.mmap is not None
+            response = mw.process_request(self.request, self.spider)
+            self.assertEqualResponse(response, self.response)
+            response = mw.process_request(other_request, self.spider)
+            self.assertEqualResponse(response, other_response)
+
+    def test_snapshot_appends_to_existing_file(self):
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+            mw.process_response(self.request, self.response, self.spider)
+        response = self.response.replace(body=b"new body")
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+            mw.process_response(self.request, response, self.spider)
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            assert len(storage.index) == 1
+            stored = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(stored, response)
+
+    def test_truncated_index(self):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+        with open(storage.index_uri, "ab") as f:
+            f.write(b"\x00\x14")
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            assert storage.retrieve_response(self.spider, self.request)
+
+    def test_retrieve_rejects_pickles(self):
+        with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+            key = storage._request_key(self.request)
+            with storage._write_lock:
+                storage._put(key, pickle.dumps({"status": 200}, protocol=2))
+        with self._storage(
+            TIME_MACHINE_RETRIEVE=True, TIME_MACHINE_LEGACY_RECORDS=True
+        ) as storage:
+            with pytest.raises(ValueError):
+                storage.retrieve_response(self.spider, self.request)
+
+
+class SqliteArchiveTimeMachineMWTest(ArchiveTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class SqliteDedupTimeMachineMWTest(DedupTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class SqlitePrefetchTimeMachineMWTest(PrefetchTimeMachineMWTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+
+class SqliteStorageTimeMachineMWTest(TimeMachineMiddlewareTest):
+    storage_class = "scrapy_time_machine.storages.SqliteTimeMachineStorage"
+
+    def _responses(self, count):
+        for i in range(count):
+            request = Request(f"http://www.example.com/{i}")
+            status = 404 if i % 2 else 200
+            yield request, Response(request.url, status=status, body=b"%d" % i)
+
+    def test_snapshot_and_retrieve(self):
+        with self._middleware(TIME_MACHINE_SNAPSHOT=True) as mw:
+            assert mw.process_request(self.request, self.spider) is None
+            mw.process_response(self.request, self.response, self.spider)
+        with self._middleware(TIME_MACHINE_RETRIEVE=True) as mw:
+            response = mw.process_request(self.request, self.spider)
+            self.assertEqualResponse(response, self.response)
+            assert "snapshot" in response.flags
+            unknown = Request("http://www.example.com/unknown")
+            assert mw.storage.retrieve_response(self.spider, unknown) is None
+
+    def test_threaded_writes(self):
+        settings = {"TIME_MACHINE_SNAPSHOT": True, "TIME_MACHINE_WRITE_WORKERS": 4}
+        with self._storage(**settings) as storage:
+            for request, response in self._responses(50):
+                storage.store_response(self.spider, request, response)
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+            for request, response in self._responses(50):
+                stored = storage.retrieve_response(self.spider, request)
+                self.assertEqualResponse(stored, response)
+
+    def test_batched_commits_are_visible_to_readers(self):
+        settings = {
+            "TIME_MACHINE_SNAPSHOT": True,
+            "TIME_MACHINE_SQLITE_BATCH_SIZE": 10,
+        }
+        responses = list(self._responses(15))
+        with self._storage(**settings) as writer:
+            for request, response in responses:
+                writer.store_response(self.spider, request, response)
+            # Only the first batch is committed while the snapshot is written
+            with self._storage(TIME_MACHINE_RETRIEVE=True) as reader:
+                for request, response in responses[:10]:
+                    assert reader.retrieve_response(self.spider, request)
+                for request, response in responses[10:]:
+                    assert reader.retrieve_response(self.spider, request) is None
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as reader:
+            for request, response in responses:
+                assert reader.retrieve_response(self.spider, request)
+
+    def test_query(self):
+        with patch("scrapy_time_machine.storages.time", side_effect=range(100)):
+            with self._storage(TIME_MACHINE_SNAPSHOT=True) as storage:
+                for request, response in self._responses(12):
+                    storage.store_response(self.spider, request, response)
+        with self._storage(TIME_MACHINE_RETRIEVE=True) as storage:
+
+            def urls(**filters):
+                return [url for _, url, _, _ in storage.query(**filters)]
+
+            assert len(urls()) == 12
+            assert urls(url_prefix="http://www.example.com/1") == [
+                "http://www.example.com/1",
+                "http://www.example.com/10",
+                "http://www.example.com/11",
+            ]
+            assert urls(status=404, url_prefix="http://www.example.com/1") == [
+                "http://www.example.com/1",
+                "http://www.example.com/11",
+            ]
+            assert len(urls(status=200)) == 6
+            assert len(urls(since=3, until=7)) == 4
+            assert urls(url_prefix="http://other") == []
+
 
 if __name__ == "__main__":
     unittest.main()
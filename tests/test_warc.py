@@ -0,0 +1,210 @@
+import gzip
+import zlib
+
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+
+from scrapy_time_machine.convert import open_storage
+from scrapy_time_machine.warc import (
+    export_warc,
+    import_warc,
+    iter_records,
+    open_warc,
+    parse_http_response,
+)
+
+STORAGES = [
+    "scrapy_time_machine.storages.DbmTimeMachineStorage",
+    "scrapy_time_machine.storages.SegmentTimeMachineStorage",
+    "scrapy_time_machine.storages.SqliteTimeMachineStorage",
+]
+
+RESPONSES = [
+    Response(
+        f"http://www.example.com/{i}",
+        headers={"Content-Type": "text/html", "Set-Cookie": ["a=1", "b=2"]},
+        body=b"body %d" % i,
+        status=200 + i,
+    )
+    for i in range(3)
+]
+
+
+def warc_record(headers, block):
+    head = b"".join(b"%s: %s\r\n" % item for item in headers.items())
+    length = b"Content-Length: %d\r\n" % len(block)
+    return b"WARC/1.0\r\n" + head + length + b"\r\n" + block + b"\r\n\r\n"
+
+
+# A response from another tool, with a chunked body, after its POST request
+FOREIGN_WARC = warc_record(
+    {
+        b"WARC-Type": b"request",
+        b"WARC-Record-ID": b"<urn:uuid:1>",
+        b"WARC-Target-URI": b"http://www.example.com/form",
+        b"Content-Type": b"application/http;msgtype=request",
+    },
+    b"POST /form HTTP/1.1\r\nHost: a\r\n\r\nq=search",
+) + warc_record(
+    {
+        b"WARC-Type": b"response",
+        b"WARC-Record-ID": b"<urn:uuid:2>",
+        b"WARC-Concurrent-To": b"<urn:uuid:1>",
+        b"WARC-Date": b"2024-01-02T03:04:05Z",
+        b"WARC-Target-URI": b"http://www.example.com/form",
+        b"Content-Type": b"application/http; msgtype=response",
+    },
+    b"HTTP/1.1 200 OK\r\ntransfer-encoding: chunked\r\n\r\n"
+    b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n",
+)
+
+
+def snapshot(settings, uri, responses):
+    storage = open_storage(settings, uri, "snapshot")
+    for response in responses:
+        storage.store_response(None, Request(response.url), response)
+    storage.close_spider(None)
+
+
+def retrieve(settings, uri, requests):
+    storage = open_storage(settings, uri, "retrieve")
+    try:
+        return [storage.retrieve_response(None, request) for request in requests]
+    finally:
+        storage.close_spider(None)
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_roundtrip(tmp_path, storage):
+    settings = Settings({"TIME_MACHINE_STORAGE": storage})
+    source = str(tmp_path / "source")
+    snapshot(settings, source, RESPONSES)
+    path = str(tmp_path / "snapshot.warc.gz")
+    assert export_warc(settings, source, path) == len(RESPONSES)
+
+    target = str(tmp_path / "target")
+    assert import_warc(settings, [path], target) == len(RESPONSES)
+    requests = [Request(response.url) for response in RESPONSES]
+    for original, stored in zip(RESPONSES, retrieve(settings, target, requests)):
+        assert stored.url == original.url
+        assert stored.status == original.status
+        assert stored.headers == original.headers
+        assert stored.body == original.body
+
+
+def test_records_are_separate_gzip_members(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "source")
+    snapshot(settings, source, RESPONSES)
+    path = str(tmp_path / "snapshot.warc.gz")
+    export_warc(settings, source, path)
+    with open(path, "rb") as f:
+        data = f.read()
+    members = 0
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        record = decompressor.decompress(data)
+        assert record.startswith(b"WARC/1.1\r\n")
+        data = decompressor.unused_data
+        members += 1
+    # warcinfo and responses
+    assert members == len(RESPONSES) + 1
+
+
+def test_uncompressed_export(tmp_path):
+    settings = Settings()
+    source = str(tmp_path / "source")
+    snapshot(settings, source, RESPONSES[:1])
+    path = str(tmp_path / "snapshot.warc")
+    export_warc(settings, source, path)
+    with open_warc(path) as f:
+        types = [headers["warc-type"] for headers, _ in iter_records(f)]
+    assert types == ["warcinfo", "response"]
+
+
+def test_import_foreign_warc(tmp_path):
+    path = tmp_path / "foreign.warc.gz"
+    path.write_bytes(gzip.compress(FOREIGN_WARC))
+    settings = Settings()
+    target = str(tmp_path / "target")
+    assert import_warc(settings, [str(path)], target) == 1
+
+    request = Request("http://www.example.com/form", method="POST", body=b"q=search")
+    (response,) = retrieve(settings, target, [request])
+    assert response.body == b"hello world"
+    assert b"Transfer-Encoding" not in response.headers
+    storage = open_storage(settings, target, "retrieve")
+    try:
+        data = storage._find_data(storage._request_key(request))
+        assert data["time"] == 1704164645.0
+    finally:
+        storage.close_spider(None)
+
+
+def test_latest_response_wins(tmp_path):
+    settings = Settings()
+    paths = []
+    for i, body in enumerate((b"old", b"new")):
+        source = str(tmp_path / f"source{i}")
+        snapshot(settings, source, [RESPONSES[0].replace(body=body)])
+        paths.append(str(tmp_path / f"{i}.warc.gz"))
+        export_warc(settings, source, paths[-1])
+    target = str(tmp_path / "target")
+    import_warc(settings, paths, target)
+    (response,) = retrieve(settings, target, [Request(RESPONSES[0].url)])
+    assert response.body == b"new"
+
+
+def test_export_incremental_snapshot(tmp_path):
+    settings = Settings()
+    base, delta = str(tmp_path / "base"), str(tmp_path / "delta")
+    snapshot(settings, base, RESPONSES[:2])
+    snapshot(Settings({"TIME_MACHINE_BASE_URI": base}), delta, RESPONSES[2:])
+    path = str(tmp_path / "snapshot.warc.gz")
+    assert export_warc(settings, delta, path) == len(RESPONSES)
+    target = str(tmp_path / "target")
+    import_warc(settings, [path], target)
+    requests = [Request(response.url) for response in RESPONSES]
+    stored = retrieve(settings, target, requests)
+    assert [r.body for r in stored] == [r.body for r in RESPONSES]
+
+
+def test_export_shards(tmp_path):
+    settings = Settings(
+        {
+            "TIME_MACHINE_STORAGE": "scrapy_time_machine.storages.ShardedTimeMachineStorage",
+            "TIME_MACHINE_SHARDS": 2,
+        }
+    )
+    source = str(tmp_path / "source")
+    snapshot(settings, source, RESPONSES)
+    path = str(tmp_path / "snapshot.warc.gz")
+    assert export_warc(settings, source, path) == len(RESPONSES)
+    target = str(tmp_path / "target")
+    import_warc(Settings(), [path], target)
+    requests = [Request(response.url) for response in RESPONSES]
+    stored = retrieve(Settings(), target, requests)
+    assert [r.body for r in stored] == [r.body for r in RESPONSES]
+
+
+def test_sharded_target(tmp_path):
+    settings = Settings(
+        {
+            "TIME_MACHINE_STORAGE": "scrapy_time_machine.storages.ShardedTimeMachineStorage"
+        }
+    )
+    with pytest.raises(NotConfigured):
+        import_warc(settings, [], str(tmp_path / "target"))
+
+
+def test_parse_http_response():
+    status, headers, body = parse_http_response(
+        b"HTTP/1.0 404 Not Found\nContent-Type: text/plain\n\nmissing"
+    )
+    assert (status, headers, body) == (
+        404,
+        {b"Content-Type": [b"text/plain"]},
+        b"missing",
+    )
@@ -0,0 +1,34 @@
+from threading import Event
+
+from scrapy_time_machine.writers import ThreadedWriter
+
+
+def test_close_waits_for_pending_writes():
+    written = []
+    writer = ThreadedWriter(written.append, maxsize=2, workers=2)
+    for i in range(10):
+        writer.put(i)
+    writer.close()
+    assert sorted(written) == list(range(10))
+    assert writer.threads == []
+
+
+def test_bounded_queue():
+    release = Event()
+    writer = ThreadedWriter(lambda _: release.wait(), maxsize=1, workers=1)
+    writer.put(1)  # picked up by the worker, which blocks
+    writer.put(2)  # waits in the queue
+    while not writer.full():
+        pass
+    release.set()
+    writer.close()
+
+
+def test_errors_are_counted():
+    def fail(_):
+        raise ValueError
+
+    writer = ThreadedWriter(fail)
+    writer.put(1)
+    writer.close()
+    assert writer.errors == 1